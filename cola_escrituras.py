@@ -0,0 +1,359 @@
+"""
+Cola de Escrituras a Google Sheets
+==================================
+Las escrituras de la app (filas nuevas y celdas actualizadas) no se envían en
+la petición del usuario: se encolan, se guardan en disco y un hilo en segundo
+plano las agrupa por hoja en llamadas `append_rows` / `batch_update`,
+reintentando con espera exponencial ante errores 429/5xx. Cada operación sale
+de la cola en cuanto su propia llamada se confirma.
+
+Un append que falló sin saber si llegó a aplicarse (timeout, 5xx) queda
+marcado con su 'intento'; antes de reenviarlo se buscan sus filas al final de
+la hoja para no duplicarlas. Las operaciones con error permanente (permisos,
+rango inválido...) pasan al archivo de fallidas, que la interfaz muestra para
+reintentarlas o descartarlas.
+
+Mientras una escritura está pendiente, la app la aplica sobre su copia en
+memoria de los datos (ver aplicar_operaciones) para no esperar a la API.
+"""
+
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import gspread
+from gspread.utils import rowcol_to_a1
+
+from sheets_api import ejecutar_en_hoja
+
+RUTA_COLA = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".detek_cache", "escrituras_pendientes.json")
+RUTA_FALLIDAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".detek_cache", "escrituras_fallidas.json")
+
+# Espera para juntar escrituras cercanas en un solo lote
+VENTANA_LOTE = 1.0
+# Reintentos ante errores transitorios
+ESPERA_MAXIMA = 60.0
+# Filas extra revisadas al final de la hoja al verificar un append sin confirmar
+MARGEN_VERIFICACION = 50
+
+_pendientes = []
+_fallidas = []
+_lock_cola = threading.Lock()
+_evento = threading.Event()
+_estado = {
+    "iniciada": False, "ruta": RUTA_COLA, "ruta_fallidas": RUTA_FALLIDAS,
+    "ultimo_error": "", "reintentos": 0, "espera_hasta": 0.0,
+    "fin_tabla": {},  # (sheet_id, hoja) -> última fila escrita por un append confirmado
+}
+
+
+def agregar_filas(sheet_id: str, hoja: str, filas: list) -> dict:
+    """Operación que agrega filas al final de una hoja."""
+    return {"id": uuid.uuid4().hex, "tipo": "append", "sheet_id": sheet_id, "hoja": hoja, "filas": filas}
+
+
+def actualizar_celda(sheet_id: str, hoja: str, fila: int, columna: int, valor) -> dict:
+    """Operación que actualiza una celda (fila y columna basadas en 1)."""
+    return {
+        "id": uuid.uuid4().hex, "tipo": "update", "sheet_id": sheet_id, "hoja": hoja,
+        "fila": fila, "columna": columna, "valor": valor,
+    }
+
+
+def _guardar_json(ruta: str, datos: list):
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        tmp = f"{ruta}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(datos, f, ensure_ascii=False)
+        os.replace(tmp, ruta)
+    except Exception as e:
+        print(f"No se pudo guardar la cola de escrituras: {e}")
+
+
+def _guardar():
+    """Persiste la cola en disco (se llama con _lock_cola tomado)."""
+    _guardar_json(_estado["ruta"], _pendientes)
+
+
+def _guardar_fallidas():
+    """Persiste las escrituras fallidas (se llama con _lock_cola tomado)."""
+    _guardar_json(_estado["ruta_fallidas"], _fallidas)
+
+
+def _cargar(ruta: str) -> list:
+    try:
+        with open(ruta, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        print(f"No se pudo leer la cola de escrituras: {e}")
+        return []
+
+
+def iniciar(client, ruta: str = RUTA_COLA, ruta_fallidas: str = RUTA_FALLIDAS):
+    """
+    Recupera las escrituras pendientes de disco y arranca el hilo de envío (una vez por proceso).
+
+    Args:
+        client: Cliente gspread autorizado
+        ruta: Archivo donde se persiste la cola
+        ruta_fallidas: Archivo de las escrituras con error permanente
+    """
+    with _lock_cola:
+        if _estado["iniciada"]:
+            return
+        _estado["iniciada"] = True
+        _estado["ruta"] = ruta
+        _estado["ruta_fallidas"] = ruta_fallidas
+        _pendientes.extend(_cargar(ruta))
+        _fallidas.extend(_cargar(ruta_fallidas))
+    threading.Thread(target=_trabajador, args=(client,), daemon=True).start()
+    if _pendientes:
+        _evento.set()
+
+
+def encolar(operaciones: list):
+    """Agrega operaciones a la cola, las persiste y despierta al hilo de envío."""
+    with _lock_cola:
+        _pendientes.extend(operaciones)
+        _guardar()
+    _evento.set()
+
+
+def pendientes(sheet_id: str = None) -> list:
+    """Copia de las operaciones aún no confirmadas por la API."""
+    with _lock_cola:
+        return [op for op in _pendientes if sheet_id is None or op["sheet_id"] == sheet_id]
+
+
+def estado_cola() -> dict:
+    """Resumen para mostrar en la interfaz: pendientes, fallidas, reintentos y último error."""
+    with _lock_cola:
+        return {
+            "pendientes": len(_pendientes),
+            "fallidas": len(_fallidas),
+            "reintentos": _estado["reintentos"],
+            "ultimo_error": _estado["ultimo_error"],
+        }
+
+
+def fallidas() -> list:
+    """Copia de las escrituras descartadas por error permanente (con 'error' y 'fecha')."""
+    with _lock_cola:
+        return list(_fallidas)
+
+
+def reintentar_fallidas():
+    """Devuelve las escrituras fallidas a la cola de envío."""
+    with _lock_cola:
+        for op in _fallidas:
+            _pendientes.append({k: v for k, v in op.items() if k not in ("error", "fecha", "intento")})
+        _fallidas.clear()
+        _guardar()
+        _guardar_fallidas()
+    _evento.set()
+
+
+def descartar_fallidas():
+    """Olvida las escrituras fallidas (el usuario ya las revisó)."""
+    with _lock_cola:
+        _fallidas.clear()
+        _guardar_fallidas()
+
+
+def _es_reintentable(error: Exception) -> bool:
+    if isinstance(error, gspread.exceptions.APIError):
+        codigo = getattr(error, "code", None) or 0
+        return codigo == 429 or codigo >= 500
+    # Errores de red (timeouts, conexión) también son transitorios
+    return isinstance(error, (ConnectionError, TimeoutError, OSError))
+
+
+def _quitar(operaciones: list):
+    """Saca de la cola las operaciones confirmadas."""
+    confirmadas = {op["id"] for op in operaciones}
+    with _lock_cola:
+        _pendientes[:] = [op for op in _pendientes if op["id"] not in confirmadas]
+        _guardar()
+
+
+def _a_fallidas(operaciones: list, error: Exception, hoja: str):
+    """Pasa a fallidas las operaciones con error permanente, para no bloquear la cola."""
+    print(f"Escritura en '{hoja}' no aplicada, queda en fallidas: {error}")
+    fecha = datetime.now().isoformat(timespec="seconds")
+    with _lock_cola:
+        _fallidas.extend({**op, "error": str(error), "fecha": fecha} for op in operaciones)
+        _estado["ultimo_error"] = f"{hoja}: {error}"
+        _guardar_fallidas()
+    _quitar(operaciones)
+
+
+def _normalizar_fila(fila: list) -> tuple:
+    """Fila comparable entre lo enviado y lo leído (números como float, sin celdas vacías al final)."""
+    valores = [
+        float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else ("" if v is None else str(v).strip())
+        for v in fila
+    ]
+    while valores and valores[-1] == "":
+        valores.pop()
+    return tuple(valores)
+
+
+def _contiene(filas_hoja: list, filas: list) -> bool:
+    n = len(filas)
+    return any(filas_hoja[i:i + n] == filas for i in range(len(filas_hoja) - n + 1))
+
+
+def _filas_finales(ws, cantidad: int, fin_conocido: int = None) -> list:
+    """
+    Últimas filas de la hoja donde podría haber quedado un append sin confirmar.
+
+    Con la última fila de un append confirmado se leen solo las siguientes;
+    si no se conoce (p. ej. tras reiniciar), se ubica el final con la columna A.
+    """
+    if fin_conocido:
+        inicio, fin = fin_conocido + 1, fin_conocido + cantidad + MARGEN_VERIFICACION
+    else:
+        fin = len(ws.col_values(1))
+        inicio = max(1, fin - cantidad - MARGEN_VERIFICACION + 1)
+    if fin < inicio:
+        return []
+    valores = ws.get(f"{inicio}:{fin}", value_render_option="UNFORMATTED_VALUE")
+    return [_normalizar_fila(fila) for fila in valores]
+
+
+def _enviar_filas(client, sheet_id: str, hoja: str, operaciones: list):
+    """
+    Agrega las filas de los appends de una hoja en una sola llamada, sin duplicar.
+
+    Los appends de un intento anterior sin confirmar se buscan primero al final
+    de la hoja; los que ya están se dan por enviados.
+    """
+    clave = (sheet_id, hoja)
+    previos = {}
+    for op in operaciones:
+        if op.get("intento"):
+            previos.setdefault(op["intento"], []).append(op)
+    if previos:
+        cantidad = sum(len(op["filas"]) for ops in previos.values() for op in ops)
+        filas_hoja = ejecutar_en_hoja(
+            client, sheet_id, hoja, lambda ws: _filas_finales(ws, cantidad, _estado["fin_tabla"].get(clave)),
+            tipo="lectura",
+        )
+        aplicadas = [
+            op for ops in previos.values()
+            if _contiene(filas_hoja, [_normalizar_fila(fila) for op in ops for fila in op["filas"]])
+            for op in ops
+        ]
+        if aplicadas:
+            print(f"{len(aplicadas)} escritura(s) en '{hoja}' ya estaban aplicadas; no se reenvían")
+            _quitar(aplicadas)
+        operaciones = [op for op in operaciones if op not in aplicadas]
+    if not operaciones:
+        return
+
+    # Se marca el intento en disco antes de la llamada: si no hay respuesta, se verifica
+    intento = uuid.uuid4().hex
+    with _lock_cola:
+        for op in operaciones:
+            op["intento"] = intento
+        _guardar()
+    filas = [fila for op in operaciones for fila in op["filas"]]
+    respuesta = ejecutar_en_hoja(client, sheet_id, hoja, lambda ws: ws.append_rows(filas))
+    rango = (respuesta or {}).get("updates", {}).get("updatedRange", "") if isinstance(respuesta, dict) else ""
+    fin = re.search(r"(\d+)$", rango)
+    if fin:
+        _estado["fin_tabla"][clave] = int(fin.group(1))
+    _quitar(operaciones)
+
+
+def _enviar_celdas(client, sheet_id: str, hoja: str, operaciones: list):
+    """Actualiza las celdas de una hoja en una sola llamada (repetirla no cambia el resultado)."""
+    celdas = [
+        {"range": rowcol_to_a1(op["fila"], op["columna"]), "values": [[op["valor"]]]}
+        for op in operaciones
+    ]
+    ejecutar_en_hoja(client, sheet_id, hoja, lambda ws: ws.batch_update(celdas))
+    _quitar(operaciones)
+
+
+def _vaciar(client):
+    """Envía lo pendiente agrupado por hoja: primero las filas nuevas, luego las celdas."""
+    lote = pendientes()
+    grupos = {}
+    for op in lote:
+        grupos.setdefault((op["sheet_id"], op["hoja"]), []).append(op)
+
+    for (sheet_id, hoja), operaciones in grupos.items():
+        for enviar, tipo in ((_enviar_filas, "append"), (_enviar_celdas, "update")):
+            seleccion = [op for op in operaciones if op["tipo"] == tipo]
+            if not seleccion:
+                continue
+            try:
+                enviar(client, sheet_id, hoja, seleccion)
+            except Exception as e:
+                if _es_reintentable(e):
+                    with _lock_cola:
+                        _estado["reintentos"] += 1
+                        _estado["ultimo_error"] = f"{hoja}: {e}"
+                        espera = min(ESPERA_MAXIMA, 2 ** min(_estado["reintentos"], 6)) * random.uniform(0.5, 1.5)
+                        _estado["espera_hasta"] = time.time() + espera
+                    print(f"Escritura en '{hoja}' pospuesta {espera:.1f}s: {e}")
+                    return
+                _a_fallidas(seleccion, e, hoja)
+                continue
+            with _lock_cola:
+                _estado["reintentos"] = 0
+
+
+def _trabajador(client):
+    while True:
+        _evento.wait(timeout=ESPERA_MAXIMA)
+        espera = _estado["espera_hasta"] - time.time()
+        if espera > 0:
+            time.sleep(espera)
+        time.sleep(VENTANA_LOTE)
+        _evento.clear()
+        try:
+            _vaciar(client)
+        except Exception as e:
+            print(f"Error en la cola de escrituras: {e}")
+        if pendientes():
+            _evento.set()
+
+
+def aplicar_operaciones(hojas: dict, encabezados: dict, operaciones: list) -> dict:
+    """
+    Aplica operaciones pendientes sobre los registros en memoria (sin tocar los originales).
+
+    Args:
+        hojas: Pestaña -> lista de registros
+        encabezados: Pestaña -> (fila_encabezado, encabezados) de la descarga
+        operaciones: Operaciones de este libro
+
+    Returns:
+        Nuevo diccionario de hojas con las filas agregadas y celdas actualizadas
+    """
+    if not operaciones:
+        return hojas
+    nuevas = dict(hojas)
+    for op in operaciones:
+        fila_encabezado, nombres = encabezados.get(op["hoja"], (1, []))
+        if not nombres:
+            continue
+        registros = list(nuevas.get(op["hoja"], []))
+        if op["tipo"] == "append":
+            registros.extend(dict(zip(nombres, fila)) for fila in op["filas"])
+        elif op["tipo"] == "update":
+            posicion = op["fila"] - fila_encabezado - 1
+            if 0 <= posicion < len(registros) and 0 < op["columna"] <= len(nombres):
+                registros[posicion] = {**registros[posicion], nombres[op["columna"] - 1]: op["valor"]}
+        nuevas[op["hoja"]] = registros
+    return nuevas
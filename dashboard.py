@@ -0,0 +1,118 @@
+"""
+Resumen del Dashboard
+=====================
+Agregados de la página "Dashboard" (conteos, partes más cambiadas, alertas de
+consumibles y equipos con más horas) calculados una sola vez por versión de
+datos. La página solo dibuja el resumen; si los datos no cambian no se recalcula
+nada.
+"""
+
+import pandas as pd
+
+# Consumibles con esta cantidad de horas restantes o menos aparecen en las alertas
+HORAS_ALERTA = 72
+TOP_PARTES = 5
+TOP_HORAS = 5
+
+
+def _partes_frecuentes(registro: pd.DataFrame, n: int = TOP_PARTES) -> pd.Series:
+    """Partes más cambiadas según 'parte cambiada' (separadas por ';')."""
+    if "parte cambiada" not in registro.columns:
+        return pd.Series(dtype="int64")
+    cambios = registro["parte cambiada"].dropna().astype(str).str.split(";").explode()
+    cambios = cambios[cambios.str.strip() != ""]  # eliminar vacíos
+    return cambios.value_counts().head(n)
+
+
+def _tabla_alertas(desgaste: pd.DataFrame, horas_alerta: int = HORAS_ALERTA) -> pd.DataFrame:
+    """Consumibles con vida útil definida y `horas_alerta` o menos restantes, más críticos primero."""
+    criticos = desgaste[(desgaste["vida_util"] != 0) & (desgaste["horas_restantes"] <= horas_alerta)]
+    alertas = pd.DataFrame({
+        "Estado": criticos["horas_restantes"].le(0).map({True: "🔴", False: "🟡"}),
+        "Consumible": criticos["consumible"],
+        "Empresa": criticos["empresa"],
+        "Equipo": criticos["codigo"].astype(str) + " - " + criticos["descripcion"].astype(str),
+        "Horas Usadas": criticos["horas_usadas"].round(1),
+        "Vida Útil (h)": criticos["vida_util"],
+        "Horas Restantes": criticos["horas_restantes"].astype(int),
+    })
+    return alertas.sort_values(by="Horas Restantes", ascending=True)
+
+
+def top_horas(registro: pd.DataFrame, n: int = TOP_HORAS, dias: int = None, hoy=None) -> pd.DataFrame:
+    """
+    Equipos con más horas acumuladas en 'Hoja 1'.
+
+    Args:
+        registro: DataFrame canónico de 'Hoja 1' (con 'horas_uso' y 'fecha_dt')
+        n: Cantidad de equipos a devolver
+        dias: Solo registros de los últimos `dias` días según 'fecha'; None para todo el historial
+        hoy: Fecha de referencia para la ventana (por defecto, hoy)
+
+    Returns:
+        DataFrame con columnas empresa, codigo, descripcion (la del último registro) y horas
+    """
+    columnas = ["empresa", "codigo", "descripcion", "horas"]
+    if registro.empty or "horas_uso" not in registro.columns:
+        return pd.DataFrame(columns=columnas)
+    if dias:
+        if "fecha_dt" not in registro.columns:
+            return pd.DataFrame(columns=columnas)
+        desde = pd.Timestamp(hoy or pd.Timestamp.now()).normalize() - pd.Timedelta(days=dias)
+        registro = registro[registro["fecha_dt"] >= desde]
+    base = pd.DataFrame({
+        col: registro[col].fillna("").astype(str) if col in registro.columns else ""
+        for col in ["empresa", "codigo", "descripcion"]
+    }, index=registro.index)
+    base["horas"] = registro["horas_uso"]
+    top = (
+        base.groupby(["empresa", "codigo"], sort=False)
+        .agg(descripcion=("descripcion", "last"), horas=("horas", "sum"))
+        .nlargest(n, "horas")
+        .reset_index()
+    )
+    return top[columnas]
+
+
+def texto_informe(resumen: dict) -> str:
+    """Informe de texto plano del Dashboard para descargar."""
+    texto = "Resumen Dashboard DeTEK PRO Company\n\n"
+    texto += f"Empresas registradas: {resumen['total_empresas']}\n"
+    texto += f"Equipos registrados: {resumen['total_equipos']}\n\n"
+    texto += "Partes más cambiadas:\n"
+    for parte, count in resumen["partes_frecuentes"].items():
+        texto += f"- {parte}: {count} cambios\n"
+    texto += "\nConsumibles que requieren atención:\n"
+    alertas = resumen["alertas"]
+    if not alertas.empty:
+        for eq in alertas.itertuples(index=False):
+            texto += f"- {eq[0]} Empresa: {eq[2]} | Equipo: {eq[3]} | Consumible: {eq[1]} | Restantes: {int(eq[6])} h\n"
+    else:
+        texto += "No hay consumibles en estado crítico o próximos a vencer.\n"
+    texto += "\nTop 5 equipos por horas acumuladas:\n"
+    for eq in resumen["top_horas"].itertuples(index=False):
+        texto += f"- {eq.empresa} - {eq.codigo}: {eq.horas:.1f} horas\n"
+    return texto
+
+
+def construir_resumen(frames: dict) -> dict:
+    """
+    Calcula todos los agregados del Dashboard para una versión de datos.
+
+    Args:
+        frames: Diccionario de DataFrames canónicos (con 'desgaste' ya calculado)
+
+    Returns:
+        Diccionario con 'total_empresas', 'total_equipos', 'partes_frecuentes',
+        'alertas', 'top_horas' e 'informe' (texto para exportar)
+    """
+    equipos = frames["equipos"]
+    resumen = {
+        "total_empresas": int(equipos["empresa"].nunique(dropna=False)) if "empresa" in equipos.columns else 0,
+        "total_equipos": int(equipos["codigo"].nunique(dropna=False)) if "codigo" in equipos.columns else 0,
+        "partes_frecuentes": _partes_frecuentes(frames["registro"]),
+        "alertas": _tabla_alertas(frames["desgaste"]),
+        "top_horas": top_horas(frames["registro"]),
+    }
+    resumen["informe"] = texto_informe(resumen)
+    return resumen
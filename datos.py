@@ -0,0 +1,380 @@
+"""
+Capa de Datos de Google Sheets
+==============================
+Construye una sola vez, por versión de datos descargada, los DataFrames
+canónicos de la app (registro, equipos, empresas, tareas y actas) con sus
+columnas derivadas ya calculadas.
+
+Los DataFrames devueltos se comparten entre sesiones y deben tratarse como
+solo lectura. Junto con ellos se precalculan índices por claves normalizadas
+(empresa, zona, código) para que las consultas de la app sean búsquedas en un
+diccionario en lugar de comparaciones de texto sobre columnas completas.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from desgaste import horas_numericas, normalizar_clave, normalizar_codigo
+from enlaces_drive import resolver_columna, url_directa
+
+# Columnas de enlaces de Drive que se resuelven al cargar: columna -> variante
+ENLACES_EQUIPOS = {"foto_url": "directa", "manual_url": "directa", "ficha_tecnica_url": "directa"}
+ENLACES_EMPRESAS = {"layout_url": "vista", "qr_url": "vista", "parametrosproce_url": "vista"}
+
+
+def _frame(registros) -> pd.DataFrame:
+    """DataFrame con nombres de columna normalizados (minúsculas, sin espacios extremos)."""
+    df = pd.DataFrame(registros or [])
+    df.columns = [str(col).lower().strip() for col in df.columns]
+    return df
+
+
+def clave(valor) -> str:
+    """Normaliza un valor escalar igual que normalizar_clave (strip + minúsculas)."""
+    return "" if valor is None else str(valor).strip().lower()
+
+
+def clave_codigo(valor) -> str:
+    """Normaliza un código de equipo (solo strip; los códigos distinguen mayúsculas)."""
+    return "" if valor is None else str(valor).strip()
+
+
+def _agregar_clave_codigo(df: pd.DataFrame) -> pd.DataFrame:
+    """Agrega 'codigo_key' (código como texto sin espacios extremos) si existe 'codigo'."""
+    if "codigo" in df.columns:
+        df["codigo_key"] = normalizar_codigo(df["codigo"])
+    return df
+
+
+def _agregar_clave_empresa(df: pd.DataFrame) -> pd.DataFrame:
+    """Agrega 'empresa_key' (empresa normalizada) si existe la columna 'empresa'."""
+    if "empresa" in df.columns:
+        df["empresa_key"] = normalizar_clave(df["empresa"])
+    return df
+
+
+def _agregar_enlaces(df: pd.DataFrame, enlaces: dict) -> pd.DataFrame:
+    """Agrega '<columna>_<variante>' con cada columna de enlaces de Drive ya resuelta."""
+    for col, variante in enlaces.items():
+        if col in df.columns:
+            df[f"{col}_{variante}"] = resolver_columna(df[col], variante)
+    return df
+
+
+def _parsear_fecha(serie: pd.Series) -> pd.Series:
+    """Parsea fechas ISO (formato que escribe la app) y, si falla, día/mes/año."""
+    texto = serie.astype(str).str.strip()
+    fechas = pd.to_datetime(texto, errors="coerce", format="%Y-%m-%d")
+    faltantes = fechas.isna() & (texto != "")
+    if faltantes.any():
+        fechas[faltantes] = pd.to_datetime(texto[faltantes], errors="coerce", dayfirst=True)
+    return fechas
+
+
+def construir_registro(registros) -> pd.DataFrame:
+    """
+    DataFrame de 'Hoja 1' con columnas derivadas.
+
+    Columnas agregadas al final (las originales no se modifican):
+        empresa_key: empresa normalizada (strip + minúsculas)
+        codigo_key: código como texto sin espacios extremos
+        horas_uso: 'hora de uso' numérica (inválidos = 0)
+        fecha_dt: 'fecha' como datetime (inválidos = NaT)
+    """
+    df = _agregar_clave_codigo(_agregar_clave_empresa(_frame(registros)))
+    if "hora de uso" in df.columns:
+        df["horas_uso"] = horas_numericas(df["hora de uso"])
+    if "fecha" in df.columns:
+        df["fecha_dt"] = _parsear_fecha(df["fecha"])
+    return df
+
+
+def registro_del_dia(registros, fecha) -> pd.DataFrame:
+    """
+    DataFrame mínimo de 'Hoja 1' con solo las filas de `fecha`.
+
+    Evita construir el DataFrame completo cuando solo importa un día: cada
+    texto de fecha distinto se parsea una vez (igual que en construir_registro)
+    y solo las filas del día, con las columnas 'empresa', 'codigo' y 'fecha',
+    pasan a construir_registro.
+
+    Args:
+        registros: Registros de 'Hoja 1' (lista de diccionarios)
+        fecha: Día buscado (date)
+
+    Returns:
+        DataFrame como el de construir_registro, restringido a esas filas y columnas
+    """
+    registros = registros or []
+    columnas = {str(col).lower().strip(): col for col in (registros[0] if registros else {})}
+    if "fecha" not in columnas:
+        return construir_registro([])
+    campo = columnas["fecha"]
+    textos = pd.Series(list({r.get(campo, "") for r in registros}), dtype=object)
+    del_dia = set(textos[_parsear_fecha(textos).dt.normalize() == pd.Timestamp(fecha)])
+    return construir_registro([
+        {col: r.get(columnas[col], "") for col in ("empresa", "codigo", "fecha") if col in columnas}
+        for r in registros
+        if r.get(campo, "") in del_dia
+    ])
+
+
+def construir_equipos(registros) -> pd.DataFrame:
+    """
+    DataFrame de 'Equipos' con 'empresa_key', 'zona_key' y 'codigo_key' normalizadas
+    y los enlaces de Drive resueltos ('foto_url_directa', 'manual_url_directa', ...).
+    """
+    df = _agregar_clave_codigo(_agregar_clave_empresa(_frame(registros)))
+    if "zona" in df.columns:
+        df["zona_key"] = normalizar_clave(df["zona"])
+    return _agregar_enlaces(df, ENLACES_EQUIPOS)
+
+
+def _indice(df: pd.DataFrame, columnas: list) -> dict:
+    """Posiciones de fila por clave (o tupla de claves) usando groupby().indices."""
+    if df.empty or not set(columnas).issubset(df.columns):
+        return {}
+    por = columnas[0] if len(columnas) == 1 else columnas
+    return df.groupby(por, sort=False).indices
+
+
+# Columnas de actas que pueden contener el número de OP (por subcadena del nombre)
+TERMINOS_COLUMNA_OP = ("op", "orden", "numero", "no")
+_PREFIJO_OP = re.compile(r"^op[\s\-_#.:]*")
+
+
+def clave_op(valor) -> str:
+    """
+    Normaliza un número de OP: strip, minúsculas, sin prefijo "OP-" y sin ceros a la izquierda.
+
+    "OP-00123", "op 123" y " 123 " dan todos "123".
+    """
+    texto = _PREFIJO_OP.sub("", clave(valor))
+    return texto.lstrip("0") or ("0" if texto else "")
+
+
+def columnas_op(actas: pd.DataFrame) -> list:
+    """
+    Columnas candidatas a número de OP en orden de prioridad; si ninguna lo parece, todas.
+
+    Las que contienen "op" van primero, luego "orden", "numero" y "no", para que
+    columnas como "nombre" no tapen a la columna de OP.
+    """
+    prioridad = {}
+    for col in actas.columns:
+        for orden, term in enumerate(TERMINOS_COLUMNA_OP):
+            if term in col:
+                prioridad[col] = orden
+                break
+    if not prioridad:
+        return actas.columns.tolist()
+    return sorted(prioridad, key=prioridad.get)
+
+
+def construir_indice_actas(actas: pd.DataFrame) -> dict:
+    """
+    Índice OP normalizada -> documentos de Drive del acta de entrega.
+
+    Como en la búsqueda original, gana la primera columna candidata (en orden)
+    donde aparece la OP, y se devuelven los links de todas sus filas.
+
+    Returns:
+        {clave_op: [{'nombre', 'url' (ya resuelta a enlace directo), 'columna_original'}, ...]}
+    """
+    if actas.empty:
+        return {}
+    texto = actas.astype(str).apply(lambda col: col.str.strip())
+    es_link = texto.apply(lambda col: col.str.lower().str.contains("drive.google.com", regex=False))
+
+    # Links de cada fila, calculados una sola vez
+    valores = texto.to_numpy()
+    links = es_link.to_numpy()
+    nombres = [str(col).replace("_", " ").replace("-", " ").title() for col in actas.columns]
+    documentos_fila = [
+        [
+            {"nombre": f"{nombres[c]} (Fila {idx + 1})", "url": url_directa(valores[pos, c]), "columna_original": actas.columns[c]}
+            for c in links[pos].nonzero()[0]
+        ]
+        for pos, idx in enumerate(actas.index)
+    ]
+
+    indice = {}
+    for col in columnas_op(actas):
+        claves = texto.iloc[:, actas.columns.get_loc(col)].map(clave_op)
+        for clave_busqueda, posiciones in claves.groupby(claves, sort=False).indices.items():
+            if clave_busqueda and clave_busqueda not in indice:
+                indice[clave_busqueda] = [doc for pos in posiciones for doc in documentos_fila[pos]]
+    return indice
+
+
+# Índices por claves: nombre -> (tabla, columnas)
+INDICES = {
+    "equipos_empresa": ("equipos", ["empresa_key"]),
+    "equipos_zona": ("equipos", ["empresa_key", "zona_key"]),
+    "equipos_codigo": ("equipos", ["empresa_key", "codigo_key"]),
+    "registro_empresa": ("registro", ["empresa_key"]),
+    "registro_codigo": ("registro", ["empresa_key", "codigo_key"]),
+    "empresas": ("empresas", ["empresa_key"]),
+    "tareas": ("tareas", ["empresa_key"]),
+}
+
+
+def construir_indices(frames: dict) -> dict:
+    """
+    Precalcula los índices de búsqueda sobre los DataFrames canónicos.
+
+    Returns:
+        Diccionario nombre -> {clave: posiciones de fila}
+    """
+    indices = {nombre: _indice(frames[tabla], columnas) for nombre, (tabla, columnas) in INDICES.items()}
+    indices["actas_op"] = construir_indice_actas(frames["actas"])
+    return indices
+
+
+def _filas(frames: dict, tabla: str, indice: str, clave_busqueda) -> pd.DataFrame:
+    """Devuelve las filas de `tabla` cuyo índice `indice` coincide con la clave."""
+    df = frames[tabla]
+    posiciones = frames["indices"][indice].get(clave_busqueda)
+    if posiciones is None:
+        return df.iloc[0:0]
+    return df.iloc[posiciones]
+
+
+def equipos_de(frames: dict, empresa, zona=None, codigo=None) -> pd.DataFrame:
+    """
+    Equipos de una empresa, opcionalmente filtrados por zona o por código.
+
+    Args:
+        frames: Diccionario devuelto por construir_frames
+        empresa: Nombre de la empresa (se normaliza)
+        zona: Zona (se normaliza); None para todas
+        codigo: Código del equipo; None para todos
+
+    Returns:
+        Vista de `frames['equipos']` (no modificar)
+    """
+    if codigo is not None:
+        return _filas(frames, "equipos", "equipos_codigo", (clave(empresa), clave_codigo(codigo)))
+    if zona is not None:
+        return _filas(frames, "equipos", "equipos_zona", (clave(empresa), clave(zona)))
+    return _filas(frames, "equipos", "equipos_empresa", clave(empresa))
+
+
+def registros_de(frames: dict, empresa, codigo=None) -> pd.DataFrame:
+    """Filas de 'Hoja 1' de una empresa, o de un equipo si se indica el código."""
+    if codigo is not None:
+        return _filas(frames, "registro", "registro_codigo", (clave(empresa), clave_codigo(codigo)))
+    return _filas(frames, "registro", "registro_empresa", clave(empresa))
+
+
+def empresa_info(frames: dict, empresa) -> pd.DataFrame:
+    """Filas de la hoja 'Empresas' para una empresa."""
+    return _filas(frames, "empresas", "empresas", clave(empresa))
+
+
+def tareas_de(frames: dict, empresa) -> pd.DataFrame:
+    """Filas de la hoja 'Tareas' para una empresa."""
+    return _filas(frames, "tareas", "tareas", clave(empresa))
+
+
+def agregar_desgaste(frames: dict, desgaste: pd.DataFrame) -> dict:
+    """Guarda la tabla de desgaste en `frames` junto con su índice por equipo."""
+    frames["desgaste"] = desgaste
+    frames["indices"]["desgaste_equipo"] = _indice(desgaste, ["equipo_idx"])
+    return frames
+
+
+def desgaste_de(frames: dict, equipo_idx) -> pd.DataFrame:
+    """Filas de la tabla de desgaste de un equipo (por índice de fila en 'Equipos')."""
+    return _filas(frames, "desgaste", "desgaste_equipo", equipo_idx)
+
+
+def actas_de(frames: dict, numero_op) -> list:
+    """Documentos del acta de entrega de una OP (lista vacía si no hay)."""
+    return frames["indices"]["actas_op"].get(clave_op(numero_op), [])
+
+
+# Constructor de cada tabla que puede recibir escrituras optimistas
+CONSTRUCTORES = {
+    "registro": construir_registro,
+    "equipos": construir_equipos,
+    "empresas": lambda registros: _agregar_enlaces(_agregar_clave_empresa(_frame(registros)), ENLACES_EMPRESAS),
+    "tareas": lambda registros: _agregar_clave_empresa(_frame(registros)),
+}
+
+
+def _extender_indice(indice: dict, nuevas: pd.DataFrame, columnas: list, desplazamiento: int) -> dict:
+    """Índice con las posiciones de las filas nuevas (agregadas al final) sumadas."""
+    extendido = dict(indice)
+    for clave_busqueda, posiciones in _indice(nuevas, columnas).items():
+        anteriores = extendido.get(clave_busqueda)
+        posiciones = posiciones + desplazamiento
+        extendido[clave_busqueda] = posiciones if anteriores is None else np.concatenate([anteriores, posiciones])
+    return extendido
+
+
+def aplicar_cambios(frames: dict, agregadas: dict = None, reemplazadas: dict = None) -> dict:
+    """
+    Frames con escrituras optimistas aplicadas, sin reconstruir las tablas intactas.
+
+    Las filas agregadas al final se construyen aparte, se concatenan y solo se
+    suman sus posiciones a los índices; una tabla con celdas editadas se
+    reconstruye completa (solo esa tabla y sus índices). La tabla de desgaste
+    no se toca.
+
+    Args:
+        frames: Diccionario devuelto por construir_frames (no se modifica)
+        agregadas: Tabla ('registro', 'equipos', ...) -> registros nuevos al final
+        reemplazadas: Tabla -> todos los registros de la tabla
+
+    Returns:
+        Nuevo diccionario de frames
+    """
+    nuevos = {**frames, "indices": dict(frames["indices"])}
+    for tabla, registros in (reemplazadas or {}).items():
+        nuevos[tabla] = CONSTRUCTORES[tabla](registros)
+        for nombre, (tabla_indice, columnas) in INDICES.items():
+            if tabla_indice == tabla:
+                nuevos["indices"][nombre] = _indice(nuevos[tabla], columnas)
+    for tabla, registros in (agregadas or {}).items():
+        if not registros or tabla in (reemplazadas or {}):
+            continue
+        anterior = nuevos[tabla]
+        filas = CONSTRUCTORES[tabla](registros)
+        nuevos[tabla] = pd.concat([anterior, filas], ignore_index=True) if not anterior.empty else filas
+        for nombre, (tabla_indice, columnas) in INDICES.items():
+            if tabla_indice != tabla:
+                continue
+            if anterior.empty or not set(columnas).issubset(anterior.columns):
+                nuevos["indices"][nombre] = _indice(nuevos[tabla], columnas)
+            else:
+                nuevos["indices"][nombre] = _extender_indice(nuevos["indices"][nombre], filas, columnas, len(anterior))
+    return nuevos
+
+
+def construir_frames(registro, equipos, empresas, tareas, actas) -> dict:
+    """
+    Construye todos los DataFrames canónicos de la app.
+
+    Args:
+        registro: Registros de 'Hoja 1'
+        equipos: Registros de 'Equipos'
+        empresas: Registros de 'Empresas'
+        tareas: Registros de 'Tareas'
+        actas: Registros de la hoja de actas de entrega
+
+    Returns:
+        Diccionario con las claves 'registro', 'equipos', 'empresas', 'tareas',
+        'actas' e 'indices'
+    """
+    frames = {
+        "registro": construir_registro(registro),
+        "equipos": construir_equipos(equipos),
+        "empresas": CONSTRUCTORES["empresas"](empresas),
+        "tareas": CONSTRUCTORES["tareas"](tareas),
+        "actas": _frame(actas),
+    }
+    frames["indices"] = construir_indices(frames)
+    return frames
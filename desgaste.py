@@ -0,0 +1,300 @@
+"""
+Motor de Desgaste de Consumibles
+================================
+Calcula, en una sola pasada vectorizada sobre la hoja "Hoja 1", las horas de uso
+acumuladas de cada consumible desde su último cambio.
+
+El resultado es una tabla "tidy" con una fila por (equipo, consumible) que
+consultan todas las vistas de la app: alertas por empresa, Dashboard, alertas
+por zona y detalle del equipo seleccionado.
+
+Como 'Hoja 1' solo crece agregando filas, el estado se guarda en un checkpoint
+(memoria + disco) y en cada recarga solo se aplican las filas nuevas.
+"""
+
+import hashlib
+import os
+import pickle
+import threading
+
+import pandas as pd
+
+# Vida útil usada cuando la hoja 'Equipos' no define una válida
+VIDA_UTIL_DEFECTO = 700
+
+# Checkpoint persistido del estado de desgaste (última fila procesada de 'Hoja 1')
+RUTA_CHECKPOINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".detek_cache", "desgaste_checkpoint.pkl")
+VERSION_CHECKPOINT = 2
+
+# Columnas de 'Hoja 1' que afectan el desgaste
+COLUMNAS_REGISTRO = ["empresa", "codigo", "hora de uso", "parte cambiada"]
+
+COLUMNAS_DESGASTE = [
+    "equipo_idx", "empresa", "empresa_key", "codigo", "descripcion",
+    "consumible", "posicion", "vida_util", "horas_usadas", "horas_restantes",
+]
+
+_estados_en_memoria = {}
+_lock_checkpoint = threading.Lock()
+
+
+def normalizar_clave(serie: pd.Series) -> pd.Series:
+    """Normaliza una columna de texto para comparaciones (strip + minúsculas)."""
+    return serie.fillna("").astype(str).str.strip().str.lower()
+
+
+def normalizar_codigo(serie: pd.Series) -> pd.Series:
+    """Normaliza códigos de equipo como texto sin espacios extremos (101 y '101' coinciden)."""
+    return serie.fillna("").astype(str).str.strip()
+
+
+def horas_numericas(serie: pd.Series) -> pd.Series:
+    """Convierte 'hora de uso' a float; valores inválidos o vacíos cuentan como 0."""
+    return pd.to_numeric(serie.astype(str).str.strip(), errors="coerce").fillna(0.0)
+
+
+def _tabla_consumibles(equipos: pd.DataFrame) -> pd.DataFrame:
+    """Una fila por (equipo, consumible) con su posición y vida útil."""
+    if equipos.empty or "consumibles" not in equipos.columns:
+        return pd.DataFrame(columns=["equipo_idx", "consumible", "posicion", "vida_util"])
+
+    consumibles = equipos["consumibles"].fillna("").astype(str).str.split(",").explode().str.strip()
+    consumibles = consumibles[consumibles != ""]
+    tabla = consumibles.rename("consumible").rename_axis("equipo_idx").reset_index()
+    tabla["posicion"] = tabla.groupby("equipo_idx").cumcount()
+
+    if "vida_util" in equipos.columns:
+        vidas = equipos["vida_util"].fillna("").astype(str).str.split(";").explode().str.strip()
+        vidas = vidas.rename("vida_util").rename_axis("equipo_idx").reset_index()
+        vidas["posicion"] = vidas.groupby("equipo_idx").cumcount()
+        # Igual que antes: solo enteros positivos escritos como dígitos son válidos
+        vidas["vida_util"] = vidas["vida_util"].where(vidas["vida_util"].str.isdigit())
+        tabla = tabla.merge(vidas, on=["equipo_idx", "posicion"], how="left")
+    else:
+        tabla["vida_util"] = None
+
+    tabla["vida_util"] = pd.to_numeric(tabla["vida_util"], errors="coerce").fillna(VIDA_UTIL_DEFECTO).astype(int)
+    return tabla
+
+
+def _estado_vacio() -> dict:
+    """Estado de desgaste sin ninguna fila de 'Hoja 1' aplicada."""
+    return {
+        "version": VERSION_CHECKPOINT,
+        "filas": 0,
+        "huella": "",
+        "totales": pd.DataFrame(columns=["empresa_key", "codigo_key", "horas_total"]),
+        "reinicios": pd.DataFrame(columns=["empresa_key", "codigo_key", "consumible", "horas_al_cambio"]),
+    }
+
+
+def _preparar_registro(registro: pd.DataFrame) -> pd.DataFrame:
+    """Extrae de 'Hoja 1' solo las columnas que afectan el desgaste, ya normalizadas."""
+    # Reutiliza las columnas derivadas de la capa de datos si ya existen
+    if "empresa_key" in registro.columns:
+        empresa_key = registro["empresa_key"]
+    else:
+        empresa_key = normalizar_clave(registro["empresa"])
+    codigo_key = registro["codigo_key"] if "codigo_key" in registro.columns else normalizar_codigo(registro["codigo"])
+    if "horas_uso" in registro.columns:
+        horas = registro["horas_uso"]
+    elif "hora de uso" in registro.columns:
+        horas = horas_numericas(registro["hora de uso"])
+    else:
+        horas = pd.Series(0.0, index=registro.index)
+    return pd.DataFrame({
+        "empresa_key": empresa_key.to_numpy(),
+        "codigo_key": codigo_key.to_numpy(),
+        "horas": horas.to_numpy(),
+        "parte cambiada": (registro["parte cambiada"].fillna("").astype(str) if "parte cambiada" in registro.columns
+                           else pd.Series("", index=registro.index)).to_numpy(),
+    })
+
+
+def aplicar_filas(estado: dict, registro: pd.DataFrame) -> dict:
+    """
+    Aplica filas de 'Hoja 1' (en orden) sobre un estado de desgaste.
+
+    El estado guarda, por equipo, las horas totales registradas y, por
+    consumible, las horas acumuladas en la fila de su último cambio. Las horas
+    usadas de un consumible son la diferencia entre ambas.
+
+    Args:
+        estado: Estado previo (ver _estado_vacio)
+        registro: Filas nuevas de 'Hoja 1' con columnas en minúsculas
+
+    Returns:
+        Nuevo estado; el recibido no se modifica
+    """
+    if registro.empty or not {"empresa", "codigo"}.issubset(registro.columns):
+        return {**estado, "filas": estado["filas"] + len(registro)}
+
+    reg = _preparar_registro(registro)
+    base = reg[["empresa_key", "codigo_key"]].merge(estado["totales"], on=["empresa_key", "codigo_key"], how="left")
+    reg["acumulado"] = (
+        pd.to_numeric(base["horas_total"], errors="coerce").fillna(0.0).to_numpy()
+        + reg.groupby(["empresa_key", "codigo_key"], sort=False)["horas"].cumsum().to_numpy()
+    )
+
+    totales = (
+        pd.concat([estado["totales"], reg[["empresa_key", "codigo_key"]].assign(horas_total=reg["horas"])])
+        .groupby(["empresa_key", "codigo_key"], sort=False)["horas_total"].sum()
+        .reset_index()
+    )
+
+    # Las horas de la fila en la que se cambió la parte no cuentan: el contador
+    # vuelve a cero y solo suman las filas posteriores.
+    cambios = reg[["empresa_key", "codigo_key", "acumulado"]].join(
+        reg["parte cambiada"].str.split(";").explode().rename("consumible")
+    )
+    cambios = cambios[cambios["consumible"] != ""].rename(columns={"acumulado": "horas_al_cambio"})
+    reinicios = pd.concat([estado["reinicios"], cambios[["empresa_key", "codigo_key", "consumible", "horas_al_cambio"]]])
+    reinicios = reinicios.drop_duplicates(subset=["empresa_key", "codigo_key", "consumible"], keep="last")
+
+    return {
+        **estado,
+        "filas": estado["filas"] + len(registro),
+        "totales": totales,
+        "reinicios": reinicios.reset_index(drop=True),
+    }
+
+
+def huella_registro(registro: pd.DataFrame, filas: int) -> str:
+    """
+    Hash de las primeras `filas` filas de 'Hoja 1' para detectar ediciones.
+
+    Se calcula sobre los valores ya normalizados, así que una fila optimista
+    ('101', '7') y la misma fila releída de Sheets (101, 7) dan la misma huella.
+    """
+    prefijo = registro.iloc[:filas]
+    if {"empresa", "codigo"}.issubset(prefijo.columns):
+        prefijo = _preparar_registro(prefijo)
+    else:
+        prefijo = prefijo[[c for c in COLUMNAS_REGISTRO if c in prefijo.columns]]
+    digest = hashlib.sha1(",".join(prefijo.columns).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(prefijo, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _leer_checkpoint(ruta: str):
+    """Lee el checkpoint de disco; devuelve None si no existe o no es compatible."""
+    try:
+        with open(ruta, "rb") as f:
+            estado = pickle.load(f)
+        if estado.get("version") != VERSION_CHECKPOINT:
+            return None
+        return estado
+    except Exception:
+        return None
+
+
+def _guardar_checkpoint(ruta: str, estado: dict):
+    """Guarda el checkpoint de forma atómica (archivo temporal + reemplazo)."""
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        tmp = f"{ruta}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(estado, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, ruta)
+    except Exception as e:
+        print(f"No se pudo guardar el checkpoint de desgaste: {e}")
+
+
+def actualizar_estado(registro: pd.DataFrame, ruta: str = RUTA_CHECKPOINT) -> dict:
+    """
+    Devuelve el estado de desgaste de todo 'Hoja 1' aplicando solo las filas nuevas.
+
+    'Hoja 1' solo crece agregando filas al final, así que se parte del último
+    checkpoint (memoria o disco) y se aplican las filas posteriores a él. Si las
+    filas ya procesadas cambiaron (edición o borrado), se reconstruye desde cero.
+
+    Args:
+        registro: DataFrame completo de 'Hoja 1' con columnas en minúsculas
+        ruta: Archivo donde se persiste el checkpoint
+
+    Returns:
+        Estado de desgaste con todas las filas de `registro` aplicadas
+    """
+    with _lock_checkpoint:
+        estado = _estados_en_memoria.get(ruta) or _leer_checkpoint(ruta)
+
+        if (
+            estado is None
+            or estado["filas"] > len(registro)
+            or estado["huella"] != huella_registro(registro, estado["filas"])
+        ):
+            estado = _estado_vacio()
+
+        if estado["filas"] == len(registro) and estado["huella"]:
+            _estados_en_memoria[ruta] = estado
+            return estado
+
+        estado = aplicar_filas(estado, registro.iloc[estado["filas"]:])
+        estado["huella"] = huella_registro(registro, estado["filas"])
+        _estados_en_memoria[ruta] = estado
+        _guardar_checkpoint(ruta, estado)
+        return estado
+
+
+def calcular_desgaste(equipos: pd.DataFrame, registro: pd.DataFrame = None, estado: dict = None) -> pd.DataFrame:
+    """
+    Calcula el estado de desgaste de todos los consumibles de todos los equipos.
+
+    Args:
+        equipos: DataFrame de la hoja 'Equipos' con columnas en minúsculas
+        registro: DataFrame de la hoja 'Hoja 1' con columnas en minúsculas
+        estado: Estado ya calculado (ver actualizar_estado); si se pasa, no se
+            recorre `registro`
+
+    Returns:
+        DataFrame con una fila por (equipo, consumible) y columnas COLUMNAS_DESGASTE.
+        'equipo_idx' es el índice de la fila en `equipos`.
+    """
+    tabla = _tabla_consumibles(equipos)
+    if tabla.empty:
+        return pd.DataFrame(columns=COLUMNAS_DESGASTE)
+
+    info = pd.DataFrame({
+        "empresa": equipos["empresa"] if "empresa" in equipos.columns else "",
+        "codigo": equipos["codigo"].astype(object) if "codigo" in equipos.columns else "",
+        "descripcion": equipos["descripcion"] if "descripcion" in equipos.columns else "",
+    }, index=equipos.index)
+    info["empresa_key"] = normalizar_clave(info["empresa"])
+    info["codigo_key"] = normalizar_codigo(info["codigo"])
+    tabla = tabla.merge(info.rename_axis("equipo_idx").reset_index(), on="equipo_idx", how="left")
+
+    if estado is None:
+        estado = aplicar_filas(_estado_vacio(), registro if registro is not None else pd.DataFrame())
+    # Cruce por el código normalizado: la fila optimista guarda '101' y 'Equipos' 101
+    tabla = tabla.merge(estado["totales"], on=["empresa_key", "codigo_key"], how="left")
+    tabla = tabla.merge(estado["reinicios"], on=["empresa_key", "codigo_key", "consumible"], how="left")
+
+    horas_total = pd.to_numeric(tabla["horas_total"], errors="coerce").fillna(0.0)
+    horas_al_cambio = pd.to_numeric(tabla["horas_al_cambio"], errors="coerce").fillna(0.0)
+    tabla["horas_usadas"] = horas_total - horas_al_cambio
+    tabla["horas_restantes"] = tabla["vida_util"] - tabla["horas_usadas"]
+    return tabla[COLUMNAS_DESGASTE]
+
+
+def nivel_alerta(desgaste: pd.DataFrame, por: str, umbral_critico: float, umbral_advertencia: float) -> pd.Series:
+    """
+    Resume el peor estado de los consumibles agrupando por una columna.
+
+    Args:
+        desgaste: Tabla devuelta por calcular_desgaste
+        por: Columna de agrupación ('empresa_key', 'equipo_idx', ...)
+        umbral_critico: Horas restantes a partir de las cuales la alerta es 🔴
+        umbral_advertencia: Horas restantes a partir de las cuales la alerta es 🟡
+
+    Returns:
+        Serie indexada por `por` con ' 🔴', ' 🟡' o '' (sufijo para las etiquetas)
+    """
+    if desgaste.empty:
+        return pd.Series(dtype=object)
+    restantes = desgaste["horas_restantes"].clip(lower=0)
+    critico = (restantes <= umbral_critico).groupby(desgaste[por]).any()
+    advertencia = (restantes <= umbral_advertencia).groupby(desgaste[por]).any()
+    alerta = pd.Series("", index=critico.index, dtype=object)
+    alerta[advertencia] = " 🟡"
+    alerta[critico] = " 🔴"
+    return alerta
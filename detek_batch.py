@@ -0,0 +1,619 @@
+"""
+Registro Automático Diario
+==========================
+Cada día, después de las 14:00 (hora de Bogotá), todos los equipos sin
+registro en 'Hoja 1' para la fecha reciben una fila con las 7 horas de la
+jornada.
+
+Las filas se calculan por conjuntos sobre los DataFrames canónicos: un
+anti-join de los equipos contra los registros del día, sin recorrer empresas ni
+equipos uno por uno.
+
+Cada fecha se escribe una sola vez aunque compitan sesiones, procesos o
+réplicas: un candado por fecha en la hoja 'Control' (CandadoHoja, o
+CandadoArchivo en una sola máquina) decide quién ejecuta y deja el marcador de
+completado.
+
+El proceso no depende de Streamlit y se programa con cron o un timer de systemd;
+la app solo muestra su estado:
+
+    python -m detek_batch run                   # fecha de hoy (Bogotá)
+    python -m detek_batch run --date 2024-05-31
+    python -m detek_batch run --candado archivo # sin hoja 'Control'
+    python -m detek_batch estado --date 2024-05-31   # según la hoja 'Control'
+    python -m detek_batch benchmark             # 5.000 equipos y 1M de registros
+
+Credenciales de la cuenta de servicio (en este orden): --credenciales RUTA,
+DETEK_GOOGLE_CREDENTIALS_FILE, GOOGLE_APPLICATION_CREDENTIALS,
+DETEK_GOOGLE_CREDENTIALS (JSON) o GOOGLE_CREDENTIALS en .streamlit/secrets.toml.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+import gspread
+import numpy as np
+import pandas as pd
+import pytz
+from google.oauth2.service_account import Credentials
+
+from datos import construir_frames, registro_del_dia
+from sheets_api import cargar_libro, ejecutar_en_hoja
+
+SHEET_ID = "1288rxOwtZDI3A7kuLnR4AXaI-GKt6YizeZS_4ZvdTnQ"
+HOJA_REGISTRO = "Hoja 1"
+HOJAS_REGISTRO_DIARIO = [HOJA_REGISTRO, "Empresas", "Equipos"]
+HOJA_CONTROL = "Control"
+
+ZONA_HORARIA = "America/Bogota"
+HORAS_JORNADA = 7.0
+OBSERVACION_AUTOMATICA = "Sin Observaciones"
+
+SCOPE = [
+    "https://www.googleapis.com/auth/drive",
+    "https://www.googleapis.com/auth/spreadsheets"
+]
+
+DIRECTORIO_BASE = os.path.dirname(os.path.abspath(__file__))
+RUTA_ESTADO = os.path.join(DIRECTORIO_BASE, ".detek_cache", "registro_diario")
+RUTA_SECRETS = os.path.join(DIRECTORIO_BASE, ".streamlit", "secrets.toml")
+
+# Segundos tras los cuales un reclamo sin completar se considera abandonado
+TTL_RECLAMO = 15 * 60
+
+# Tiempo máximo (segundos) del cálculo de filas en `benchmark` (5.000 equipos, 1M de registros)
+OBJETIVO_BENCHMARK = 1.0
+
+_lock_proceso = threading.Lock()
+
+
+def _registrados_en(registro: pd.DataFrame, fecha: date) -> pd.DataFrame:
+    """Pares (empresa_key, codigo_key) con al menos un registro en la fecha."""
+    if registro.empty or not {"empresa_key", "codigo_key"}.issubset(registro.columns):
+        return pd.DataFrame(columns=["empresa_key", "codigo_key"])
+    if "fecha_dt" in registro.columns:
+        del_dia = registro["fecha_dt"].dt.normalize() == pd.Timestamp(fecha)
+    elif "fecha" in registro.columns:
+        del_dia = registro["fecha"].astype(str).str.strip() == fecha.isoformat()
+    else:
+        return pd.DataFrame(columns=["empresa_key", "codigo_key"])
+    return registro.loc[del_dia, ["empresa_key", "codigo_key"]].drop_duplicates()
+
+
+def filas_registro_diario(equipos: pd.DataFrame, registro: pd.DataFrame, empresas: pd.DataFrame, fecha: date) -> list:
+    """
+    Filas a agregar en 'Hoja 1' para los equipos sin registro en `fecha`.
+
+    Args:
+        equipos: DataFrame canónico de 'Equipos'
+        registro: DataFrame canónico de 'Hoja 1' (basta con las filas del día,
+            ver registro_del_dia)
+        empresas: DataFrame canónico de 'Empresas' (solo se registran sus empresas)
+        fecha: Día a registrar
+
+    Returns:
+        Lista de filas [empresa, fecha, codigo, descripcion, horas, parte cambiada,
+        observaciones], en el orden de 'Empresas' y luego de 'Equipos'
+    """
+    if equipos.empty or empresas.empty or "empresa" not in empresas.columns or "empresa_key" not in equipos.columns:
+        return []
+
+    # Nombre de cada empresa tal como aparece en 'Empresas' (una vez por clave)
+    nombres = empresas[["empresa_key", "empresa"]].drop_duplicates("empresa_key")
+    nombres = nombres.assign(orden_empresa=np.arange(len(nombres)))
+
+    candidatos = pd.DataFrame({
+        "empresa_key": equipos["empresa_key"],
+        "codigo_key": equipos["codigo_key"],
+        "codigo": equipos["codigo"],
+        "descripcion": equipos["descripcion"] if "descripcion" in equipos.columns else "",
+        "orden_equipo": np.arange(len(equipos)),
+    }).merge(nombres, on="empresa_key", how="inner")
+
+    # Anti-join: equipos sin ninguna fila del día
+    registrados = _registrados_en(registro, fecha)
+    ya_registrado = pd.MultiIndex.from_frame(candidatos[["empresa_key", "codigo_key"]]).isin(
+        pd.MultiIndex.from_frame(registrados)
+    ) if not registrados.empty else np.zeros(len(candidatos), dtype=bool)
+    pendientes = candidatos[~ya_registrado].sort_values(["orden_empresa", "orden_equipo"], kind="stable")
+
+    texto_fecha = fecha.isoformat()
+    return [
+        [empresa, texto_fecha, codigo, descripcion, HORAS_JORNADA, "", OBSERVACION_AUTOMATICA]
+        for empresa, codigo, descripcion in zip(pendientes["empresa"], pendientes["codigo"], pendientes["descripcion"])
+    ]
+
+
+def benchmark(equipos_total: int = 5000, registros_total: int = 1_000_000, empresas_total: int = 200) -> float:
+    """
+    Mide el camino de _registrar con datos sintéticos: los DataFrames de
+    'Equipos', 'Empresas' y las filas del día de 'Hoja 1' a partir de registros
+    como los que devuelve cargar_libro, y luego filas_registro_diario.
+
+    No incluye la red (la descarga con batchGet ni el append_rows).
+
+    Returns:
+        Segundos que tardó el cálculo completo
+
+    Raises:
+        AssertionError: Si supera OBJETIVO_BENCHMARK segundos
+    """
+    rng = np.random.default_rng(0)
+    fecha = date.today()
+    nombres_empresas = [f"Empresa {i}" for i in range(empresas_total)]
+    empresas = [{"empresa": nombre} for nombre in nombres_empresas]
+    equipos = [
+        {"empresa": nombres_empresas[codigo % empresas_total], "codigo": codigo, "descripcion": "Equipo"}
+        for codigo in range(equipos_total)
+    ]
+
+    elegidos = rng.integers(0, equipos_total, registros_total)
+    dias = (pd.Timestamp(fecha) - pd.to_timedelta(rng.integers(0, 365, registros_total), unit="D")).strftime("%Y-%m-%d")
+    registro = [
+        {
+            "empresa": nombres_empresas[codigo % empresas_total], "fecha": dia, "codigo": int(codigo),
+            "descripcion": "Equipo", "hora de uso": HORAS_JORNADA, "parte cambiada": "",
+            "observaciones": OBSERVACION_AUTOMATICA,
+        }
+        for codigo, dia in zip(elegidos, dias)
+    ]
+
+    inicio = time.perf_counter()
+    frames = construir_frames([], equipos, empresas, [], [])
+    del_dia = registro_del_dia(registro, fecha)
+    construidos = time.perf_counter()
+    filas = filas_registro_diario(frames["equipos"], del_dia, frames["empresas"], fecha)
+    fin = time.perf_counter()
+    print(
+        f"{equipos_total} equipos, {registros_total} registros: {len(filas)} filas en {fin - inicio:.3f} s "
+        f"(DataFrames {construidos - inicio:.3f} s + filas_registro_diario {fin - construidos:.3f} s; "
+        f"sin contar la descarga de Sheets ni el append_rows)"
+    )
+    assert fin - inicio < OBJETIVO_BENCHMARK, f"El cálculo tardó {fin - inicio:.3f} s (objetivo: < {OBJETIVO_BENCHMARK} s)"
+    return fin - inicio
+
+
+def hoy_bogota() -> date:
+    return datetime.now(pytz.timezone(ZONA_HORARIA)).date()
+
+
+def _leer_secrets() -> dict:
+    """Credenciales de .streamlit/secrets.toml (requiere Python 3.11+ o tomli)."""
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            return {}
+    try:
+        with open(RUTA_SECRETS, "rb") as f:
+            return tomllib.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def credenciales_servicio(ruta: str = None) -> dict:
+    """
+    Datos de la cuenta de servicio de Google sin pasar por st.secrets.
+
+    Args:
+        ruta: Archivo JSON de la cuenta de servicio (tiene prioridad)
+
+    Returns:
+        Diccionario de la cuenta de servicio con la clave privada normalizada
+    """
+    ruta = ruta or os.environ.get("DETEK_GOOGLE_CREDENTIALS_FILE") or os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
+    if ruta:
+        with open(ruta, "r", encoding="utf-8") as f:
+            info = json.load(f)
+    elif os.environ.get("DETEK_GOOGLE_CREDENTIALS"):
+        info = json.loads(os.environ["DETEK_GOOGLE_CREDENTIALS"])
+    else:
+        raw = _leer_secrets().get("GOOGLE_CREDENTIALS")
+        if raw is None:
+            raise RuntimeError("No se encontraron credenciales de Google (ver la ayuda de detek_batch)")
+        info = json.loads(raw) if isinstance(raw, str) else dict(raw)
+
+    if "private_key" in info:
+        info["private_key"] = info["private_key"].replace("\\n", "\n").replace("\\r", "\r")
+    return info
+
+
+def cliente_gspread(ruta_credenciales: str = None):
+    """Cliente gspread autorizado con credenciales de entorno o archivo."""
+    creds = Credentials.from_service_account_info(credenciales_servicio(ruta_credenciales), scopes=SCOPE)
+    return gspread.authorize(creds)
+
+
+def _ruta_estado(fecha: date) -> str:
+    return os.path.join(RUTA_ESTADO, f"{fecha.isoformat()}.json")
+
+
+def _guardar_estado(fecha: date, estado: dict):
+    os.makedirs(RUTA_ESTADO, exist_ok=True)
+    ruta = _ruta_estado(fecha)
+    tmp = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(estado, f, ensure_ascii=False)
+    os.replace(tmp, ruta)
+
+
+def estado_registro(fecha: date):
+    """
+    Estado del registro automático de una fecha.
+
+    Returns:
+        Diccionario con 'estado' ('completado' o 'error'), 'filas', 'empresas',
+        'terminado_en' y 'error', o None si aún no se ha ejecutado
+    """
+    try:
+        with open(_ruta_estado(fecha), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# --- CANDADO POR FECHA (una sola ejecución aunque compitan sesiones o réplicas) ---
+def _nuevo_token() -> str:
+    # Con prefijo para que la hoja no lo convierta en número
+    return f"r-{uuid.uuid4().hex}"
+
+
+def interpretar_control(eventos: list, ahora: float = None) -> dict:
+    """
+    Estado de una fecha a partir de sus eventos en la hoja de control, en orden.
+
+    Cada evento es (estado, token, marca, detalle) con estado 'reclamado',
+    'completado' o 'liberado'. Gana el primer reclamo; un reclamo sin completar
+    ni liberar caduca a los TTL_RECLAMO segundos y el siguiente puede tomarlo.
+
+    Returns:
+        {'estado': 'completado' | 'en_curso' | 'error' | None, 'token', 'marca', 'detalle'}
+    """
+    ahora = time.time() if ahora is None else ahora
+    activo = None
+    ultimo_error = None
+    for estado, token, marca, detalle in eventos:
+        try:
+            marca = float(str(marca).replace(",", ".") or 0)
+        except ValueError:
+            marca = 0.0
+        if estado == "completado":
+            return {"estado": "completado", "token": token, "marca": marca, "detalle": detalle}
+        if estado == "reclamado" and (activo is None or marca - activo[1] > TTL_RECLAMO):
+            activo = (token, marca)
+        elif estado == "liberado" and activo is not None and token == activo[0]:
+            activo = None
+            ultimo_error = {"estado": "error", "token": token, "marca": marca, "detalle": detalle}
+    if activo is not None and ahora - activo[1] <= TTL_RECLAMO:
+        return {"estado": "en_curso", "token": activo[0], "marca": activo[1], "detalle": ""}
+    return ultimo_error or {"estado": None, "token": None, "marca": 0.0, "detalle": ""}
+
+
+class CandadoHoja:
+    """
+    Candado entre réplicas sobre la hoja 'Control' del libro principal.
+
+    Cada intento agrega una fila (fecha, evento, token, marca, detalle). Como
+    Sheets aplica los append en orden, todas las réplicas ven la misma
+    secuencia y coinciden en quién reclamó primero.
+    """
+
+    def __init__(self, client, sheet_id: str = SHEET_ID, hoja: str = HOJA_CONTROL):
+        self.client = client
+        self.sheet_id = sheet_id
+        self.hoja = hoja
+
+    def _eventos(self, fecha: date) -> list:
+        filas = ejecutar_en_hoja(self.client, self.sheet_id, self.hoja, lambda ws: ws.get_all_values(), tipo="lectura")
+        return [
+            (fila + [""] * 5)[1:5]
+            for fila in filas[1:]
+            if fila and str(fila[0]).strip() == fecha.isoformat()
+        ]
+
+    def _agregar(self, fecha: date, evento: str, token: str, detalle: str = ""):
+        # Marca como texto entero: RAW la guarda igual sin importar la configuración regional
+        fila = [fecha.isoformat(), evento, token, str(int(time.time())), detalle]
+        ejecutar_en_hoja(self.client, self.sheet_id, self.hoja, lambda ws: ws.append_row(fila, value_input_option="RAW"))
+
+    def estado(self, fecha: date) -> dict:
+        return interpretar_control(self._eventos(fecha))
+
+    def adquirir(self, fecha: date, token: str) -> bool:
+        if self.estado(fecha)["estado"] in ("completado", "en_curso"):
+            return False
+        self._agregar(fecha, "reclamado", token)
+        resultado = self.estado(fecha)
+        return resultado["estado"] == "en_curso" and resultado["token"] == token
+
+    def completar(self, fecha: date, token: str, detalle: dict):
+        self._agregar(fecha, "completado", token, json.dumps(detalle))
+
+    def liberar(self, fecha: date, token: str, error: str = ""):
+        self._agregar(fecha, "liberado", token, error)
+
+
+class CandadoArchivo:
+    """
+    Candado equivalente con archivos locales (una sola máquina o pruebas).
+
+    Cada reclamo es un archivo de generación '<fecha>.lock.<n>' que se crea
+    con os.link desde un temporal ya escrito: el enlace falla si el archivo
+    existe, así que crear la generación n es atómico y solo un proceso lo
+    logra. Para tomar un reclamo caducado o liberado se crea la generación
+    siguiente a la observada; ninguna generación de la fecha se borra ni se
+    reemplaza (liberar deja '<fecha>.lock.<n>.liberado' con el error), así que
+    el número solo crece y un contendiente con una observación vieja choca con
+    una generación existente y pierde. Los reclamos se borran cuando la fecha
+    ya quedó atrás. El marcador de completado es '<fecha>.done'.
+    """
+
+    def __init__(self, directorio: str = RUTA_ESTADO):
+        self.directorio = directorio
+
+    def _ruta(self, fecha: date, extension: str) -> str:
+        return os.path.join(self.directorio, f"{fecha.isoformat()}.{extension}")
+
+    def _leer(self, ruta: str):
+        try:
+            with open(ruta, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _generaciones(self, fecha: date) -> list:
+        """Números de generación de los reclamos de la fecha, de menor a mayor."""
+        prefijo = f"{fecha.isoformat()}.lock."
+        try:
+            nombres = os.listdir(self.directorio)
+        except FileNotFoundError:
+            return []
+        return sorted(int(n[len(prefijo):]) for n in nombres if n.startswith(prefijo) and n[len(prefijo):].isdigit())
+
+    def _observar(self, fecha: date):
+        """
+        Una sola lectura del candado de la fecha.
+
+        Returns:
+            (generación más alta, estado) con estado como en CandadoHoja.estado
+        """
+        hecho = self._leer(self._ruta(fecha, "done"))
+        if hecho:
+            return 0, {"estado": "completado", "token": hecho["token"], "marca": hecho["marca"], "detalle": json.dumps(hecho["detalle"])}
+        generaciones = self._generaciones(fecha)
+        generacion = generaciones[-1] if generaciones else 0
+        reclamo = self._leer(self._ruta(fecha, f"lock.{generacion}")) if generacion else None
+        liberado = self._leer(self._ruta(fecha, f"lock.{generacion}.liberado")) if generacion else None
+        if liberado:
+            return generacion, {"estado": "error", "token": liberado["token"], "marca": liberado["marca"], "detalle": liberado.get("error", "")}
+        if reclamo and time.time() - reclamo["marca"] <= TTL_RECLAMO:
+            return generacion, {"estado": "en_curso", "token": reclamo["token"], "marca": reclamo["marca"], "detalle": ""}
+        return generacion, {"estado": None, "token": None, "marca": 0.0, "detalle": ""}
+
+    def estado(self, fecha: date) -> dict:
+        return self._observar(fecha)[1]
+
+    def adquirir(self, fecha: date, token: str) -> bool:
+        os.makedirs(self.directorio, exist_ok=True)
+        # La generación a crear sale de la misma observación que decidió que está libre
+        generacion, estado = self._observar(fecha)
+        if estado["estado"] in ("completado", "en_curso"):
+            return False
+        ruta = self._ruta(fecha, f"lock.{generacion + 1}")
+        tmp = f"{ruta}.{token}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"token": token, "marca": time.time()}, f)
+        try:
+            os.link(tmp, ruta)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+        self._limpiar_anteriores(fecha)
+        return True
+
+    def _limpiar_anteriores(self, fecha: date):
+        """Borra los reclamos de fechas anteriores a ayer (nadie compite ya por ellas)."""
+        limite = fecha - timedelta(days=1)
+        for nombre in os.listdir(self.directorio):
+            dia, separador, _ = nombre.partition(".lock.")
+            try:
+                anterior = separador and date.fromisoformat(dia) < limite
+            except ValueError:
+                anterior = False
+            if anterior:
+                try:
+                    os.remove(os.path.join(self.directorio, nombre))
+                except FileNotFoundError:
+                    pass
+
+    def completar(self, fecha: date, token: str, detalle: dict):
+        ruta = self._ruta(fecha, "done")
+        with open(f"{ruta}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"token": token, "marca": time.time(), "detalle": detalle}, f)
+        os.replace(f"{ruta}.tmp", ruta)
+        self.liberar(fecha, token)
+
+    def liberar(self, fecha: date, token: str, error: str = ""):
+        # El reclamo se conserva (mantiene la generación) y se marca liberado
+        for generacion in self._generaciones(fecha):
+            reclamo = self._leer(self._ruta(fecha, f"lock.{generacion}"))
+            if reclamo and reclamo["token"] == token:
+                with open(self._ruta(fecha, f"lock.{generacion}.liberado"), "w", encoding="utf-8") as f:
+                    json.dump({"token": token, "marca": time.time(), "error": error}, f)
+
+
+def estado_desde_control(registros: list, fecha: date) -> dict:
+    """
+    Estado del registro de una fecha según los registros ya descargados de 'Control'.
+
+    Returns:
+        Igual que estado_registro, o None si no hay eventos para la fecha
+    """
+    eventos = [
+        (str(r.get("estado", "")), str(r.get("token", "")), r.get("marca") or 0, str(r.get("detalle", "")))
+        for r in registros
+        if str(r.get("fecha", "")).strip() == fecha.isoformat()
+    ]
+    return _estado_publico(interpretar_control(eventos))
+
+
+def _estado_publico(control: dict):
+    """Convierte el estado del candado al formato de estado_registro."""
+    if control["estado"] is None:
+        return None
+    estado = {"estado": control["estado"], "filas": 0, "empresas": 0, "terminado_en": control["marca"], "error": ""}
+    if control["estado"] == "completado":
+        try:
+            estado.update(json.loads(control["detalle"] or "{}"))
+        except (TypeError, ValueError):
+            pass
+    elif control["estado"] == "error":
+        estado["error"] = control["detalle"]
+    return estado
+
+
+def _registrar(client, fecha: date, sheet_id: str, aplicar_pendientes) -> dict:
+    """Calcula y agrega las filas del día; devuelve el resumen."""
+    hojas, encabezados = cargar_libro(client, sheet_id, HOJAS_REGISTRO_DIARIO)
+    if aplicar_pendientes is not None:
+        hojas = aplicar_pendientes(hojas, encabezados)
+    # Solo hace falta el día en 'Hoja 1': no se construye el DataFrame completo
+    frames = construir_frames([], hojas.get("Equipos", []), hojas.get("Empresas", []), [], [])
+    del_dia = registro_del_dia(hojas.get(HOJA_REGISTRO, []), fecha)
+    filas = filas_registro_diario(frames["equipos"], del_dia, frames["empresas"], fecha)
+    if filas:
+        ejecutar_en_hoja(client, sheet_id, HOJA_REGISTRO, lambda ws: ws.append_rows(filas))
+    return {"filas": len(filas), "empresas": len({fila[0] for fila in filas})}
+
+
+def ejecutar_registro_diario(client, fecha: date, sheet_id: str = SHEET_ID, aplicar_pendientes=None, candado=None) -> dict:
+    """
+    Registra el día una sola vez: toma el candado de la fecha, lee 'Hoja 1',
+    'Empresas' y 'Equipos', agrega en un solo append_rows las filas de los
+    equipos sin registro en `fecha` y deja el marcador de completado.
+
+    Si otra sesión, proceso o réplica ya completó la fecha o la está
+    ejecutando, no se escribe nada.
+
+    Args:
+        client: Cliente gspread autorizado
+        fecha: Día a registrar
+        sheet_id: Libro principal
+        aplicar_pendientes: Función opcional (hojas, encabezados) -> hojas que
+            agrega escrituras aún no enviadas (la app pasa su cola)
+        candado: CandadoHoja (por defecto) o CandadoArchivo
+
+    Returns:
+        Estado guardado (ver estado_registro); 'estado' puede ser además
+        'en_curso' si otra réplica tiene el candado
+    """
+    candado = candado if candado is not None else CandadoHoja(client, sheet_id)
+    token = _nuevo_token()
+    # Dentro del proceso las sesiones esperan su turno; entre procesos decide el candado
+    with _lock_proceso:
+        try:
+            if not candado.adquirir(fecha, token):
+                estado = _estado_publico(candado.estado(fecha)) or {
+                    "estado": "en_curso", "filas": 0, "empresas": 0, "terminado_en": time.time(), "error": "",
+                }
+                if estado["estado"] == "error":
+                    # El último intento falló y liberó el candado entre medias: se reintenta después
+                    estado["estado"] = "en_curso"
+            else:
+                try:
+                    resumen = _registrar(client, fecha, sheet_id, aplicar_pendientes)
+                except Exception as e:
+                    candado.liberar(fecha, token, str(e))
+                    raise
+                candado.completar(fecha, token, resumen)
+                estado = {"estado": "completado", **resumen, "terminado_en": time.time(), "error": ""}
+        except Exception as e:
+            estado = {"estado": "error", "filas": 0, "empresas": 0, "terminado_en": time.time(), "error": str(e)}
+    if estado["estado"] != "en_curso":
+        _guardar_estado(fecha, estado)
+    return estado
+
+
+def estado_compartido(fecha: date, candado: str = "hoja", ruta_credenciales: str = None, sheet_id: str = SHEET_ID):
+    """
+    Estado de la fecha según el candado compartido (lo ejecute la réplica que sea).
+
+    Lee la hoja 'Control' (o los archivos de CandadoArchivo); si no se puede
+    leer o no tiene eventos de la fecha, usa el estado local de estado_registro.
+    """
+    try:
+        if candado == "archivo":
+            control = CandadoArchivo().estado(fecha)
+        else:
+            control = CandadoHoja(cliente_gspread(ruta_credenciales), sheet_id).estado(fecha)
+    except Exception as e:
+        print(f"No se pudo leer el candado compartido, se usa el estado local: {e}", file=sys.stderr)
+        return estado_registro(fecha)
+    return _estado_publico(control) or estado_registro(fecha)
+
+
+def _fecha(texto: str) -> date:
+    try:
+        return date.fromisoformat(texto)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Fecha inválida '{texto}' (formato AAAA-MM-DD)")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m detek_batch", description="Registro automático diario de horas de uso")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    run = comandos.add_parser("run", help="Registra 7 h a los equipos sin registro en la fecha")
+    run.add_argument("--date", type=_fecha, default=None, help="Fecha AAAA-MM-DD (por defecto, hoy en Bogotá)")
+    run.add_argument("--credenciales", default=None, help="Archivo JSON de la cuenta de servicio")
+    run.add_argument("--sheet-id", default=SHEET_ID, help="ID del libro principal")
+    run.add_argument("--candado", choices=["hoja", "archivo"], default="hoja",
+                     help="Candado por fecha: hoja 'Control' (entre réplicas) o archivo local")
+
+    estado = comandos.add_parser("estado", help="Muestra el estado del registro de una fecha")
+    estado.add_argument("--date", type=_fecha, default=None, help="Fecha AAAA-MM-DD (por defecto, hoy en Bogotá)")
+    estado.add_argument("--credenciales", default=None, help="Archivo JSON de la cuenta de servicio")
+    estado.add_argument("--sheet-id", default=SHEET_ID, help="ID del libro principal")
+    estado.add_argument("--candado", choices=["hoja", "archivo"], default="hoja",
+                        help="Dónde leer el estado compartido: hoja 'Control' o archivos locales")
+
+    comandos.add_parser("benchmark", help="Mide el cálculo de filas (sin red) con datos sintéticos")
+
+    args = parser.parse_args(argv)
+    if args.comando == "benchmark":
+        benchmark()
+        return 0
+
+    fecha = args.date or hoy_bogota()
+    if args.comando == "estado":
+        print(json.dumps(estado_compartido(fecha, args.candado, args.credenciales, args.sheet_id), ensure_ascii=False))
+        return 0
+
+    try:
+        client = cliente_gspread(args.credenciales)
+    except Exception as e:
+        print(f"No se pudo autenticar con Google: {e}", file=sys.stderr)
+        return 2
+    candado = CandadoArchivo() if args.candado == "archivo" else CandadoHoja(client, args.sheet_id)
+    resultado = ejecutar_registro_diario(client, fecha, sheet_id=args.sheet_id, candado=candado)
+    if resultado["estado"] == "en_curso":
+        print(f"El registro automático del {fecha} lo está ejecutando otro proceso")
+        return 0
+    if resultado["estado"] != "completado":
+        print(f"Error en el registro automático del {fecha}: {resultado['error']}", file=sys.stderr)
+        return 1
+    print(f"Registro automático del {fecha}: {resultado['filas']} equipos de {resultado['empresas']} empresas")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
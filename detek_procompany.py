@@ -11,14 +11,46 @@ from googleapiclient.http import MediaIoBaseUpload
 # Firebase para chat en tiempo real
 from firebase_chat import (
     inicializar_firebase,
-    enviar_mensaje as firebase_enviar_mensaje,
-    obtener_mensajes as firebase_obtener_mensajes,
+    encolar_mensaje,
+    envios_chat,
+    reintentar_envio,
+    mensajes_chat,
+    obtener_pagina_mensajes,
+    cursor_mensaje,
     obtener_ultimo_mensaje,
     contar_mensajes_no_leidos,
+    contar_no_leidos_por_empresa,
+    marcar_mensajes_leidos,
     firebase_disponible,
     obtener_ultimo_error_firebase,
-    normalizar_nombre_empresa
+    normalizar_nombre_empresa,
+    INTERVALO_SONDEO
 )
+from dashboard import TOP_HORAS, construir_resumen, top_horas
+from datos import (
+    actas_de,
+    agregar_desgaste,
+    aplicar_cambios,
+    construir_frames,
+    desgaste_de,
+    empresa_info,
+    equipos_de,
+    registros_de,
+    tareas_de
+)
+from detek_batch import HOJA_CONTROL, SHEET_ID, ejecutar_registro_diario, estado_desde_control, estado_registro, hoy_bogota
+from desgaste import actualizar_estado, aplicar_filas, calcular_desgaste, nivel_alerta
+from enlaces_drive import url_miniatura
+from sheets_api import (
+    cargar_libros,
+    estadisticas_api,
+    modificar_snapshot,
+    obtener_snapshot,
+    refrescar_snapshot,
+    refresco_en_curso
+)
+import cola_escrituras
+import imagenes_drive
 
 # Configuración de la página
 st.set_page_config(
@@ -92,43 +124,6 @@ if 'ultimo_error_sheet' not in st.session_state:
     st.session_state['ultimo_error_sheet'] = ''
 
 
-# --- CACHÉ EN MEMORIA PARA GOOGLE SHEETS (TTL extendido) ---
-@st.cache_data(show_spinner=False, ttl=30, max_entries=50)
-def cached_get_all_records(sheet_key, worksheet_name):
-    try:
-        client = get_gspread_client()
-        ws = client.open_by_key(sheet_key).worksheet(worksheet_name)
-        # Solución robusta: buscar la fila de encabezados correcta en 'Equipos'
-        if worksheet_name.lower() == "equipos":
-            # Buscar la primera fila que contenga 'Empresa' (ignorando mayúsculas/minúsculas)
-            for i in range(1, 11):  # Busca en las primeras 10 filas
-                fila = ws.row_values(i)
-                if any(str(cell).strip().lower() == "empresa" for cell in fila):
-                    header_row = i
-                    headers = [h if h else f"col_{idx+1}" for idx, h in enumerate(fila)]
-                    break
-            else:
-                # Si no encuentra, usa la primera fila
-                header_row = 1
-                headers = ws.row_values(1)
-                headers = [h if h else f"col_{idx+1}" for idx, h in enumerate(headers)]
-            # Elimina duplicados en headers solo si hay vacíos
-            seen = set()
-            new_headers = []
-            for idx, h in enumerate(headers):
-                h_clean = h if h else f"col_{idx+1}"
-                while h_clean in seen or h_clean == '':
-                    h_clean += f"_{idx+1}"
-                seen.add(h_clean)
-                new_headers.append(h_clean)
-            return ws.get_all_records(expected_headers=new_headers, head=header_row)
-        else:
-            return ws.get_all_records()
-    except Exception as e:
-        st.session_state['modo_offline'] = True
-        st.session_state['ultimo_error_sheet'] = str(e)
-        raise
-
 # --- CACHÉ PARA CLIENTE GSPREAD ---
 def get_google_credentials_info():
     raw_credentials = st.secrets["GOOGLE_CREDENTIALS"]
@@ -159,104 +154,104 @@ def get_gspread_client():
     creds = Credentials.from_service_account_info(service_account_info, scopes=SCOPE)
     return gspread.authorize(creds)
 
+# --- CONFIGURACIÓN GOOGLE SHEETS Y DRIVE ---
+
+client = get_gspread_client()
+imagenes_drive.iniciar(client)
+
 # --- LOGO INICIO ---
-import re
-def get_drive_thumbnail_url(url):
-    """Convierte un enlace de Google Drive a un enlace de thumbnail visualizable."""
-    if not isinstance(url, str):
-        return url
-    patterns = [
-        r"/file/d/([\w-]+)",
-        r"id=([\w-]+)",
-        r"https://drive.google.com/open\?id=([\w-]+)",
-        r"https://drive.google.com/uc\?id=([\w-]+)"
-    ]
-    for pat in patterns:
-        match = re.search(pat, url)
-        if match:
-            file_id = match.group(1)
-            return f"https://drive.google.com/thumbnail?id={file_id}"
-    return url
-
-logo_url = get_drive_thumbnail_url("https://drive.google.com/uc?export=view&id=1TNWW3yHkS9EGFIL3XbETPCcIDBkbQXTH")
-st.markdown(f"""
-    <div style='display: flex; justify-content: center; align-items: center; margin-bottom: 1em;'>
-        <img src='{logo_url}' width='180' style='display: block;'/>
-    </div>
-""", unsafe_allow_html=True)
-def get_or_create_sheet_tareas(client, SHEET_ID):
-    try:
-        sheet_tareas = client.open_by_key(SHEET_ID).worksheet("Tareas")
-    except:
-        sheet_tareas = client.open_by_key(SHEET_ID).add_worksheet(title="Tareas", rows="1000", cols="6")
-        sheet_tareas.append_row(["empresa", "tarea", "asignada_por", "fecha_asignacion", "completada", "fecha_completada"])
-    return sheet_tareas
+LOGO_DRIVE_URL = "https://drive.google.com/uc?export=view&id=1TNWW3yHkS9EGFIL3XbETPCcIDBkbQXTH"
+# Sin bloquear: mientras la caché no lo tenga (se descarga en segundo plano) se usa el enlace
+logo_local = imagenes_drive.imagen_drive(LOGO_DRIVE_URL, ancho=240)
+if logo_local:
+    _, col_logo, _ = st.columns([1, 1, 1])
+    with col_logo:
+        st.image(logo_local, width=180)
+else:
+    logo_url = url_miniatura(LOGO_DRIVE_URL)
+    st.markdown(f"""
+        <div style='display: flex; justify-content: center; align-items: center; margin-bottom: 1em;'>
+            <img src='{logo_url}' width='180' style='display: block;'/>
+        </div>
+    """, unsafe_allow_html=True)
 
 
+SHEET_ACTAS_ID = "1Vc7XnxhXfuus7WdGOvBjG08cLpW8awO0E7P4b3aLc4A"
 
 
-# --- CONFIGURACIÓN GOOGLE SHEETS Y DRIVE ---
+HOJA_ACTAS = "actas de entregas diligenciadas"
+HOJAS_PRINCIPALES = ["Hoja 1", "Empresas", "Chat", "Tareas", "Equipos", HOJA_CONTROL]
+
+
+CLAVE_SNAPSHOT_SHEETS = "sheets"
+EDAD_MAXIMA_SHEETS = 30  # segundos antes de refrescar en segundo plano
+
+
+# --- DESCARGA DE GOOGLE SHEETS (una petición por libro, libros en paralelo) ---
+def descargar_hojas():
+    datos, encabezados, errores = cargar_libros(client, {
+        SHEET_ID: HOJAS_PRINCIPALES,
+        SHEET_ACTAS_ID: [HOJA_ACTAS],
+    })
+    if SHEET_ID in errores:
+        raise errores[SHEET_ID]
+    return {
+        # Las escrituras aún encoladas no están en la hoja: se superponen a lo descargado
+        "hojas": cola_escrituras.aplicar_operaciones(datos[SHEET_ID], encabezados[SHEET_ID], cola_escrituras.pendientes(SHEET_ID)),
+        # Fila de encabezado detectada y encabezados sin duplicados, versionados con los datos
+        "encabezados": encabezados[SHEET_ID],
+        "actas": datos.get(SHEET_ACTAS_ID, {}).get(HOJA_ACTAS, []),
+        "error_actas": str(errores[SHEET_ACTAS_ID]) if SHEET_ACTAS_ID in errores else "",
+    }
 
-client = get_gspread_client()
-SHEET_ID = "1288rxOwtZDI3A7kuLnR4AXaI-GKt6YizeZS_4ZvdTnQ"
-SHEET_ACTAS_ID = "1Vc7XnxhXfuus7WdGOvBjG08cLpW8awO0E7P4b3aLc4A"
 
+# --- ESCRITURAS EN SEGUNDO PLANO (cola persistida en disco, lotes por hoja) ---
+cola_escrituras.iniciar(client)
 
-# --- INTENTAR CARGAR DATOS DE SHEETS, SI FALLA USAR CACHE Y MODO OFFLINE ---
+
+def escribir_en_segundo_plano(operaciones):
+    """Encola escrituras y las refleja de inmediato en la copia en memoria de los datos."""
+    cola_escrituras.encolar(operaciones)
+    modificar_snapshot(CLAVE_SNAPSHOT_SHEETS, lambda datos: {
+        **datos,
+        "hojas": cola_escrituras.aplicar_operaciones(datos["hojas"], datos["encabezados"], operaciones),
+    }, cambios=operaciones)
+
+
+# --- CARGAR DATOS DE SHEETS: SIEMPRE LA ÚLTIMA COPIA BUENA, REFRESCO EN SEGUNDO PLANO ---
 def cargar_datos_sheet():
     try:
-        sheet_registro_data = cached_get_all_records(SHEET_ID, "Hoja 1")
-        sheet_empresas_data = cached_get_all_records(SHEET_ID, "Empresas")
-        try:
-            sheet_chat_data = cached_get_all_records(SHEET_ID, "Chat")
-        except:
-            ws = client.open_by_key(SHEET_ID).add_worksheet(title="Chat", rows="1000", cols="4")
-            ws.append_row(["fecha", "usuario", "mensaje", "empresa"])
-            sheet_chat_data = []
-        try:
-            sheet_tareas_data = cached_get_all_records(SHEET_ID, "Tareas")
-        except:
-            ws = client.open_by_key(SHEET_ID).add_worksheet(title="Tareas", rows="1000", cols="6")
-            ws.append_row(["empresa", "tarea", "asignada_por", "fecha_asignacion", "completada", "fecha_completada"])
-            sheet_tareas_data = []
-        # Cargar datos de actas de entrega
-        try:
-            sheet_actas_data = cached_get_all_records(SHEET_ACTAS_ID, "actas de entregas diligenciadas")
-        except Exception as e:
-            sheet_actas_data = []
-            st.session_state['error_actas'] = str(e)
-        st.session_state['modo_offline'] = False
-        st.session_state['ultimo_error_sheet'] = ''
-        return sheet_registro_data, sheet_empresas_data, sheet_chat_data, sheet_tareas_data, sheet_actas_data
+        snapshot = obtener_snapshot(CLAVE_SNAPSHOT_SHEETS, descargar_hojas, max_edad=EDAD_MAXIMA_SHEETS)
     except Exception as e:
+        # Sin ninguna copia previa: modo offline con datos vacíos
         st.session_state['modo_offline'] = True
         st.session_state['ultimo_error_sheet'] = str(e)
-        # Intentar usar datos cacheados si existen
-        sheet_registro_data = st.cache_data.get_cached_value(cached_get_all_records, (SHEET_ID, "Hoja 1")) or []
-        sheet_empresas_data = st.cache_data.get_cached_value(cached_get_all_records, (SHEET_ID, "Empresas")) or []
-        sheet_chat_data = st.cache_data.get_cached_value(cached_get_all_records, (SHEET_ID, "Chat")) or []
-        sheet_tareas_data = st.cache_data.get_cached_value(cached_get_all_records, (SHEET_ID, "Tareas")) or []
-        sheet_actas_data = st.cache_data.get_cached_value(cached_get_all_records, (SHEET_ACTAS_ID, "actas de entregas diligenciadas")) or []
         st.session_state['error_actas'] = str(e)
-        return sheet_registro_data, sheet_empresas_data, sheet_chat_data, sheet_tareas_data, sheet_actas_data
-
-sheet_registro_data, sheet_empresas_data, sheet_chat_data, sheet_tareas_data, sheet_actas_data = cargar_datos_sheet()
-sheet_tareas = get_or_create_sheet_tareas(client, SHEET_ID)
-try:
-    sheet_chat = client.open_by_key(SHEET_ID).worksheet("Chat")
-except gspread.exceptions.APIError as e:
-    st.error(f"Error de API al conectar con la hoja 'Chat': {e}. La funcionalidad del chat puede estar limitada.")
-    sheet_chat = None # Continuar sin el objeto sheet_chat
-except Exception as e:
-    st.error(f"No se pudo abrir la hoja 'Chat': {e}. La funcionalidad del chat puede estar limitada.")
-    sheet_chat = None # Continuar sin el objeto sheet_chat
-
-sheet_registro = client.open_by_key(SHEET_ID).worksheet("Hoja 1")
+        return None, {"hojas": {}, "encabezados": {}, "actas": [], "error_actas": str(e)}
+    # Si el último refresco falló se siguen mostrando los datos anteriores
+    st.session_state['modo_offline'] = bool(snapshot["error"])
+    st.session_state['ultimo_error_sheet'] = snapshot["error"]
+    if snapshot["datos"]["error_actas"]:
+        st.session_state['error_actas'] = snapshot["datos"]["error_actas"]
+    return snapshot, snapshot["datos"]
+
+snapshot_sheets, datos_sheets = cargar_datos_sheet()
+hojas_sheets = datos_sheets["hojas"]
+sheet_registro_data = hojas_sheets.get("Hoja 1", [])
+sheet_empresas_data = hojas_sheets.get("Empresas", [])
+sheet_chat_data = hojas_sheets.get("Chat", [])
+sheet_tareas_data = hojas_sheets.get("Tareas", [])
+sheet_equipos_data = hojas_sheets.get("Equipos", [])
+sheet_actas_data = datos_sheets["actas"]
 # --- AVISO DE MODO OFFLINE Y BOTÓN DE REINTENTO ---
 if st.session_state.get('modo_offline', False):
     st.warning(f"No se pudo conectar con Google Sheets. Estás en modo offline temporal.\n\nError: {st.session_state.get('ultimo_error_sheet','')}")
     if st.button("Reintentar conexión con Google Sheets"):
         st.session_state['modo_offline'] = False
+        try:
+            refrescar_snapshot(CLAVE_SNAPSHOT_SHEETS, descargar_hojas)
+        except Exception as e:
+            st.session_state['ultimo_error_sheet'] = str(e)
         st.rerun()
 
 # --- AVISO DE ERROR EN HOJA DE ACTAS ---
@@ -285,55 +280,104 @@ if st.session_state.get('error_actas'):
             del st.session_state['error_actas']
         st.rerun()
 
-# --- VIDA ÚTIL POR DEFECTO ---
-VIDA_UTIL_DEFECTO = 700
+# --- DATAFRAMES CANÓNICOS (una vez por versión de datos, compartidos entre sesiones) ---
+# Tabla de los frames canónicos que corresponde a cada hoja con escrituras optimistas
+TABLAS_HOJAS = {"Hoja 1": "registro", "Equipos": "equipos", "Empresas": "empresas", "Tareas": "tareas"}
 
-# --- NUEVO MODELO: UNA SOLA HOJA 'Equipos' ---
-sheet_equipos_data = cached_get_all_records(SHEET_ID, "Equipos")
-equipos_df = pd.DataFrame(sheet_equipos_data)
-equipos_df.columns = [col.lower().strip() for col in equipos_df.columns]
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def obtener_frames_base(base, _datos):
+    """DataFrames de solo lectura para una descarga de Sheets, con el desgaste ya calculado."""
+    hojas = _datos["hojas"]
+    frames = construir_frames(
+        hojas.get("Hoja 1", []), hojas.get("Equipos", []), hojas.get("Empresas", []), hojas.get("Tareas", []), _datos["actas"]
+    )
+    # Desgaste de consumibles: checkpoint incremental sobre 'Hoja 1' para todas las vistas
+    estado = actualizar_estado(frames["registro"])
+    frames["estado_desgaste"] = estado
+    return agregar_desgaste(frames, calcular_desgaste(frames["equipos"], estado=estado))
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def obtener_frames(version, base, _datos_base, _datos, _cambios):
+    """
+    DataFrames de una versión: los de la descarga `base` más las escrituras
+    encoladas desde entonces, aplicadas sin reconstruir las tablas intactas.
+    """
+    base_frames = obtener_frames_base(base, _datos_base)
+    if not _cambios:
+        return base_frames
+    agregadas, reemplazadas = {}, {}
+    for hoja in {op["hoja"] for op in _cambios}:
+        tabla = TABLAS_HOJAS.get(hoja)
+        if tabla is None:
+            continue
+        registros = _datos["hojas"].get(hoja, [])
+        if all(op["tipo"] == "append" for op in _cambios if op["hoja"] == hoja):
+            agregadas[tabla] = registros[len(_datos_base["hojas"].get(hoja, [])):]
+        else:
+            reemplazadas[tabla] = registros
+    frames = aplicar_cambios(base_frames, agregadas, reemplazadas)
+    if "registro" in reemplazadas:
+        estado = actualizar_estado(frames["registro"])
+    else:
+        # Las filas optimistas se suman al estado sin tocar el checkpoint (aún no están en la hoja)
+        estado = aplicar_filas(base_frames["estado_desgaste"], frames["registro"].iloc[len(base_frames["registro"]):])
+    frames["estado_desgaste"] = estado
+    return agregar_desgaste(frames, calcular_desgaste(frames["equipos"], estado=estado))
+
+
+@st.cache_resource(max_entries=2)
+def obtener_resumen_dashboard(version, _frames):
+    """Agregados del Dashboard para una versión de datos (se calculan una sola vez)."""
+    return construir_resumen(_frames)
+
+
+# Ventanas de fecha para el ranking de horas del Dashboard (días; None = todo el historial)
+PERIODOS_TOP_HORAS = {"Todo el historial": None, "Últimos 30 días": 30, "Últimos 90 días": 90, "Últimos 365 días": 365}
+
+
+@st.cache_resource(max_entries=16)
+def obtener_top_horas(version, n, dias, dia, _registro):
+    """Ranking de horas por versión de datos, tamaño, ventana y día de referencia."""
+    return top_horas(_registro, n=n, dias=dias, hoy=dia)
+
+
+version_actual = snapshot_sheets["version"] if snapshot_sheets else ""
+if snapshot_sheets:
+    frames = obtener_frames(version_actual, snapshot_sheets["base"], snapshot_sheets["datos_base"], datos_sheets, snapshot_sheets["cambios"])
+else:
+    frames = obtener_frames_base(version_actual, datos_sheets)
+registro_df = frames["registro"]
+equipos_df = frames["equipos"]
+empresas_df = frames["empresas"]
+tareas_df = frames["tareas"]
+actas_df = frames["actas"]
+desgaste_df = frames["desgaste"]
+
+# --- FIREBASE (CHAT) ---
+# Inicializar Firebase (solo una vez)
+if 'firebase_initialized' not in st.session_state:
+    db_firebase = inicializar_firebase()
+    st.session_state['firebase_initialized'] = db_firebase is not None
+
+firebase_ok = firebase_disponible()
 
 # --- EMPRESAS ÚNICAS Y ALERTAS ---
-empresas_df = pd.DataFrame(sheet_empresas_data)
-empresas_df.columns = [col.lower().strip() for col in empresas_df.columns]
+alertas_por_empresa = nivel_alerta(desgaste_df, "empresa_key", umbral_critico=1, umbral_advertencia=10)
+# Mensajes sin leer de todas las empresas (últimos conteos; se refrescan en segundo plano)
+no_leidos_por_empresa = (
+    contar_no_leidos_por_empresa(empresas_df["empresa"].tolist()) if firebase_ok and "empresa" in empresas_df.columns else {}
+)
 empresas_visible = []
 empresa_mapa = {}
 for _, row in empresas_df.iterrows():
     if 'empresa' in row:
         nombre = row['empresa']
-        alerta = ''
-        equipos_empresa = equipos_df[equipos_df["empresa"].str.strip().str.lower() == nombre.strip().lower()]
-        for _, eq_row in equipos_empresa.iterrows():
-            consumibles = [c.strip() for c in str(eq_row.get('consumibles','')).split(",") if c.strip()]
-            vida_util_str = str(eq_row.get('vida_util',''))
-            vidas_utiles = [int(v.strip()) if v.strip().isdigit() else 700 for v in vida_util_str.split(";")]
-            data_registro = pd.DataFrame(sheet_registro_data)
-            data_registro.columns = [col.lower().strip() for col in data_registro.columns]
-            data_equipo = data_registro[(data_registro["empresa"].str.strip().str.lower() == nombre.strip().lower()) & (data_registro["codigo"] == eq_row['codigo'])] if not data_registro.empty else pd.DataFrame()
-            estado_partes = {parte: 0 for parte in consumibles}
-            for _, fila in data_equipo.iterrows():
-                horas = fila.get("hora de uso", 0)
-                try:
-                    horas = float(horas)
-                except:
-                    horas = 0
-                partes_cambiadas = str(fila.get("parte cambiada", "")).split(";")
-                for parte in consumibles:
-                    if parte in partes_cambiadas:
-                        estado_partes[parte] = 0
-                    else:
-                        estado_partes[parte] += horas
-            for idx, parte in enumerate(consumibles):
-                usadas = estado_partes.get(parte, 0)
-                vida_util_val = vidas_utiles[idx] if idx < len(vidas_utiles) else 700
-                restantes = max(vida_util_val - usadas, 0)
-                if restantes <= 1:
-                    alerta = ' 🔴'
-                    break
-                elif restantes <= 10 and not alerta:
-                    alerta = ' 🟡'
-            if alerta:
-                break
+        alerta = alertas_por_empresa.get(nombre.strip().lower(), '')
+        no_leidos = no_leidos_por_empresa.get(normalizar_nombre_empresa(nombre), 0)
+        if no_leidos:
+            alerta += f" 💬{no_leidos}"
         empresas_visible.append(f"{nombre}{alerta}")
         empresa_mapa[f"{nombre}{alerta}"] = nombre
 
@@ -345,74 +389,11 @@ def slugify_empresa(nombre):
     return urllib.parse.quote_plus(nombre.strip().replace(' ', '_').lower())
 
 # --- FUNCIÓN PARA BUSCAR ACTAS DE ENTREGA POR OP ---
-def buscar_actas_por_op(numero_op, sheet_actas_data):
-    """Busca las imágenes del acta de entrega por número de OP - LIMPIO"""
-    if not numero_op or not sheet_actas_data:
-        return []
-    
-    actas_df = pd.DataFrame(sheet_actas_data)
-    if actas_df.empty:
+def buscar_actas_por_op(numero_op, frames):
+    """Documentos del acta de entrega de una OP (búsqueda en el índice precalculado)"""
+    if not numero_op:
         return []
-    
-    # Normalizar nombres de columnas  
-    actas_df.columns = [col.lower().strip() for col in actas_df.columns]
-    
-
-    
-    # Buscar por número de OP en TODAS las columnas posibles
-    op_columns = []
-    # Primero buscar columnas obvias de OP
-    for col in actas_df.columns:
-        if any(term in col for term in ['op', 'orden', 'numero', 'no']):
-            op_columns.append(col)
-    
-    # Si no encuentra columnas obvias, usar todas las columnas
-    if not op_columns:
-        op_columns = actas_df.columns.tolist()
-
-    
-    imagenes = []
-    
-    for col in op_columns:
-        # Mostrar algunos valores de ejemplo
-
-        
-        
-        # Buscar coincidencias exactas
-        matching_rows = actas_df[actas_df[col].astype(str).str.strip() == str(numero_op).strip()]
-        
-        if not matching_rows.empty:
-
-            
-            for idx, row in matching_rows.iterrows():
-
-                urls_encontradas = 0
-                
-                # Buscar CUALQUIER columna que tenga un link de Drive
-                for column in row.index:
-                    valor = str(row[column]).strip()
-                    if valor and 'drive.google.com' in valor.lower():
-                        urls_encontradas += 1
-                        nombre_amigable = column.replace('_', ' ').replace('-', ' ').title()
-                        
-                        imagenes.append({
-                            'nombre': f"{nombre_amigable} (Fila {idx + 1})",
-                            'url': get_drive_direct_url(valor),
-                            'columna_original': column
-                        })
-                        
-                    
-                
-
-            
-            break  # Si encontramos la OP, no buscar en otras columnas
-        else:
-            pass  # No se encontraron coincidencias en esta columna
-    
-    return imagenes
-
-
-
+    return actas_de(frames, numero_op)
 
 
 # --- LEER EMPRESA DESDE QUERY PARAM (usando st.query_params, API moderna) ---
@@ -442,82 +423,22 @@ if panel_dashboard == "Panel":
 elif panel_dashboard == "Dashboard":
     st.markdown("##  Dashboard general")
 
+    resumen = obtener_resumen_dashboard(version_actual, frames)
+
     # Total de empresas y equipos
-    total_empresas = len(equipos_df["empresa"].unique())
-    total_equipos = len(equipos_df["codigo"].unique())
-    st.markdown(f"-  **Empresas registradas:** `{total_empresas}`")
-    st.markdown(f"-  **Equipos registrados:** `{total_equipos}`")
+    st.markdown(f"-  **Empresas registradas:** `{resumen['total_empresas']}`")
+    st.markdown(f"-  **Equipos registrados:** `{resumen['total_equipos']}`")
 
     # Partes más cambiadas
-    data_registro = pd.DataFrame(sheet_registro_data)
-    data_registro.columns = [col.lower().strip() for col in data_registro.columns]
-    cambios = data_registro["parte cambiada"].dropna().str.split(";").explode()
-    cambios = cambios[cambios.str.strip() != ""]  # eliminar vacíos
-    partes_frecuentes = cambios.value_counts().head(5)
-
     st.markdown("###  Partes más cambiadas")
-    for parte, count in partes_frecuentes.items():
+    for parte, count in resumen["partes_frecuentes"].items():
         st.markdown(f"- `{parte}`: `{count}` cambios")
 
     # Consumibles críticos y cerca de cumplir vida útil
     st.markdown("### Estado General de Consumibles")
-    
-    consumibles_alertas = []
-
-    for _, row in equipos_df.iterrows():
-        empresa_k = row.get("empresa", "")
-        codigo_k = row.get("codigo", "")
-        descripcion_k = row.get("descripcion", "")
-        consumibles = [c.strip() for c in str(row.get("consumibles", "")).split(",") if c.strip()]
-        vida_util_str = str(row.get("vida_util", ""))
-        vidas_utiles = [int(v.strip()) if v.strip().isdigit() else VIDA_UTIL_DEFECTO for v in vida_util_str.split(";")]
-
-        data_registro = pd.DataFrame(sheet_registro_data)
-        if not data_registro.empty:
-            data_registro.columns = [col.lower().strip() for col in data_registro.columns]
-
-        estado_partes = {parte: 0 for parte in consumibles}
-        data_equipo = data_registro[(data_registro["empresa"].str.strip().str.lower() == empresa_k.strip().lower()) & (data_registro["codigo"] == codigo_k)] if not data_registro.empty else pd.DataFrame()
-        
-        for _, fila in data_equipo.iterrows():
-            horas = fila.get("hora de uso", 0)
-            try:
-                horas = float(horas)
-            except (ValueError, TypeError):
-                horas = 0
-            partes_cambiadas = str(fila.get("parte cambiada", "")).split(";")
-            for parte in estado_partes:
-                if parte in partes_cambiadas:
-                    estado_partes[parte] = 0
-                else:
-                    estado_partes[parte] += horas
-
-        for idx, parte in enumerate(consumibles):
-            usadas = estado_partes.get(parte, 0)
-            vida = vidas_utiles[idx] if idx < len(vidas_utiles) else VIDA_UTIL_DEFECTO
-            
-            if vida == 0: continue
+    alertas_df = resumen["alertas"]
 
-            horas_restantes = vida - usadas
-            
-            if horas_restantes <= 72:  # Unificamos la condición
-                estado_emoji = "🔴" if horas_restantes <= 0 else "🟡"
-                info = {
-                    "Estado": estado_emoji,
-                    "Consumible": parte,
-                    "Empresa": empresa_k,
-                    "Equipo": f"{codigo_k} - {descripcion_k}",
-                    "Horas Usadas": round(usadas, 1),
-                    "Vida Útil (h)": vida,
-                    "Horas Restantes": int(horas_restantes)
-                }
-                consumibles_alertas.append(info)
-
-    if consumibles_alertas:
-        alertas_df = pd.DataFrame(consumibles_alertas)
-        # Ordenar por horas restantes para ver los más críticos primero
-        alertas_df = alertas_df.sort_values(by="Horas Restantes", ascending=True)
-        
+    if not alertas_df.empty:
         st.markdown("Consumibles que requieren atención (críticos y próximos a vencer):")
         st.dataframe(
             alertas_df,
@@ -536,53 +457,24 @@ elif panel_dashboard == "Dashboard":
         st.info("✅ No hay consumibles en estado crítico o próximos a vencer.")
 
     # Equipos con más horas acumuladas
-    st.markdown("### ⏱️ Top 5 equipos con más horas acumuladas")
-    horas_acumuladas = {}
-    detalles_equipo = {}
-
-    for _, fila in data_registro.iterrows():
-        empresa_val = fila.get('empresa', '')
-        codigo_val = fila.get('codigo', '')
-        descripcion_val = fila.get('descripcion', '')
-        key = f"{empresa_val} - {codigo_val}"
-        horas = fila.get("hora de uso", 0)
-        try:
-            horas = float(horas)
-        except:
-            horas = 0
-        horas_acumuladas[key] = horas_acumuladas.get(key, 0) + horas
-        detalles_equipo[key] = {
-            "empresa": empresa_val,
-            "codigo": codigo_val,
-            "descripcion": descripcion_val
-        }
-
-    top_horas = sorted(horas_acumuladas.items(), key=lambda x: x[1], reverse=True)[:5]
-    for equipo_key, horas in top_horas:
-        info = detalles_equipo.get(equipo_key, {})
-        empresa_txt = info.get("empresa", "")
-        codigo_txt = info.get("codigo", "")
-        descripcion_txt = info.get("descripcion", "")
-        st.markdown(f"- 🕒 **Empresa:** `{empresa_txt}` | **Código:** `{codigo_txt}` | **Descripción:** `{descripcion_txt}` | **Horas:** `{horas:.1f}`")
+    st.markdown("### ⏱️ Equipos con más horas acumuladas")
+    col_top, col_periodo = st.columns(2)
+    with col_top:
+        top_n = st.selectbox("Cantidad de equipos", [5, 10, 20], index=0, key="dashboard_top_n")
+    with col_periodo:
+        periodo = st.selectbox("Periodo", list(PERIODOS_TOP_HORAS), index=0, key="dashboard_periodo")
+    dias_periodo = PERIODOS_TOP_HORAS[periodo]
+    if top_n == TOP_HORAS and dias_periodo is None:
+        top_equipos = resumen["top_horas"]
+    else:
+        top_equipos = obtener_top_horas(version_actual, top_n, dias_periodo, hoy_bogota().isoformat(), registro_df)
+    if top_equipos.empty:
+        st.info("No hay horas registradas en el periodo seleccionado.")
+    for eq in top_equipos.itertuples(index=False):
+        st.markdown(f"- 🕒 **Empresa:** `{eq.empresa}` | **Código:** `{eq.codigo}` | **Descripción:** `{eq.descripcion}` | **Horas:** `{eq.horas:.1f}`")
 
     # Simulación exportación a PDF
-    dashboard_text = "Resumen Dashboard DeTEK PRO Company\n\n"
-    dashboard_text += f"Empresas registradas: {total_empresas}\n"
-    dashboard_text += f"Equipos registrados: {total_equipos}\n\n"
-    dashboard_text += "Partes más cambiadas:\n"
-    for parte, count in partes_frecuentes.items():
-        dashboard_text += f"- {parte}: {count} cambios\n"
-    dashboard_text += "\nConsumibles que requieren atención:\n"
-    if consumibles_alertas:
-        alertas_df_report = pd.DataFrame(consumibles_alertas)
-        alertas_df_report = alertas_df_report.sort_values(by="Horas Restantes", ascending=True)
-        for _, eq in alertas_df_report.iterrows():
-            dashboard_text += f"- {eq['Estado']} Empresa: {eq['Empresa']} | Equipo: {eq['Equipo']} | Consumible: {eq['Consumible']} | Restantes: {int(eq['Horas Restantes'])} h\n"
-    else:
-        dashboard_text += "No hay consumibles en estado crítico o próximos a vencer.\n"
-    dashboard_text += "\nTop 5 equipos por horas acumuladas:\n"
-    for equipo, horas in top_horas:
-        dashboard_text += f"- {equipo}: {horas:.1f} horas\n"
+    dashboard_text = resumen["informe"]
 
     st.download_button(
         label=" Exportar informe PDF",
@@ -605,7 +497,7 @@ components.html(f"""
     </script>
 """, height=0)
 # 2. Mostrar layout y QR en un expander debajo de la empresa
-info_empresa_row = empresas_df[empresas_df["empresa"].str.strip().str.lower() == empresa.strip().lower()]
+info_empresa_row = empresa_info(frames, empresa)
 if not info_empresa_row.empty:
     info_empresa_row = info_empresa_row.squeeze()
     layout_url = info_empresa_row.get("layout_url", "")
@@ -613,24 +505,9 @@ if not info_empresa_row.empty:
     parametrosproce_url = info_empresa_row.get("parametrosproce_url", "")
     
     # Convertir el link de layout, qr y parametrosproce si es de Google Drive
-    def get_drive_viewable_url(url):
-        if not isinstance(url, str):
-            return url
-        patterns = [
-            r"/file/d/([\w-]+)",
-            r"id=([\w-]+)",
-            r"https://drive.google.com/open\?id=([\w-]+)",
-            r"https://drive.google.com/uc\?id=([\w-]+)"
-        ]
-        for pat in patterns:
-            match = re.search(pat, url)
-            if match:
-                file_id = match.group(1)
-                return f"https://drive.google.com/uc?export=view&id={file_id}"
-        return url
-    layout_url_view = get_drive_viewable_url(layout_url)
-    qr_url_view = get_drive_viewable_url(qr_url)
-    parametrosproce_url_view = get_drive_viewable_url(parametrosproce_url)
+    layout_url_view = info_empresa_row.get("layout_url_vista", layout_url)
+    qr_url_view = info_empresa_row.get("qr_url_vista", qr_url)
+    parametrosproce_url_view = info_empresa_row.get("parametrosproce_url_vista", parametrosproce_url)
     
     # Generar link único por empresa (slug amigable)
     import urllib.parse
@@ -650,6 +527,15 @@ if not info_empresa_row.empty:
                 </a>
             </div>
         ''', unsafe_allow_html=True)
+        # Vista previa desde la caché local reducida; los botones quedan como respaldo
+        layout_local = imagenes_drive.imagen_drive(layout_url, ancho=960)
+        qr_local = imagenes_drive.imagen_drive(qr_url, ancho=240)
+        if layout_local or qr_local:
+            col_layout, col_qr = st.columns([3, 1])
+            if layout_local:
+                col_layout.image(layout_local, caption="Layout", width=640)
+            if qr_local:
+                col_qr.image(qr_local, caption="QR", width=200)
 
     # --- NUEVO: Expander para Información Adicional ---
     desprese = info_empresa_row.get("desprese", "No especificado")
@@ -711,7 +597,7 @@ zonas_agregadas = set()
 for zona_norm, zona_amigable in orden_zonas:
     if zona_norm in zonas_unicas_norm and zona_amigable not in zonas_agregadas:
         zona_real = next((z for z in zonas_unicas if z.strip().lower() == zona_norm), zona_norm)
-        equipos_zona = equipos_df[(equipos_df["empresa"].str.strip().str.lower() == empresa.strip().lower()) & (equipos_df["zona"].str.strip().str.lower() == zona_norm)]
+        equipos_zona = equipos_de(frames, empresa, zona=zona_norm)
         alerta = ''
         if equipos_zona.empty:
             alerta = ' ⚠️'
@@ -727,7 +613,7 @@ for z in zonas_unicas:
     if not znorm or zona_amigable.strip() == '':
         continue
     if znorm not in [o[0] for o in orden_zonas] and zona_amigable not in zonas_agregadas:
-        equipos_zona = equipos_df[(equipos_df["empresa"].str.strip().str.lower() == empresa.strip().lower()) & (equipos_df["zona"].str.strip().str.lower() == znorm)]
+        equipos_zona = equipos_de(frames, empresa, zona=znorm)
         alerta = ''
         if equipos_zona.empty:
             alerta = ' ⚠️' 
@@ -740,45 +626,17 @@ zona_visible = st.selectbox("Selecciona la zona:", zonas_visibles, key="zona_sel
 nombre_zona = zonas_alerta_map[zona_visible]
 
 # Filtrar equipos por empresa y zona seleccionada
-equipos_zona_df = equipos_df[(equipos_df["empresa"].str.strip().str.lower() == empresa.strip().lower()) & (equipos_df["zona"] == nombre_zona)]
+equipos_zona_df = equipos_de(frames, empresa, zona=nombre_zona)
 
 # --- EQUIPO: agregar alerta si algún consumible está en estado crítico o advertencia ---
 equipos_lista = []
 equipos_alerta_map = {}
 if not equipos_zona_df.empty:
-    for _, row in equipos_zona_df.iterrows():
+    alertas_por_equipo = nivel_alerta(desgaste_df, "equipo_idx", umbral_critico=192, umbral_advertencia=360)
+    for idx_equipo, row in equipos_zona_df.iterrows():
         nombre = f"{row['codigo']} - {row['descripcion']}"
         # Revisar estado de consumibles si existen
-        alerta = ''
-        consumibles = [c.strip() for c in str(row.get('consumibles','')).split(",") if c.strip()]
-        vida_util_str = str(row.get('vida_util',''))
-        vidas_utiles = [int(v.strip()) if v.strip().isdigit() else 700 for v in vida_util_str.split(";")]
-        # Buscar registros de uso
-        data_registro = pd.DataFrame(sheet_registro_data)
-        data_registro.columns = [col.lower().strip() for col in data_registro.columns]
-        data_equipo = data_registro[(data_registro["empresa"].str.strip().str.lower() == empresa.strip().lower()) & (data_registro["codigo"] == row['codigo'])] if not data_registro.empty else pd.DataFrame()
-        estado_partes = {parte: 0 for parte in consumibles}
-        for _, fila in data_equipo.iterrows():
-            horas = fila.get("hora de uso", 0)
-            try:
-                horas = float(horas)
-            except:
-                horas = 0
-            partes_cambiadas = str(fila.get("parte cambiada", "")).split(";")
-            for parte in consumibles:
-                if parte in partes_cambiadas:
-                    estado_partes[parte] = 0
-                else:
-                    estado_partes[parte] += horas
-        for idx, parte in enumerate(consumibles):
-            usadas = estado_partes.get(parte, 0)
-            vida_util_val = vidas_utiles[idx] if idx < len(vidas_utiles) else 700
-            restantes = max(vida_util_val - usadas, 0)
-            if restantes <= 0.5 or restantes <= 192:
-                alerta = ' 🔴'
-                break
-            elif restantes <= 360 and not alerta:
-                alerta = ' 🟡'
+        alerta = alertas_por_equipo.get(idx_equipo, '')
         equipos_lista.append(f"{nombre}{alerta}")
         equipos_alerta_map[f"{nombre}{alerta}"] = nombre
     equipo_seleccionado = st.selectbox("Selecciona el equipo:", equipos_lista, key="equipo_select")
@@ -786,7 +644,7 @@ if not equipos_zona_df.empty:
     # Mostrar cantidad justo debajo del selector de equipo
     if equipo_sel_nombre:
         codigo_sel = equipo_sel_nombre.split(' - ')[0].strip()
-        op_row = equipos_zona_df[equipos_zona_df["codigo"] == codigo_sel]
+        op_row = equipos_zona_df[equipos_zona_df["codigo_key"] == codigo_sel]
         if "cantidad" in op_row.columns and not op_row.empty:
             cantidad_eq = op_row["cantidad"].values[0]
             # Si el valor es None, NaN, vacío o no numérico, mostrar 0
@@ -815,9 +673,14 @@ end_time = now.replace(hour=14, minute=0, second=0, microsecond=0)
 
 modo_auto = True  # Siempre automático
 
+
+def estado_registro_hoy():
+    """Estado del registro masivo de hoy: marcador en la hoja 'Control' (todas las réplicas) o archivo local."""
+    return estado_desde_control(hojas_sheets.get(HOJA_CONTROL, []), today) or estado_registro(today)
+
 if equipo_sel_nombre:
     codigo_sel = equipo_sel_nombre.split(' - ')[0].strip()
-    op_row = equipos_zona_df[equipos_zona_df["codigo"] == codigo_sel]
+    op_row = equipos_zona_df[equipos_zona_df["codigo_key"] == codigo_sel]
     op_equipo = op_row["op"].values[0] if "op" in op_row.columns and not op_row.empty else "No disponible"
     descripcion = op_row["descripcion"].values[0] if not op_row.empty else "No disponible"
     if not op_row.empty:
@@ -846,123 +709,55 @@ if modo_auto:
     st.markdown(f"**Horas transcurridas hoy:** `{horas_formato}` / 7.00 h")
     st.progress(minutos_avance / 420)
 
-    # Registro automático MASIVO a las 2pm para TODAS las empresas (optimización API)
+    # Registro automático MASIVO a las 2pm: lo ejecuta `python -m detek_batch run` (cron/systemd);
+    # la app solo muestra su estado y permite lanzarlo a mano si no se ha ejecutado
+    estado_batch = estado_registro_hoy()
     if now > end_time:
-        # Verificar si ya se ejecutó el proceso masivo hoy
-        batch_key = f"batch_processed_{str(today)}"
-        if batch_key not in st.session_state:
-            st.session_state[batch_key] = False
-        
-        if not st.session_state[batch_key]:
-            with st.spinner("🔄 Ejecutando registro automático masivo de todas las empresas..."):
-                try:
-                    sheet_registro = client.open_by_key(SHEET_ID).worksheet("Hoja 1")
-                    data_registro = pd.DataFrame(sheet_registro_data)
-                    data_registro.columns = [col.lower().strip() for col in data_registro.columns]
-                    
-                    # Procesar TODAS las empresas
-                    total_registros = 0
-                    empresas_procesadas = 0
-                    todas_las_filas = []  # Batch de todas las filas para insertar
-                    
-                    # Obtener todas las empresas únicas
-                    empresas_unicas = empresas_df["empresa"].unique() if not empresas_df.empty else []
-                    
-                    for empresa_nombre in empresas_unicas:
-                        equipos_empresa = equipos_df[equipos_df["empresa"].str.strip().str.lower() == empresa_nombre.strip().lower()]
-                        registros_empresa = 0
-                        
-                        for _, eq_row in equipos_empresa.iterrows():
-                            codigo = eq_row["codigo"]
-                            descripcion_eq = eq_row["descripcion"]
-                            
-                            # Verificar si ya existe registro para hoy
-                            existe_registro = False
-                            if not data_registro.empty:
-                                existe_registro = (
-                                    (data_registro["empresa"].str.strip().str.lower() == empresa_nombre.strip().lower()) &
-                                    (data_registro["codigo"] == codigo) &
-                                    (data_registro["fecha"] == str(today))
-                                ).any()
-                            
-                            if not existe_registro:
-                                # Verificar si se cambió alguna parte hoy
-                                partes_cambiadas_hoy = []
-                                if not data_registro.empty:
-                                    registros_hoy = data_registro[
-                                        (data_registro["empresa"].str.strip().str.lower() == empresa_nombre.strip().lower()) &
-                                        (data_registro["codigo"] == codigo) &
-                                        (data_registro["fecha"] == str(today))
-                                    ]
-                                    if not registros_hoy.empty:
-                                        partes_cambiadas_hoy = registros_hoy["parte cambiada"].dropna().tolist()
-                                
-                                # Determinar horas de uso y parte cambiada
-                                if partes_cambiadas_hoy:
-                                    parte_cambiada = ";".join([p for p in partes_cambiadas_hoy if p])
-                                    horas_uso = 0.0
-                                else:
-                                    parte_cambiada = ""
-                                    horas_uso = 7.0
-                                
-                                # Agregar fila al batch
-                                fila = [
-                                    empresa_nombre,
-                                    str(today),
-                                    codigo,
-                                    descripcion_eq,
-                                    horas_uso,
-                                    parte_cambiada,
-                                    "Sin Observaciones"
-                                ]
-                                todas_las_filas.append(fila)
-                                registros_empresa += 1
-                        
-                        if registros_empresa > 0:
-                            empresas_procesadas += 1
-                            total_registros += registros_empresa
-                    
-                    # Insertar todas las filas en una sola operación (BATCH)
-                    if todas_las_filas:
-                        sheet_registro.append_rows(todas_las_filas)
-                        st.success(f"✅ **Registro Masivo Completado**: {total_registros} equipos de {empresas_procesadas} empresas registrados automáticamente")
-                        st.info(f"📊 **Optimización API**: Se realizó una sola operación en lote en lugar de {total_registros} llamadas individuales")
-                    else:
-                        st.info("ℹ️ Todos los registros del día ya estaban completos")
-                    
-                    # Marcar como procesado para evitar repetición
-                    st.session_state[batch_key] = True
-                    
-                except Exception as e:
-                    st.error(f"❌ Error en registro masivo: {str(e)}")
+        if estado_batch and estado_batch["estado"] == "completado":
+            st.info(f"✅ Registro masivo del día ya completado ({estado_batch['filas']} equipos de {estado_batch['empresas']} empresas)")
+        elif estado_batch and estado_batch["estado"] == "en_curso":
+            st.info("🔄 El registro masivo del día se está ejecutando en otra sesión o servidor")
         else:
-            st.info("✅ Registro masivo del día ya completado")
+            if estado_batch:
+                st.error(f"❌ Error en registro masivo: {estado_batch['error']}")
+            else:
+                st.warning("🔄 El registro masivo del día aún no se ha ejecutado")
+            if st.button("Ejecutar registro masivo ahora", key=f"ejecutar_batch_{today}"):
+                with st.spinner("🔄 Ejecutando registro automático masivo de todas las empresas..."):
+                    estado_batch = ejecutar_registro_diario(
+                        client, today, SHEET_ID,
+                        aplicar_pendientes=lambda hojas, encabezados: cola_escrituras.aplicar_operaciones(
+                            hojas, encabezados, cola_escrituras.pendientes(SHEET_ID)
+                        ),
+                    )
+                if estado_batch["estado"] == "completado":
+                    st.success(f"✅ **Registro Masivo Completado**: {estado_batch['filas']} equipos de {estado_batch['empresas']} empresas registrados automáticamente")
+                    refrescar_snapshot(CLAVE_SNAPSHOT_SHEETS, descargar_hojas)
+                elif estado_batch["estado"] == "en_curso":
+                    st.info("🔄 Otra sesión o servidor está ejecutando el registro masivo del día")
+                else:
+                    st.error(f"❌ Error en registro masivo: {estado_batch['error']}")
     
     # Mostrar registro individual para la empresa actual (solo informativo)
-    equipos_empresa = equipos_df[equipos_df["empresa"].str.strip().str.lower() == empresa.strip().lower()]
-    data_registro = pd.DataFrame(sheet_registro_data)
-    data_registro.columns = [col.lower().strip() for col in data_registro.columns]
+    equipos_empresa = equipos_de(frames, empresa)
+    registros_empresa = registros_de(frames, empresa)
     registros_empresa_hoy = 0
-    if not data_registro.empty and not equipos_empresa.empty:
-        for _, eq_row in equipos_empresa.iterrows():
-            codigo = eq_row["codigo"]
-            existe_registro = (
-                (data_registro["empresa"].str.strip().str.lower() == empresa.strip().lower()) &
-                (data_registro["codigo"] == codigo) &
-                (data_registro["fecha"] == str(today))
-            ).any()
-            if existe_registro:
-                registros_empresa_hoy += 1
+    if not registros_empresa.empty and not equipos_empresa.empty:
+        codigos_hoy = set(registros_empresa.loc[registros_empresa["fecha_dt"].dt.date == today, "codigo_key"])
+        registros_empresa_hoy = int(equipos_empresa["codigo_key"].isin(codigos_hoy).sum())
     
     if registros_empresa_hoy > 0 and now > end_time:
         st.success(f"✅ Esta empresa tiene {registros_empresa_hoy} equipo(s) ya registrados hoy")
 
 # --- INFORMACIÓN DEL SISTEMA (sidebar) ---
 st.sidebar.markdown("### ⚡ Estado del Sistema API")
-batch_key = f"batch_processed_{str(today)}"
-batch_status = st.session_state.get(batch_key, False)
-if batch_status:
+estado_batch = estado_registro_hoy()
+if estado_batch and estado_batch["estado"] == "completado":
     st.sidebar.success("✅ Registro masivo completado hoy")
+elif estado_batch and estado_batch["estado"] == "en_curso":
+    st.sidebar.info("🔄 Registro masivo en ejecución")
+elif estado_batch and now > end_time:
+    st.sidebar.error("❌ Registro masivo con error")
 elif now > end_time:
     st.sidebar.warning("🔄 Registro masivo pendiente")
 else:
@@ -971,13 +766,47 @@ else:
     minutos_restantes = (tiempo_restante.seconds % 3600) // 60
     st.sidebar.info(f"⏱️ Registro masivo en: {horas_restantes}h {minutos_restantes}m")
 
+uso_api = estadisticas_api()
+if uso_api["esperas"] or uso_api["limitadas"]:
+    st.sidebar.caption(
+        f"🚦 Llamadas API: {uso_api['llamadas']} | en espera por cuota: {uso_api['esperas']} | "
+        f"limitadas (429): {uso_api['limitadas']}"
+    )
+
+estado_escrituras = cola_escrituras.estado_cola()
+if estado_escrituras["pendientes"]:
+    st.sidebar.caption(f"📝 Escrituras pendientes de enviar: {estado_escrituras['pendientes']}")
+    if estado_escrituras["ultimo_error"]:
+        st.sidebar.caption(f"Último error de escritura: {estado_escrituras['ultimo_error']}")
+if estado_escrituras["fallidas"]:
+    # Escrituras que Sheets rechazó: no se aplicaron y no se descartan sin avisar
+    st.sidebar.error(f"⚠️ {estado_escrituras['fallidas']} escritura(s) no se pudieron guardar en Sheets")
+    with st.sidebar.expander("Ver escrituras fallidas", expanded=False):
+        for op in cola_escrituras.fallidas():
+            detalle = f"{len(op['filas'])} fila(s) nuevas" if op["tipo"] == "append" else f"celda F{op['fila']}C{op['columna']} = {op['valor']}"
+            st.caption(f"{op.get('fecha', '')} · {op['hoja']} · {detalle}\n\n{op.get('error', '')}")
+            if op["tipo"] == "append":
+                st.code("\n".join(" | ".join(str(v) for v in fila) for fila in op["filas"]))
+        col_reintentar, col_descartar = st.columns(2)
+        with col_reintentar:
+            st.button("🔁 Reintentar", key="escrituras_reintentar", on_click=cola_escrituras.reintentar_fallidas)
+        with col_descartar:
+            st.button("🗑️ Descartar", key="escrituras_descartar", on_click=cola_escrituras.descartar_fallidas)
+
+if snapshot_sheets:
+    edad_datos = int(time.time() - snapshot_sheets["obtenido_en"])
+    texto_edad = f"🕒 Datos de Sheets de hace {edad_datos // 60} min {edad_datos % 60} s" if edad_datos >= 60 else f"🕒 Datos de Sheets de hace {edad_datos} s"
+    if refresco_en_curso(CLAVE_SNAPSHOT_SHEETS):
+        texto_edad += " (actualizando...)"
+    st.sidebar.caption(texto_edad)
+
 st.sidebar.markdown("---")
 
 # --- INFORMACIÓN DE LA EMPRESA (sidebar) ---
 st.sidebar.markdown("### 🏢 Información de la empresa seleccionada")
 st.sidebar.markdown(f"**Empresa:** {empresa}")
 
-info_match = empresas_df[empresas_df["empresa"].str.strip().str.lower() == empresa.strip().lower()]
+info_match = empresa_info(frames, empresa)
 info_empresa = info_match.squeeze() if not info_match.empty else {}
 
 st.sidebar.markdown(f"**Encargado:** {info_empresa.get('encargado', 'No disponible')}")
@@ -989,14 +818,10 @@ st.sidebar.markdown(f"**Técnico líder Tekpro:** {info_empresa.get('tecnico', '
 st.sidebar.markdown("---")
 st.sidebar.markdown("### 📋 Tareas de la empresa")
 
-# Cargar todas las tareas de la empresa
-try:
-    tareas_df = pd.DataFrame(sheet_tareas_data)
-except:
-    tareas_df = pd.DataFrame()
+# Tareas de la empresa (tareas_df viene de la capa de datos)
 cols_needed = {"empresa", "tarea", "descripcion", "fecha_asignacion", "completada"}
 if not tareas_df.empty and cols_needed.issubset(set(tareas_df.columns)):
-    tareas_empresa = tareas_df[tareas_df["empresa"].str.strip().str.lower() == empresa.strip().lower()]
+    tareas_empresa = tareas_de(frames, empresa)
     if not tareas_empresa.empty:
         for idx, tarea_row in tareas_empresa.iterrows():
             try:
@@ -1024,14 +849,15 @@ with st.sidebar.expander("➕ Agregar nueva tarea"):
     asignada_por = st.text_input("Asignada por", value="DeTEK PRO Company", key="asignada_por")
     if st.button("Agregar tarea", key="asignar_tarea"):
         if nueva_tarea.strip():
-            sheet_tareas.append_row([
+            fila_tarea = [
                 empresa,
                 nueva_tarea.strip(),
                 asignada_por.strip(),
                 datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                 "No",
                 ""
-            ])
+            ]
+            escribir_en_segundo_plano([cola_escrituras.agregar_filas(SHEET_ID, "Tareas", [fila_tarea])])
             st.success("Tarea agregada correctamente.")
             st.rerun()
 
@@ -1090,9 +916,8 @@ with st.sidebar.expander("🔧 Registrar nuevo equipo"):
         ]
         
         try:
-            # Obtener la hoja de equipos y agregar la nueva fila
-            sheet_equipos = client.open_by_key(SHEET_ID).worksheet("Equipos")
-            sheet_equipos.append_row(fila)
+            # Agregar la nueva fila a la hoja de equipos (se envía en segundo plano)
+            escribir_en_segundo_plano([cola_escrituras.agregar_filas(SHEET_ID, "Equipos", [fila])])
             
             st.success(f"✅ Equipo {nuevo_codigo} registrado correctamente en zona {nueva_zona}.")
             # Recargar la página para ver los cambios
@@ -1101,13 +926,6 @@ with st.sidebar.expander("🔧 Registrar nuevo equipo"):
             st.error(f"Error al registrar el equipo: {e}")
 
 # --- CHAT EN LÍNEA ENTRE APPS (FIREBASE - TIEMPO REAL) ---
-# Inicializar Firebase (solo una vez)
-if 'firebase_initialized' not in st.session_state:
-    db_firebase = inicializar_firebase()
-    st.session_state['firebase_initialized'] = db_firebase is not None
-
-firebase_ok = firebase_disponible()
-
 # Obtener mensajes no leídos para indicador
 mensajes_no_leidos = contar_mensajes_no_leidos(empresa) if firebase_ok else 0
 hay_nuevo = mensajes_no_leidos > 0
@@ -1117,7 +935,35 @@ chat_title = "💬 Chat en línea"
 if hay_nuevo:
     chat_title += f" 🔴 {mensajes_no_leidos}"
 
-with st.sidebar.expander(chat_title, expanded=False):
+# El chat se dibuja como fragmento: enviar, actualizar o cargar anteriores solo
+# vuelve a ejecutar esta parte, no toda la página (Streamlit >= 1.33)
+fragmento_chat = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda **_: lambda f: f)
+ICONOS_ENVIO = {'pendiente': '⏳', 'enviado': '✓', 'fallido': '❌'}
+
+
+def enviar_chat(empresa):
+    """Encola el mensaje escrito (se envía en segundo plano) y limpia el campo."""
+    texto = st.session_state.get("chat_mensaje_company", "").strip()
+    if not texto:
+        st.session_state['chat_aviso'] = "Escribe un mensaje primero."
+    elif encolar_mensaje(empresa, "Soporte tecnico", texto) is None:
+        st.session_state['chat_aviso'] = "❌ Error al enviar el mensaje."
+    else:
+        st.session_state["chat_mensaje_company"] = ""
+
+
+def cargar_anteriores_chat(empresa, historial_chat, cursor):
+    """Agrega la página anterior del historial (una por clic)."""
+    pagina = obtener_pagina_mensajes(empresa, antes=cursor)
+    historial_chat['mensajes'] = pagina['mensajes'] + historial_chat['mensajes']
+    historial_chat['agotado'] = pagina['anterior'] is None
+
+
+def forzar_sincronizacion_chat():
+    st.session_state['chat_forzar_sincronizacion'] = True
+
+
+def panel_chat(empresa, firebase_ok):
     # Mostrar el chat_id para debugging (key real de Firestore)
     chat_id_debug = normalizar_nombre_empresa(empresa)
     st.caption(f"🔗 Chat ID: `{chat_id_debug}`")
@@ -1129,8 +975,28 @@ with st.sidebar.expander(chat_title, expanded=False):
         if ultimo_error_firebase:
             st.warning(f"Detalle: {ultimo_error_firebase}")
     
-    # Obtener mensajes de Firebase (tiempo real)
-    mensajes_firebase = firebase_obtener_mensajes(empresa, limite=50)
+    # Mensajes de Firebase desde la copia local sincronizada (solo se descargan los nuevos)
+    mensajes_firebase = mensajes_chat(
+        empresa, limite=50, forzar=st.session_state.pop('chat_forzar_sincronizacion', False)
+    ) if firebase_ok else []
+    
+    # Páginas anteriores cargadas a pedido (una por clic), por empresa
+    historial_chat = st.session_state.setdefault(
+        f"chat_historial_{chat_id_debug}", {'mensajes': [], 'agotado': False}
+    )
+    # Mensajes enviados desde aquí: se ven al instante con su estado de envío
+    envios = envios_chat(empresa) if firebase_ok else []
+    estados_envio = {envio['id']: envio for envio in envios}
+    mostrados = {m['id']: m for m in historial_chat['mensajes'] + mensajes_firebase}
+    mostrados.update({envio['id']: envio for envio in envios if envio['id'] not in mostrados})
+    hay_anteriores = bool(historial_chat['mensajes']) or len(mensajes_firebase) >= 50
+    mensajes_firebase = sorted(mostrados.values(), key=lambda m: m.get('timestamp') or 0)
+    
+    if hay_anteriores and not historial_chat['agotado']:
+        st.button(
+            "⬆️ Cargar anteriores", key="chat_anteriores_company", use_container_width=True,
+            on_click=cargar_anteriores_chat, args=(empresa, historial_chat, cursor_mensaje(mensajes_firebase[0]))
+        )
     
     if mensajes_firebase:
         # Mostrar mensajes
@@ -1138,6 +1004,8 @@ with st.sidebar.expander(chat_title, expanded=False):
             usuario = msg.get('usuario', 'Anónimo')
             fecha = msg.get('fecha', '')
             texto = msg.get('mensaje', '')
+            envio = estados_envio.get(msg['id'])
+            estado = f" <span title='{envio['estado']}'>{ICONOS_ENVIO[envio['estado']]}</span>" if envio else ""
             
             # Estilo diferente para soporte técnico vs cliente
             if usuario.lower() == 'soporte tecnico':
@@ -1147,54 +1015,50 @@ with st.sidebar.expander(chat_title, expanded=False):
             
             st.markdown(
                 f"<span style='color:{color}'><b>{usuario}</b></span> "
-                f"<span style='color:gray;font-size:12px'>({fecha})</span>: {texto}",
+                f"<span style='color:gray;font-size:12px'>({fecha})</span>: {texto}{estado}",
                 unsafe_allow_html=True
             )
+            if envio and envio['estado'] == 'fallido':
+                st.button(
+                    "Reintentar", key=f"chat_reintentar_{msg['id']}", help=envio['error'],
+                    on_click=reintentar_envio, args=(empresa, msg['id'])
+                )
     else:
         st.info("No hay mensajes en el chat todavía.")
     
     st.markdown("---")
-    mensaje_chat = st.text_input("Mensaje:", value="", key="chat_mensaje_company")
+    st.text_input("Mensaje:", key="chat_mensaje_company")
     
     col_enviar, col_refresh = st.columns([3, 1])
     with col_enviar:
-        if st.button("📤 Enviar", key="chat_enviar_company", use_container_width=True):
-            if mensaje_chat.strip():
-                if firebase_enviar_mensaje(empresa, "Soporte tecnico", mensaje_chat.strip()):
-                    st.success("✅ Mensaje enviado!")
-                    time.sleep(0.5)
-                    st.rerun()
-                else:
-                    st.error("❌ Error al enviar el mensaje.")
-            else:
-                st.warning("Escribe un mensaje primero.")
+        st.button(
+            "📤 Enviar", key="chat_enviar_company", use_container_width=True,
+            on_click=enviar_chat, args=(empresa,)
+        )
+        aviso_chat = st.session_state.pop('chat_aviso', None)
+        if aviso_chat:
+            st.warning(aviso_chat)
     
     with col_refresh:
-        if st.button("🔄", key="chat_refresh_company", help="Actualizar mensajes"):
-            st.rerun()
+        st.button("🔄", key="chat_refresh_company", help="Actualizar mensajes", on_click=forzar_sincronizacion_chat)
+
+
+# Streamlit no informa si un expander está abierto: el chat se abre con una
+# casilla y solo mientras está abierto el fragmento sondea cada INTERVALO_SONDEO
+chat_abierto = st.sidebar.checkbox(chat_title, key="chat_abierto")
+if chat_abierto:
+    with st.sidebar.container():
+        fragmento_chat(run_every=INTERVALO_SONDEO)(panel_chat)(empresa, firebase_ok)
+        # Fuera del fragmento: al marcar leídos se redibujan también los indicadores
+        if hay_nuevo:
+            st.button(
+                "✔️ Marcar como leídos", key="chat_marcar_leidos_company", use_container_width=True,
+                on_click=marcar_mensajes_leidos, args=(empresa,)
+            )
 
 # --- INFORMACIÓN MULTIMEDIA DEL EQUIPO EN EXPANDER ---
 
 if equipo_seleccionado and isinstance(equipo_seleccionado, str) and not op_row.empty:
-    import re
-    def get_drive_direct_url(url):
-        """Convierte un enlace de Google Drive tipo /file/d/ID/view o sharing a enlace directo de visualización."""
-        if not isinstance(url, str):
-            url = str(url) if url is not None else ""
-        # Buscar ID en diferentes formatos
-        patterns = [
-            r"/file/d/([\w-]+)",
-            r"id=([\w-]+)",
-            r"https://drive.google.com/open\?id=([\w-]+)",
-            r"https://drive.google.com/uc\?id=([\w-]+)"
-        ]
-        for pat in patterns:
-            match = re.search(pat, url)
-            if match:
-                file_id = match.group(1)
-                return f"https://drive.google.com/uc?export=view&id={file_id}"
-        return url
-
     equipo_row = op_row.squeeze()
     with st.expander("Información adicional del equipo", expanded=True):
         # Mostrar número de OP si existe
@@ -1211,19 +1075,19 @@ if equipo_seleccionado and isinstance(equipo_seleccionado, str) and not op_row.e
         # Verificación estricta de la foto
         foto_url = equipo_row.get("foto_url", "")
         if isinstance(foto_url, str) and foto_url.strip():
-            foto_url = get_drive_direct_url(foto_url)
+            foto_url = equipo_row.get("foto_url_directa", foto_url)
             tiene_foto = True
         
         # Verificación estricta del manual
         manual_url = equipo_row.get("manual_url", "")
         if isinstance(manual_url, str) and manual_url.strip():
-            manual_url = get_drive_direct_url(manual_url)
+            manual_url = equipo_row.get("manual_url_directa", manual_url)
             tiene_manual = True
         
         # Verificación estricta de la ficha técnica
         ficha_url = equipo_row.get("ficha_tecnica_url", "")
         if isinstance(ficha_url, str) and ficha_url.strip():
-            ficha_url = get_drive_direct_url(ficha_url)
+            ficha_url = equipo_row.get("ficha_tecnica_url_directa", ficha_url)
         
         # Solo crear columnas si hay al menos un botón para mostrar
         if tiene_foto or tiene_manual:
@@ -1233,6 +1097,9 @@ if equipo_seleccionado and isinstance(equipo_seleccionado, str) and not op_row.e
             if tiene_foto:
                 with col1:
                     st.markdown("**Foto del equipo:**")
+                    foto_local = imagenes_drive.imagen_drive(foto_url, ancho=480)
+                    if foto_local:
+                        st.image(foto_local, width=320)
                     st.markdown(f'''
                         <a href="{foto_url}" target="_blank" style="
                             display: inline-block;
@@ -1299,7 +1166,7 @@ if equipo_seleccionado and isinstance(equipo_seleccionado, str) and not op_row.e
 
         
         if op_numero and op_numero != "No disponible":
-            imagenes_acta = buscar_actas_por_op(op_numero, sheet_actas_data)
+            imagenes_acta = buscar_actas_por_op(op_numero, frames)
             
             if imagenes_acta:
                 st.markdown("---")
@@ -1333,6 +1200,11 @@ if equipo_seleccionado and isinstance(equipo_seleccionado, str) and not op_row.e
                             color = "#fd7e14"  # Naranja para otros
                             icono = "🔗"
                         
+                        # Vista previa reducida si el documento es una imagen
+                        imagen_local = imagenes_drive.imagen_drive(url, ancho=480) if icono == "📷" else None
+                        if imagen_local:
+                            st.image(imagen_local, caption=nombre, width=320)
+
                         # Crear botón estilizado
                         st.markdown(f"""
                             <div style="margin-bottom: 0.5em;">
@@ -1378,11 +1250,8 @@ if equipo_seleccionado and isinstance(equipo_seleccionado, str) and not op_row.e
         # --- ESTADO DE CONSUMIBLES ---
         if 'codigo_sel' in locals() and codigo_sel:
             st.markdown("### 🔧 Estado de consumibles del proceso seleccionado")
-            # Leer registros de uso desde la hoja principal para el equipo seleccionado
-            data_registro = pd.DataFrame(sheet_registro_data)
-            data_registro.columns = [col.lower().strip() for col in data_registro.columns]
-            data_equipo = data_registro[(data_registro["empresa"].str.strip().str.lower() == empresa.strip().lower()) & (data_registro["codigo"] == codigo_sel)] if not data_registro.empty else pd.DataFrame()
-            estado_partes = {parte: 0 for parte in consumibles_equipo}
+            # Estado de desgaste del equipo seleccionado (tabla precalculada)
+            desgaste_equipo = desgaste_de(frames, op_row.index[0])
 
             # Obtener cantidades de consumibles
             cantidad_consu_list = []
@@ -1390,28 +1259,12 @@ if equipo_seleccionado and isinstance(equipo_seleccionado, str) and not op_row.e
                 cantidad_consu_str = str(op_row["cantidad_consu"].values[0])
                 cantidad_consu_list = [c.strip() for c in cantidad_consu_str.split(";")]
 
-            for _, fila in data_equipo.iterrows():
-                horas = fila.get("hora de uso", 0)
-                try:
-                    horas = float(horas)
-                except:
-                    horas = 0
-                partes_cambiadas = str(fila.get("parte cambiada", "")).split(";")
-                for parte in consumibles_equipo:
-                    if parte in partes_cambiadas:
-                        estado_partes[parte] = 0
-                    else:
-                        estado_partes[parte] += horas
-
             # Mostrar cada consumible y debajo su cantidad
-            for idx, parte in enumerate(consumibles_equipo):
-                usadas = estado_partes.get(parte, 0)
-                vida_util_val = VIDA_UTIL_DEFECTO
-                if "vida_util" in op_row.columns and not op_row.empty:
-                    vida_util_str = str(op_row["vida_util"].values[0])
-                    vidas_utiles = [int(v.strip()) if v.strip().isdigit() else VIDA_UTIL_DEFECTO for v in vida_util_str.split(";")]
-                    if idx < len(vidas_utiles):
-                        vida_util_val = vidas_utiles[idx]
+            for _, consumo in desgaste_equipo.iterrows():
+                idx = consumo["posicion"]
+                parte = consumo["consumible"]
+                usadas = consumo["horas_usadas"]
+                vida_util_val = consumo["vida_util"]
                 restantes = max(vida_util_val - usadas, 0)
                 porcentaje = min(usadas / vida_util_val, 1.0) if vida_util_val > 0 else 0
 
@@ -1453,19 +1306,23 @@ with st.form("registro_form"):
             parte_cambiada,
             observaciones if observaciones else "Sin Observaciones"
         ]
-        sheet_registro.append_row(fila)
+        escrituras = [cola_escrituras.agregar_filas(SHEET_ID, "Hoja 1", [fila])]
         # Si se cambió alguna parte, reiniciar la columna 'hora de uso' en la hoja de equipos
         if partes and 'codigo_sel' in locals():
-            idx_equipo = equipos_df[(equipos_df["empresa"].str.strip().str.lower() == empresa.strip().lower()) & (equipos_df["codigo"] == codigo_sel)].index
+            idx_equipo = equipos_de(frames, empresa, codigo=codigo_sel).index
+            # Encabezado de 'Equipos' detectado en la descarga (puede no estar en la fila 1)
+            fila_encabezado, encabezados_equipos = datos_sheets["encabezados"].get("Equipos", (1, []))
+            encabezados_norm = [str(h).lower().strip() for h in encabezados_equipos]
             if len(idx_equipo) > 0:
                 idx = idx_equipo[0]
                 # Reiniciar 'hora de uso' a 0 (si existe la columna)
-                if "hora de uso" in equipos_df.columns:
-                    equipos_df.at[idx, "hora de uso"] = 0
+                # equipos_df es compartido y de solo lectura: se actualiza solo la hoja
+                if "hora de uso" in encabezados_norm:
                     # Actualizar en Google Sheets
-                    sheet_equipos = client.open_by_key(SHEET_ID).worksheet("Equipos")
-                    col_idx = list(equipos_df.columns).index("hora de uso") + 1
-                    sheet_equipos.update_cell(idx + 2, col_idx, 0)  # +2 por encabezado y 0-index
+                    col_idx = encabezados_norm.index("hora de uso") + 1
+                    fila_hoja = fila_encabezado + 1 + idx  # primera fila de datos + posición
+                    escrituras.append(cola_escrituras.actualizar_celda(SHEET_ID, "Equipos", fila_hoja, col_idx, 0))
+        escribir_en_segundo_plano(escrituras)
         # Limpiar los campos del formulario
         st.session_state["registro_form-Partes cambiadas hoy"] = []
         st.session_state["registro_form-Observaciones"] = ""
@@ -0,0 +1,87 @@
+"""
+Enlaces de Google Drive
+=======================
+Convierte enlaces de Drive (/file/d/ID/view, open?id=ID, uc?id=ID, ...) en
+enlaces de miniatura o de visualización directa. El ID se extrae con un solo
+patrón precompilado y los resultados se memorizan en un LRU acotado, así que
+resolver la misma URL en cada rerun no vuelve a aplicar la expresión regular.
+"""
+
+import re
+from functools import lru_cache
+
+import pandas as pd
+
+# /file/d/ID tiene prioridad sobre id=ID (open?id=, uc?id=, uc?export=view&id=)
+PATRON_ID_DRIVE = re.compile(r"/file/d/([\w-]+)|id=([\w-]+)")
+
+VARIANTES = {
+    "miniatura": "https://drive.google.com/thumbnail?id={}",
+    "vista": "https://drive.google.com/uc?export=view&id={}",
+    "directa": "https://drive.google.com/uc?export=view&id={}",
+}
+
+TAMANO_CACHE = 4096
+
+
+@lru_cache(maxsize=TAMANO_CACHE)
+def id_drive(url: str):
+    """ID del archivo de Drive en la URL, o None si no parece un enlace de Drive."""
+    coincidencia = PATRON_ID_DRIVE.search(url)
+    if not coincidencia:
+        return None
+    return coincidencia.group(1) or coincidencia.group(2)
+
+
+@lru_cache(maxsize=TAMANO_CACHE)
+def _resolver(url: str, variante: str) -> str:
+    file_id = id_drive(url)
+    return VARIANTES[variante].format(file_id) if file_id else url
+
+
+def url_drive(url, variante: str = "vista"):
+    """
+    Resuelve un enlace de Drive a la variante pedida.
+
+    Args:
+        url: Enlace original (los valores que no son texto se devuelven igual,
+            salvo en la variante 'directa', que los convierte a texto)
+        variante: 'miniatura', 'vista' o 'directa'
+
+    Returns:
+        Enlace resuelto, o el original si no contiene un ID de Drive
+    """
+    if not isinstance(url, str):
+        if variante != "directa":
+            return url
+        url = str(url) if url is not None else ""
+    return _resolver(url, variante)
+
+
+def url_miniatura(url):
+    """Enlace de miniatura (thumbnail) de un archivo de Drive."""
+    return url_drive(url, "miniatura")
+
+
+def url_vista(url):
+    """Enlace de visualización (uc?export=view) de un archivo de Drive."""
+    return url_drive(url, "vista")
+
+
+def url_directa(url) -> str:
+    """Enlace directo para incrustar imágenes o abrir documentos de Drive."""
+    return url_drive(url, "directa")
+
+
+def resolver_columna(serie: pd.Series, variante: str = "directa") -> pd.Series:
+    """
+    Resuelve una columna completa de enlaces (cada valor distinto una sola vez).
+
+    Las celdas vacías o que no son texto se conservan tal cual.
+    """
+    es_texto = serie.map(lambda valor: isinstance(valor, str) and bool(valor.strip()))
+    resueltos = serie.copy()
+    if es_texto.any():
+        unicos = {url: url_drive(url, variante) for url in serie[es_texto].unique()}
+        resueltos[es_texto] = serie[es_texto].map(unicos)
+    return resueltos
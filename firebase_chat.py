@@ -9,11 +9,69 @@ from firebase_admin import credentials, firestore
 from datetime import datetime
 import json
 import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from google.cloud.firestore_v1.base_query import FieldFilter
+except ImportError:  # google-cloud-firestore < 2.11
+    FieldFilter = None
+
+try:
+    from google.api_core.exceptions import AlreadyExists
+except ImportError:
+    AlreadyExists = None
 
 # Variable global para controlar la inicialización
 _firebase_initialized = False
 _firebase_last_error = ""
 
+# Valor de 'origen' de los mensajes escritos por esta app (soporte técnico)
+ORIGEN_APP = 'detek_procompany'
+
+# Conteos de no leídos por empresa (ver contar_no_leidos_por_empresa): se
+# refrescan en segundo plano cada TTL_NO_LEIDOS segundos, con una sola
+# consulta collection_group para los chats que ya tienen marca de lectura
+TTL_NO_LEIDOS = 15
+# Consultas count() en paralelo para los chats que nunca se marcaron leídos
+HILOS_CONTEO_NO_LEIDOS = 8
+_cache_no_leidos = {}
+_estado_no_leidos = {'claves': set(), 'refrescado': 0.0, 'hilo': None}
+_lock_no_leidos = threading.Lock()
+
+# Máximo de operaciones por WriteBatch que admite Firestore
+TAMANO_LOTE_ESCRITURA = 500
+# Segundos que se retrocede la marca 'leidos_hasta' al buscar mensajes de
+# CLIENTE, cuyo 'timestamp' sale del reloj del dispositivo que los escribe
+MARGEN_RELOJ_CLIENTE = 3600
+
+# Mensajes sincronizados por empresa (ver mensajes_chat): se descargan una vez
+# y luego solo llegan los nuevos, por listener de Firestore o por sondeo
+MAX_CHATS_SINCRONIZADOS = 20
+MAX_MENSAJES_POR_CHAT = 200
+INTERVALO_SONDEO = 5
+TTL_CHAT_INACTIVO = 600
+# Cada cuántos segundos el hilo de expulsión cierra los chats inactivos
+INTERVALO_EXPULSION = 60
+_chats_sincronizados = OrderedDict()
+_lock_chats = threading.Lock()
+_hilo_expulsion = None
+
+# Mensajes por página del historial (ver obtener_pagina_mensajes)
+TAMANO_PAGINA_MENSAJES = 50
+
+# Envíos en segundo plano (ver encolar_mensaje): estado por mensaje y reintentos
+REINTENTOS_ENVIO = 3
+ESPERA_REINTENTO_ENVIO = 1  # segundos; se duplica en cada intento
+MAX_ENVIOS_POR_CHAT = 50
+_envios = {}
+_cola_envios = queue.Queue()
+_lock_envios = threading.Lock()
+_hilo_envios = None
+
 
 def inicializar_firebase(credentials_path: str = "firebase_credentials.json"):
     """
@@ -126,9 +184,103 @@ def normalizar_nombre_empresa(empresa):
     return nombre_normalizado
 
 
+def _donde(consulta, campo: str, operador: str, valor):
+    """Aplica un filtro con la sintaxis de la versión instalada de Firestore."""
+    if FieldFilter is not None:
+        return consulta.where(filter=FieldFilter(campo, operador, valor))
+    return consulta.where(campo, operador, valor)
+
+
+def _contar(consulta) -> int:
+    """Cuenta documentos con una agregación count() en el servidor (sin descargarlos)."""
+    resultado = consulta.count().get()
+    return int(resultado[0][0].value)
+
+
+def _no_leidos_en_cero(empresa_key: str):
+    """Deja en cero el conteo cacheado de una empresa (tras marcar leídos)."""
+    with _lock_no_leidos:
+        _cache_no_leidos[empresa_key] = 0
+
+
+def _ultimo_mensaje_resumen(mensaje: dict) -> dict:
+    """Campos del último mensaje en el documento chats/{empresa_key}."""
+    return {
+        'ultimo_mensaje': {
+            'usuario': mensaje.get('usuario', ''),
+            'mensaje': mensaje.get('mensaje', ''),
+            'fecha': mensaje.get('fecha', ''),
+        },
+        'ultimo_timestamp': mensaje.get('timestamp'),
+    }
+
+
+def _resumen_chat(mensaje: dict) -> dict:
+    """
+    Campos del documento chats/{empresa_key} que se actualizan con cada mensaje
+    escrito por esta app. Los de CLIENTE no pasan por aquí: los refleja el
+    refresco de no leídos (ver _conteos_no_leidos).
+    """
+    resumen = {
+        'empresa': mensaje.get('empresa', ''),
+        **_ultimo_mensaje_resumen(mensaje),
+        'total_mensajes': firestore.Increment(1),
+    }
+    # Solo los mensajes de otro origen cuentan como no leídos para soporte
+    if not mensaje.get('leido') and mensaje.get('origen') != ORIGEN_APP:
+        resumen['no_leidos'] = firestore.Increment(1)
+    return resumen
+
+
+def _nuevo_mensaje(empresa: str, usuario: str, mensaje: str) -> dict:
+    """Documento de un mensaje nuevo, con la fecha tomada una sola vez."""
+    momento = datetime.now()
+    return {
+        'fecha': momento.strftime("%Y-%m-%d %H:%M:%S"),
+        'timestamp': momento.timestamp(),
+        'usuario': usuario,
+        'mensaje': mensaje,
+        'empresa': empresa,
+        'leido': False,  # Explícito para que el conteo de no leídos lo filtre en el servidor
+        'origen': ORIGEN_APP  # Identificar de dónde viene el mensaje
+    }
+
+
+def _escribir_mensaje(db, empresa_key: str, nuevo_mensaje: dict, mensaje_id: str = None) -> str:
+    """
+    Guarda el mensaje y el resumen del chat en la misma escritura atómica.
+
+    El mensaje se crea (no se sobrescribe), así que reintentar con el mismo
+    `mensaje_id` no lo duplica ni vuelve a sumar en el resumen: Firestore
+    responde AlreadyExists. 'timestamp' (numérico, el mismo que usa CLIENTE)
+    ordena y pagina; 'timestamp_servidor' registra la hora del servidor.
+
+    Returns:
+        ID del documento del mensaje
+    """
+    chat_ref = db.collection('chats').document(empresa_key)
+    doc_ref = chat_ref.collection('mensajes').document(mensaje_id)
+    lote = db.batch()
+    lote.create(doc_ref, {**nuevo_mensaje, 'timestamp_servidor': firestore.SERVER_TIMESTAMP})
+    lote.set(chat_ref, _resumen_chat(nuevo_mensaje), merge=True)
+    lote.commit()
+    return doc_ref.id
+
+
+def _mensaje_guardado(empresa_key: str, nuevo_mensaje: dict, mensaje_id: str):
+    """Refleja un mensaje ya escrito en la copia local del chat sin volver a leerlo."""
+    with _lock_chats:
+        chat = _chats_sincronizados.get(empresa_key)
+    if chat is not None and chat['cargado']:
+        _agregar_a_cache(chat, [{**nuevo_mensaje, 'id': mensaje_id}], avanzar_marca=False)
+        chat['sincronizado'] = 0.0  # sin listener, el próximo mensajes_chat sondea
+
+
 def enviar_mensaje(empresa: str, usuario: str, mensaje: str) -> bool:
     """
-    Envía un mensaje al chat de una empresa.
+    Envía un mensaje al chat de una empresa (esperando la escritura).
+
+    Para no bloquear la interfaz, ver encolar_mensaje.
     
     Args:
         empresa: Nombre de la empresa (identificador del chat)
@@ -146,21 +298,11 @@ def enviar_mensaje(empresa: str, usuario: str, mensaje: str) -> bool:
         
         # Usar la misma normalización que el lado CLIENTE
         empresa_key = normalizar_nombre_empresa(empresa)
+        nuevo_mensaje = _nuevo_mensaje(empresa, usuario, mensaje)
+        mensaje_id = _escribir_mensaje(db, empresa_key, nuevo_mensaje)
         
-        # Usar la misma colección 'chat' que el lado CLIENTE
-        nuevo_mensaje = {
-            'fecha': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'timestamp': datetime.now().timestamp(),
-            'usuario': usuario,
-            'mensaje': mensaje,
-            'empresa': empresa,
-            'origen': 'detek_procompany'  # Identificar de dónde viene el mensaje
-        }
-        
-        # Agregar mensaje a la colección
-        doc_ref = db.collection('chats').document(empresa_key).collection('mensajes').add(nuevo_mensaje)
-        
-        print(f"Mensaje enviado con ID: {doc_ref[1].id}")
+        print(f"Mensaje enviado con ID: {mensaje_id}")
+        _mensaje_guardado(empresa_key, nuevo_mensaje, mensaje_id)
         _firebase_last_error = ""
         return True
     
@@ -170,43 +312,197 @@ def enviar_mensaje(empresa: str, usuario: str, mensaje: str) -> bool:
         return False
 
 
-def obtener_mensajes(empresa: str, limite: int = 50) -> list:
+def _procesar_envios():
+    """Hilo de envíos: escribe los mensajes en orden, con reintentos y espera creciente."""
+    global _firebase_last_error
+    while True:
+        empresa_key, envio = _cola_envios.get()
+        estado, error = 'fallido', ''
+        for intento in range(REINTENTOS_ENVIO):
+            with _lock_envios:
+                envio['intentos'] += 1
+            try:
+                db = obtener_db()
+                if db is None:
+                    raise RuntimeError("Firebase no inicializado")
+                _escribir_mensaje(db, empresa_key, envio['documento'], envio['id'])
+                estado = 'enviado'
+            except Exception as e:
+                if AlreadyExists is not None and isinstance(e, AlreadyExists):
+                    estado = 'enviado'  # un intento anterior sí llegó
+                else:
+                    error = f"Error al enviar mensaje: {e}"
+                    print(error)
+                    if intento + 1 < REINTENTOS_ENVIO:
+                        time.sleep(ESPERA_REINTENTO_ENVIO * 2 ** intento)
+                        continue
+            break
+        if estado == 'enviado':
+            _mensaje_guardado(empresa_key, envio['documento'], envio['id'])
+        else:
+            _firebase_last_error = error
+        with _lock_envios:
+            envio['estado'], envio['error'] = estado, error
+        _cola_envios.task_done()
+
+
+def _iniciar_hilo_envios():
+    global _hilo_envios
+    with _lock_envios:
+        if _hilo_envios is None or not _hilo_envios.is_alive():
+            _hilo_envios = threading.Thread(target=_procesar_envios, name="envios-chat", daemon=True)
+            _hilo_envios.start()
+
+
+def encolar_mensaje(empresa: str, usuario: str, mensaje: str) -> dict:
     """
-    Obtiene los mensajes del chat de una empresa.
-    
+    Envía un mensaje sin esperar a Firestore.
+
+    El mensaje queda visible de inmediato en envios_chat con estado
+    'pendiente' y un hilo en segundo plano lo escribe (hasta REINTENTOS_ENVIO
+    intentos); después pasa a 'enviado' o 'fallido'. El ID del documento se
+    genera localmente, así que el listener del chat lo reconoce como el mismo
+    mensaje.
+
+    Args:
+        empresa: Nombre de la empresa (identificador del chat)
+        usuario: Nombre del usuario que envía el mensaje
+        mensaje: Contenido del mensaje
+
+    Returns:
+        Copia del envío (con 'id' y 'estado'), o None si Firebase no está disponible
+    """
+    db = obtener_db()
+    if db is None:
+        return None
+
+    empresa_key = normalizar_nombre_empresa(empresa)
+    nuevo_mensaje = _nuevo_mensaje(empresa, usuario, mensaje)
+    mensaje_id = db.collection('chats').document(empresa_key).collection('mensajes').document().id
+    envio = {'id': mensaje_id, 'documento': nuevo_mensaje, 'estado': 'pendiente', 'intentos': 0, 'error': ''}
+
+    with _lock_envios:
+        envios = _envios.setdefault(empresa_key, OrderedDict())
+        envios[mensaje_id] = envio
+        # Los envíos terminados más antiguos se olvidan; los pendientes nunca
+        for clave in [c for c, e in envios.items() if e['estado'] != 'pendiente'][:max(0, len(envios) - MAX_ENVIOS_POR_CHAT)]:
+            del envios[clave]
+    _cola_envios.put((empresa_key, envio))
+    _iniciar_hilo_envios()
+    return _como_envio(envio)
+
+
+def reintentar_envio(empresa: str, mensaje_id: str) -> bool:
+    """Vuelve a encolar un envío fallido. Returns: True si se encoló."""
+    empresa_key = normalizar_nombre_empresa(empresa)
+    with _lock_envios:
+        envio = _envios.get(empresa_key, {}).get(mensaje_id)
+        if envio is None or envio['estado'] != 'fallido':
+            return False
+        envio['estado'], envio['error'] = 'pendiente', ''
+    _cola_envios.put((empresa_key, envio))
+    _iniciar_hilo_envios()
+    return True
+
+
+def _como_envio(envio: dict) -> dict:
+    return {**envio['documento'], 'id': envio['id'], 'estado': envio['estado'], 'error': envio['error']}
+
+
+def envios_chat(empresa: str) -> list:
+    """
+    Mensajes enviados desde esta app con encolar_mensaje y su estado.
+
+    Returns:
+        Lista de mensajes (con 'id', 'estado' = 'pendiente', 'enviado' o
+        'fallido', y 'error') en orden de envío
+    """
+    empresa_key = normalizar_nombre_empresa(empresa)
+    with _lock_envios:
+        return [_como_envio(envio) for envio in _envios.get(empresa_key, {}).values()]
+
+
+def cursor_mensaje(mensaje: dict) -> dict:
+    """Cursor de paginación (timestamp e ID del documento) a partir de un mensaje."""
+    return {'timestamp': mensaje.get('timestamp') or 0, 'id': mensaje['id']}
+
+
+def obtener_pagina_mensajes(empresa: str, tamano: int = TAMANO_PAGINA_MENSAJES,
+                            antes: dict = None, despues: dict = None) -> dict:
+    """
+    Obtiene una página del historial del chat, de los más recientes hacia atrás.
+
+    La consulta ordena por timestamp descendente (con el ID del documento como
+    desempate) y corta con start_after/end_before, así que abrir un chat largo
+    solo lee `tamano` documentos y siempre muestra la conversación actual.
+
     Args:
         empresa: Nombre de la empresa
-        limite: Número máximo de mensajes a obtener
-    
+        tamano: Mensajes por página
+        antes: Cursor (ver cursor_mensaje); devuelve los mensajes anteriores a él
+        despues: Cursor; devuelve los mensajes posteriores a él
+
     Returns:
-        Lista de diccionarios con los mensajes
+        Diccionario con 'mensajes' (en orden cronológico para mostrar),
+        'anterior' (cursor para pedir la página previa, o None si no hay más)
+        y 'siguiente' (cursor del mensaje más reciente de la página, o None)
     """
     global _firebase_last_error
+    vacia = {'mensajes': [], 'anterior': None, 'siguiente': None}
     try:
         db = obtener_db()
         if db is None:
-            return []
-        
-        # Usar la misma normalización que el lado CLIENTE
+            return vacia
+
         empresa_key = normalizar_nombre_empresa(empresa)
-        
-        # Usar la colección 'chats'
         mensajes_ref = db.collection('chats').document(empresa_key).collection('mensajes')
-        mensajes = mensajes_ref.order_by('timestamp').limit(limite).stream()
-        
-        resultado = []
-        for msg in mensajes:
-            data = msg.to_dict()
-            data['id'] = msg.id
-            resultado.append(data)
-        
+        consulta = (
+            mensajes_ref.order_by('timestamp', direction=firestore.Query.DESCENDING)
+            .order_by('__name__', direction=firestore.Query.DESCENDING)
+        )
+
+        def valores(cursor):
+            return {'timestamp': cursor['timestamp'], '__name__': mensajes_ref.document(cursor['id'])}
+
+        if despues is not None:
+            # Los `tamano` inmediatamente posteriores al cursor (los más cercanos a él)
+            consulta = consulta.end_before(valores(despues)).limit_to_last(tamano)
+            documentos = consulta.get()
+            hay_anteriores = True
+        else:
+            if antes is not None:
+                consulta = consulta.start_after(valores(antes))
+            # Un documento extra indica si quedan páginas anteriores
+            documentos = list(consulta.limit(tamano + 1).stream())
+            hay_anteriores = len(documentos) > tamano
+            documentos = documentos[:tamano]
+
+        mensajes = [_como_mensaje(doc) for doc in documentos][::-1]
         _firebase_last_error = ""
-        return resultado
-    
+        return {
+            'mensajes': mensajes,
+            'anterior': cursor_mensaje(mensajes[0]) if mensajes and hay_anteriores else None,
+            'siguiente': cursor_mensaje(mensajes[-1]) if mensajes else despues,
+        }
+
     except Exception as e:
         _firebase_last_error = f"Error al obtener mensajes: {e}"
         print(_firebase_last_error)
-        return []
+        return vacia
+
+
+def obtener_mensajes(empresa: str, limite: int = 50) -> list:
+    """
+    Obtiene los últimos mensajes del chat de una empresa.
+    
+    Args:
+        empresa: Nombre de la empresa
+        limite: Número máximo de mensajes a obtener
+    
+    Returns:
+        Lista de diccionarios con los mensajes, en orden cronológico
+    """
+    return obtener_pagina_mensajes(empresa, tamano=limite)['mensajes']
 
 
 def obtener_ultimo_mensaje(empresa: str) -> dict:
@@ -243,77 +539,257 @@ def obtener_ultimo_mensaje(empresa: str) -> dict:
         return None
 
 
-def marcar_mensajes_leidos(empresa: str):
+def marcar_mensajes_leidos(empresa: str) -> int:
     """
-    Marca todos los mensajes de un chat como leídos.
-    
+    Marca como leídos los mensajes no leídos de un chat, en lotes de escritura.
+
+    El estado de lectura es por documento (leido == True). Se leen los que
+    tienen leido == False y, como CLIENTE no escribe el campo 'leido', los que
+    no lo tienen desde la última marca ('leidos_hasta' en el documento del
+    chat, la hora de la marca anterior) menos MARGEN_RELOJ_CLIENTE. Si los
+    conteos del servidor dicen que aún quedan mensajes sin leer (un CLIENTE con
+    el reloj muy atrasado), se revisa el campo 'leido' de todo el chat. Las
+    actualizaciones se confirman en WriteBatch de hasta TAMANO_LOTE_ESCRITURA.
+
     Args:
         empresa: Nombre de la empresa
+
+    Returns:
+        Número de mensajes actualizados
     """
     try:
         db = obtener_db()
         if db is None:
-            return
+            return 0
         
         # Usar la misma normalización que el lado CLIENTE
         empresa_key = normalizar_nombre_empresa(empresa)
         
         # Usar la colección 'chats'
-        mensajes_ref = db.collection('chats').document(empresa_key).collection('mensajes')
-        
-        # Obtener todos los mensajes (ya que CLIENTE no usa campo 'leido')
-        mensajes = mensajes_ref.stream()
-        
-        # Para compatibilidad, podríamos agregar el campo 'leido' si no existe
-        for msg in mensajes:
-            data = msg.to_dict()
-            if 'leido' not in data:
-                msg.reference.update({'leido': True})
+        chat_ref = db.collection('chats').document(empresa_key)
+        mensajes_ref = chat_ref.collection('mensajes')
+        # La marca es la hora de esta lectura, no el timestamp de los mensajes:
+        # un mensaje con el reloj adelantado no la mueve al futuro
+        marca = time.time()
+        chat_doc = chat_ref.get()
+        leidos_hasta = (chat_doc.to_dict() or {}).get('leidos_hasta') if chat_doc.exists else None
+
+        pendientes = {msg.id: msg.reference for msg in _donde(mensajes_ref, 'leido', '==', False).stream()}
+        recientes = (mensajes_ref if leidos_hasta is None
+                     else _donde(mensajes_ref, 'timestamp', '>', leidos_hasta - MARGEN_RELOJ_CLIENTE))
+        for msg in recientes.stream():
+            if 'leido' not in msg.to_dict():
+                pendientes[msg.id] = msg.reference
+
+        if leidos_hasta is not None:
+            total = _contar(mensajes_ref)
+            leidos = _contar(_donde(mensajes_ref, 'leido', '==', True)) if total else 0
+            if total - leidos > len(pendientes):
+                for msg in mensajes_ref.select(['leido']).stream():
+                    if msg.to_dict().get('leido') is not True:
+                        pendientes[msg.id] = msg.reference
+
+        referencias = list(pendientes.values())
+        for inicio in range(0, len(referencias), TAMANO_LOTE_ESCRITURA):
+            lote = db.batch()
+            for referencia in referencias[inicio:inicio + TAMANO_LOTE_ESCRITURA]:
+                lote.update(referencia, {'leido': True})
+            lote.commit()
+
+        chat_ref.set({'no_leidos': 0, 'leidos_hasta': marca}, merge=True)
+        _no_leidos_en_cero(empresa_key)
+        return len(referencias)
     
     except Exception as e:
         print(f"Error al marcar mensajes como leídos: {e}")
+        return 0
 
 
-def contar_mensajes_no_leidos(empresa: str) -> int:
+def _no_leidos_chat(db, empresa_key: str) -> int:
     """
-    Cuenta los mensajes no leídos de una empresa.
-    Nota: CLIENTE no usa campo 'leido', así que cuenta mensajes sin este campo.
-    
+    No leídos de un chat con agregaciones count() en el servidor.
+
+    Los mensajes de CLIENTE no traen el campo 'leido', así que no se pueden
+    filtrar con leido == False: los no leídos son el total menos los que
+    tienen leido == True, sin contar los que escribió esta app
+    (origen == ORIGEN_APP). Son de dos a cuatro count() que no descargan
+    documentos.
+    """
+    mensajes_ref = db.collection('chats').document(empresa_key).collection('mensajes')
+    total = _contar(mensajes_ref)
+    leidos = _contar(_donde(mensajes_ref, 'leido', '==', True)) if total else 0
+    propios_ref = _donde(mensajes_ref, 'origen', '==', ORIGEN_APP)
+    propios = _contar(propios_ref) if total > leidos else 0
+    propios_sin_leer = propios - _contar(_donde(propios_ref, 'leido', '==', True)) if propios else 0
+    return max(0, total - leidos - propios_sin_leer)
+
+
+def _conteos_no_leidos(db, claves: list) -> dict:
+    """
+    No leídos de varios chats con una sola consulta para los ya marcados.
+
+    Los chats con marca de lectura ('leidos_hasta', ver
+    marcar_mensajes_leidos) se cuentan con una consulta collection_group
+    sobre 'mensajes' desde la marca más antigua (menos MARGEN_RELOJ_CLIENTE),
+    agrupando en el cliente los que no son leido == True ni de esta app.
+    Los que nunca se marcaron no tienen ventana y se cuentan con count()
+    (_no_leidos_chat), en paralelo.
+
+    Returns:
+        Diccionario {empresa_key: no leídos} (los chats que fallaron no aparecen)
+    """
+    resumenes = {doc.id: doc.to_dict() or {} for doc in db.collection('chats').stream()}
+    marcas = {clave: resumen.get('leidos_hasta') for clave, resumen in resumenes.items()}
+    con_marca = [clave for clave in claves if isinstance(marcas.get(clave), (int, float))]
+    conteos = dict.fromkeys(con_marca, 0)
+    if con_marca:
+        desde = min(marcas[clave] for clave in con_marca) - MARGEN_RELOJ_CLIENTE
+        ultimos = {}
+        for msg in _donde(db.collection_group('mensajes'), 'timestamp', '>', desde).stream():
+            clave = msg.reference.parent.parent.id
+            if clave not in conteos:
+                continue
+            data = msg.to_dict()
+            if data.get('leido') is not True and data.get('origen') != ORIGEN_APP:
+                conteos[clave] += 1
+            if (data.get('timestamp') or 0) > (ultimos.get(clave, {}).get('timestamp') or 0):
+                ultimos[clave] = data
+        _actualizar_resumenes(db, resumenes, conteos, ultimos)
+
+    sin_marca = [clave for clave in claves if clave not in conteos]
+    if sin_marca:
+        def contar(clave):
+            try:
+                return clave, _no_leidos_chat(db, clave)
+            except Exception as e:
+                print(f"Error al contar mensajes: {e}")
+                return clave, None
+
+        with ThreadPoolExecutor(max_workers=min(HILOS_CONTEO_NO_LEIDOS, len(sin_marca))) as hilos:
+            conteos.update((clave, total) for clave, total in hilos.map(contar, sin_marca) if total is not None)
+    return conteos
+
+
+def _actualizar_resumenes(db, resumenes: dict, conteos: dict, ultimos: dict):
+    """
+    Corrige los resúmenes de chat que quedaron atrás por mensajes de CLIENTE
+    (que no actualiza 'ultimo_timestamp' ni 'no_leidos'). Solo escribe los
+    que cambiaron, en lotes de hasta TAMANO_LOTE_ESCRITURA.
+    """
+    cambios = []
+    for clave, no_leidos in conteos.items():
+        resumen = resumenes.get(clave, {})
+        cambio = {} if resumen.get('no_leidos') == no_leidos else {'no_leidos': no_leidos}
+        ultimo = ultimos.get(clave)
+        if ultimo is not None and (ultimo.get('timestamp') or 0) > (resumen.get('ultimo_timestamp') or 0):
+            cambio.update(_ultimo_mensaje_resumen(ultimo))
+        if cambio:
+            cambios.append((db.collection('chats').document(clave), cambio))
+    for inicio in range(0, len(cambios), TAMANO_LOTE_ESCRITURA):
+        lote = db.batch()
+        for referencia, cambio in cambios[inicio:inicio + TAMANO_LOTE_ESCRITURA]:
+            lote.set(referencia, cambio, merge=True)
+        lote.commit()
+
+
+def _refrescar_no_leidos():
+    """Hilo de refresco: recuenta todas las empresas pedidas y reemplaza la caché."""
+    with _lock_no_leidos:
+        claves = sorted(_estado_no_leidos['claves'])
+        _estado_no_leidos['refrescado'] = time.monotonic()
+    try:
+        db = obtener_db()
+        if db is None:
+            return
+        conteos = _conteos_no_leidos(db, claves)
+        with _lock_no_leidos:
+            _cache_no_leidos.update(conteos)
+    except Exception as e:
+        print(f"Error al contar mensajes: {e}")
+
+
+def contar_mensajes_no_leidos(empresa: str, usar_cache: bool = True) -> int:
+    """
+    Cuenta los mensajes de la empresa que soporte no ha leído.
+
+    Con la caché es el mismo valor que contar_no_leidos_por_empresa (el
+    indicador del selector y el del chat coinciden). Sin caché se cuenta solo
+    este chat con count() en el servidor (ver _no_leidos_chat).
+
     Args:
         empresa: Nombre de la empresa
-    
+        usar_cache: False para consultar en este momento
+
     Returns:
-        Número de mensajes no leídos (sin campo 'leido')
+        Número de mensajes no leídos
     """
+    empresa_key = normalizar_nombre_empresa(empresa)
+    if usar_cache:
+        return contar_no_leidos_por_empresa([empresa]).get(empresa_key, 0)
     try:
         db = obtener_db()
         if db is None:
             return 0
-        
-        # Usar la misma normalización que el lado CLIENTE
-        empresa_key = normalizar_nombre_empresa(empresa)
-        
-        # Usar la colección 'chats'
-        mensajes_ref = db.collection('chats').document(empresa_key).collection('mensajes')
-        mensajes = mensajes_ref.stream()
-        
-        # Contar mensajes que no tienen el campo 'leido' (compatibilidad con CLIENTE)
-        count = 0
-        for msg in mensajes:
-            data = msg.to_dict()
-            if 'leido' not in data or not data.get('leido', False):
-                count += 1
-        
-        return count
-    
+        total = _no_leidos_chat(db, empresa_key)
+        with _lock_no_leidos:
+            _cache_no_leidos[empresa_key] = total
+        return total
     except Exception as e:
         print(f"Error al contar mensajes: {e}")
         return 0
 
 
-def obtener_chats_activos() -> list:
+def contar_no_leidos_por_empresa(empresas, usar_cache: bool = True) -> dict:
     """
-    Obtiene la lista de todos los chats activos (empresas con mensajes).
+    Cuenta los mensajes no leídos de varias empresas a la vez.
+
+    Devuelve de inmediato los últimos conteos conocidos y, si tienen más de
+    TTL_NO_LEIDOS segundos o falta alguna empresa, lanza un único refresco en
+    segundo plano (ver _conteos_no_leidos): la página nunca espera a
+    Firestore y las empresas sin conteo todavía aparecen con 0.
+
+    Args:
+        empresas: Nombres de las empresas
+        usar_cache: False para contar en este hilo y esperar el resultado
+
+    Returns:
+        Diccionario {empresa_key: no leídos}
+    """
+    claves = list(dict.fromkeys(normalizar_nombre_empresa(e) for e in empresas if isinstance(e, str) and e))
+    if not usar_cache:
+        try:
+            db = obtener_db()
+            conteos = _conteos_no_leidos(db, claves) if db is not None else {}
+        except Exception as e:
+            print(f"Error al contar mensajes: {e}")
+            conteos = {}
+        with _lock_no_leidos:
+            _cache_no_leidos.update(conteos)
+        return {clave: conteos.get(clave, 0) for clave in claves}
+
+    with _lock_no_leidos:
+        nuevas = not _estado_no_leidos['claves'].issuperset(claves)
+        _estado_no_leidos['claves'].update(claves)
+        hilo = _estado_no_leidos['hilo']
+        vencido = time.monotonic() - _estado_no_leidos['refrescado'] >= TTL_NO_LEIDOS
+        if (nuevas or vencido) and (hilo is None or not hilo.is_alive()):
+            hilo = threading.Thread(target=_refrescar_no_leidos, name="no-leidos-chat", daemon=True)
+            _estado_no_leidos['hilo'] = hilo
+            hilo.start()
+        return {clave: _cache_no_leidos.get(clave, 0) for clave in claves}
+
+
+def obtener_chats_activos(limite: int = None) -> list:
+    """
+    Obtiene la lista de todos los chats activos (empresas con mensajes), el más reciente primero.
+
+    Lee los documentos de resumen de 'chats' (ver _resumen_chat) y no consulta
+    los mensajes. Los chats sin 'ultimo_timestamp' (creados antes del resumen o
+    escritos solo por CLIENTE, que pueden no tener documento) se reconstruyen
+    una vez con reconstruir_resumen_chat.
+
+    Args:
+        limite: Máximo de chats a devolver (None para todos)
     
     Returns:
         Lista de diccionarios con información de cada chat
@@ -323,30 +799,27 @@ def obtener_chats_activos() -> list:
         if db is None:
             return []
         
-        # Obtener todas las empresas que tienen mensajes en la colección 'chats'
-        empresas_ref = db.collection('chats')
-        empresas = empresas_ref.stream()
+        chats_ref = db.collection('chats')
+        resumenes = {chat_doc.id: chat_doc.to_dict() or {} for chat_doc in chats_ref.stream()}
+        # list_documents incluye los chats sin documento propio (solo la subcolección)
+        for referencia in chats_ref.list_documents():
+            if resumenes.get(referencia.id, {}).get('ultimo_timestamp') is None and reconstruir_resumen_chat(referencia.id):
+                resumenes[referencia.id] = referencia.get().to_dict() or {}
+        ordenados = sorted(
+            (item for item in resumenes.items() if item[1].get('ultimo_timestamp') is not None),
+            key=lambda item: item[1]['ultimo_timestamp'], reverse=True,
+        )
         
         resultado = []
-        for empresa_doc in empresas:
-            # Verificar si tiene mensajes
-            mensajes_ref = empresa_doc.reference.collection('mensajes')
-            mensajes_count = sum(1 for _ in mensajes_ref.limit(1).stream())
-            
-            if mensajes_count > 0:
-                # Obtener el último mensaje para info
-                ultimo_msg = None
-                for msg in mensajes_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).stream():
-                    ultimo_msg = msg.to_dict()
-                    ultimo_msg['id'] = msg.id
-                    break
-                
-                resultado.append({
-                    'empresa_key': empresa_doc.id,
-                    'empresa': ultimo_msg.get('empresa', empresa_doc.id) if ultimo_msg else empresa_doc.id,
-                    'ultimo_mensaje': ultimo_msg,
-                    'activo': True
-                })
+        for empresa_key, resumen in ordenados[:limite] if limite else ordenados:
+            resultado.append({
+                'empresa_key': empresa_key,
+                'empresa': resumen.get('empresa') or empresa_key,
+                'ultimo_mensaje': {**resumen.get('ultimo_mensaje', {}), 'timestamp': resumen.get('ultimo_timestamp')},
+                'total_mensajes': resumen.get('total_mensajes', 0),
+                'no_leidos': resumen.get('no_leidos', 0),
+                'activo': True
+            })
         
         return resultado
     
@@ -355,6 +828,217 @@ def obtener_chats_activos() -> list:
         return []
 
 
+def reconstruir_resumen_chat(empresa: str) -> bool:
+    """
+    Recalcula el resumen de un chat desde sus mensajes (chats creados antes del
+    resumen o escritos solo por CLIENTE).
+
+    Args:
+        empresa: Nombre de la empresa
+
+    Returns:
+        True si se guardó el resumen
+    """
+    try:
+        db = obtener_db()
+        if db is None:
+            return False
+
+        empresa_key = normalizar_nombre_empresa(empresa)
+        chat_ref = db.collection('chats').document(empresa_key)
+        mensajes_ref = chat_ref.collection('mensajes')
+        ultimo = obtener_ultimo_mensaje(empresa)
+        if ultimo is None:
+            return False
+
+        resumen = _resumen_chat(ultimo)
+        resumen['empresa'] = ultimo.get('empresa', empresa)
+        resumen['total_mensajes'] = _contar(mensajes_ref)
+        resumen['no_leidos'] = contar_mensajes_no_leidos(empresa, usar_cache=False)
+        chat_ref.set(resumen, merge=True)
+        return True
+
+    except Exception as e:
+        print(f"Error al reconstruir el resumen del chat: {e}")
+        return False
+
+
+# --- SINCRONIZACIÓN INCREMENTAL DE MENSAJES ---
+def _agregar_a_cache(chat: dict, mensajes: list, avanzar_marca: bool = True):
+    """
+    Inserta o actualiza mensajes en la copia local, ordenada por timestamp y acotada.
+
+    Con avanzar_marca=False (mensajes propios recién escritos) no se mueve
+    'ultimo_timestamp', para que el sondeo siga trayendo los de CLIENTE
+    anteriores a ellos.
+    """
+    with chat['lock']:
+        por_id = {m['id']: m for m in chat['mensajes']}
+        for mensaje in mensajes:
+            por_id[mensaje['id']] = mensaje
+        ordenados = sorted(por_id.values(), key=lambda m: m.get('timestamp') or 0)
+        chat['mensajes'] = ordenados[-MAX_MENSAJES_POR_CHAT:]
+        if chat['mensajes'] and avanzar_marca:
+            chat['ultimo_timestamp'] = max(chat['ultimo_timestamp'] or 0, chat['mensajes'][-1].get('timestamp') or 0)
+
+
+def _quitar_de_cache(chat: dict, ids: set):
+    with chat['lock']:
+        chat['mensajes'] = [m for m in chat['mensajes'] if m['id'] not in ids]
+
+
+def _como_mensaje(doc) -> dict:
+    data = doc.to_dict()
+    data['id'] = doc.id
+    return data
+
+
+def _escuchar(chat: dict, mensajes_ref):
+    """
+    Suscribe un listener on_snapshot a los mensajes posteriores al último visto.
+
+    Returns:
+        El Watch de Firestore, o None si no se pudo (se usa sondeo)
+    """
+    def al_cambiar(_documentos, cambios, _momento):
+        nuevos, quitados = [], set()
+        for cambio in cambios:
+            if cambio.type.name == 'REMOVED':
+                quitados.add(cambio.document.id)
+            else:
+                nuevos.append(_como_mensaje(cambio.document))
+        if nuevos:
+            _agregar_a_cache(chat, nuevos)
+        if quitados:
+            _quitar_de_cache(chat, quitados)
+        chat['sincronizado'] = time.monotonic()
+
+    try:
+        consulta = _donde(mensajes_ref, 'timestamp', '>', chat['ultimo_timestamp'] or 0)
+        return consulta.on_snapshot(al_cambiar)
+    except Exception as e:
+        print(f"Listener de chat no disponible, se usa sondeo: {e}")
+        return None
+
+
+def _sondear(chat: dict, mensajes_ref):
+    """Descarga solo los mensajes con timestamp mayor al último visto."""
+    consulta = _donde(mensajes_ref, 'timestamp', '>', chat['ultimo_timestamp'] or 0).order_by('timestamp')
+    nuevos = [_como_mensaje(msg) for msg in consulta.stream()]
+    if nuevos:
+        _agregar_a_cache(chat, nuevos)
+    chat['sincronizado'] = time.monotonic()
+
+
+def _cerrar_chat(chat: dict):
+    if chat.get('escucha') is not None:
+        try:
+            chat['escucha'].unsubscribe()
+        except Exception as e:
+            print(f"Error al cerrar listener de chat: {e}")
+
+
+def _expulsar_chats(conservar: str = None):
+    """Cierra los chats sin uso reciente y los que excedan MAX_CHATS_SINCRONIZADOS (LRU)."""
+    ahora = time.monotonic()
+    cerrados = []
+    with _lock_chats:
+        inactivos = [
+            c for c, chat in _chats_sincronizados.items()
+            if c != conservar and ahora - chat['usado'] > TTL_CHAT_INACTIVO
+        ]
+        for clave in inactivos:
+            cerrados.append(_chats_sincronizados.pop(clave))
+        while len(_chats_sincronizados) > MAX_CHATS_SINCRONIZADOS:
+            cerrados.append(_chats_sincronizados.popitem(last=False)[1])
+    for chat in cerrados:
+        _cerrar_chat(chat)
+
+
+def _expulsar_periodicamente():
+    """Hilo de expulsión: cierra los listeners inactivos aunque ninguna sesión abra chats; termina sin chats."""
+    global _hilo_expulsion
+    while True:
+        time.sleep(INTERVALO_EXPULSION)
+        _expulsar_chats()
+        with _lock_chats:
+            if not _chats_sincronizados:
+                _hilo_expulsion = None
+                return
+
+
+def _iniciar_hilo_expulsion():
+    """Arranca el hilo de expulsión si no está corriendo (se llama con _lock_chats tomado)."""
+    global _hilo_expulsion
+    if _hilo_expulsion is None or not _hilo_expulsion.is_alive():
+        _hilo_expulsion = threading.Thread(target=_expulsar_periodicamente, name="expulsion-chats", daemon=True)
+        _hilo_expulsion.start()
+
+
+def mensajes_chat(empresa: str, limite: int = 50, forzar: bool = False) -> list:
+    """
+    Mensajes recientes de una empresa desde la copia local sincronizada.
+
+    La primera vez descarga los últimos `limite` mensajes; después solo se
+    piden los que tengan timestamp mayor al último visto, empujados por un
+    listener on_snapshot o, si no hay listener, sondeando cada INTERVALO_SONDEO
+    segundos. Los chats sin uso se expulsan (LRU) en cada llamada y, aunque
+    nadie llame, cada INTERVALO_EXPULSION segundos desde un hilo.
+
+    Args:
+        empresa: Nombre de la empresa
+        limite: Máximo de mensajes a devolver (los más recientes)
+        forzar: Sondear ya aunque no haya pasado el intervalo
+
+    Returns:
+        Lista de mensajes en orden cronológico
+    """
+    global _firebase_last_error
+    try:
+        db = obtener_db()
+        if db is None:
+            return []
+
+        empresa_key = normalizar_nombre_empresa(empresa)
+        mensajes_ref = db.collection('chats').document(empresa_key).collection('mensajes')
+
+        with _lock_chats:
+            chat = _chats_sincronizados.get(empresa_key)
+            nuevo = chat is None
+            if nuevo:
+                chat = {
+                    'mensajes': [], 'ultimo_timestamp': None, 'cargado': False, 'sincronizado': 0.0,
+                    'escucha': None, 'lock': threading.Lock(), 'cargando': threading.Lock(),
+                }
+                _chats_sincronizados[empresa_key] = chat
+                _iniciar_hilo_expulsion()
+            chat['usado'] = time.monotonic()
+            _chats_sincronizados.move_to_end(empresa_key)
+
+        with chat['cargando']:
+            if not chat['cargado']:
+                # Carga inicial: los más recientes, invertidos para mostrarlos en orden
+                recientes = mensajes_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(limite)
+                _agregar_a_cache(chat, [_como_mensaje(msg) for msg in recientes.stream()])
+                chat['sincronizado'] = time.monotonic()
+                chat['cargado'] = True
+                chat['escucha'] = _escuchar(chat, mensajes_ref)
+            elif chat['escucha'] is None and (forzar or time.monotonic() - chat['sincronizado'] >= INTERVALO_SONDEO):
+                _sondear(chat, mensajes_ref)
+
+        # En cada sondeo o tick del fragmento, no solo al abrir un chat nuevo
+        _expulsar_chats(conservar=empresa_key)
+
+        _firebase_last_error = ""
+        with chat['lock']:
+            return list(chat['mensajes'][-limite:])
+
+    except Exception as e:
+        _firebase_last_error = f"Error al sincronizar mensajes: {e}"
+        print(_firebase_last_error)
+        return []
+
+
 # Función de prueba
 if __name__ == "__main__":
     print("Probando conexión a Firebase...")
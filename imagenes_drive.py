@@ -0,0 +1,239 @@
+"""
+Caché de Imágenes de Google Drive
+=================================
+Las fotos de equipos, el logo y las imágenes de actas se guardan en Drive a
+tamaño original. Este módulo descarga cada archivo una sola vez con la API de
+Drive, lo redimensiona con Pillow a unos pocos anchos (WebP, o JPEG si Pillow
+no soporta WebP) y guarda el resultado en disco con expulsión LRU por tamaño
+total. La app muestra la ruta local con st.image en lugar del enlace de Drive.
+
+Las descargas se hacen en hilos en segundo plano: mientras una imagen no está
+en caché, imagen_drive devuelve None al instante y la app muestra el enlace;
+la imagen aparece en un rerun posterior. Los archivos que no son imágenes
+quedan marcados en disco ('<id>.noimagen') y no se vuelven a descargar.
+
+El descargador es intercambiable (configurar(descargador=...)) para poder
+usar archivos locales sin credenciales.
+"""
+
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.discovery import build
+from PIL import Image, ImageOps, features
+
+from enlaces_drive import id_drive
+from sheets_api import llamar_api
+
+RUTA_CACHE_IMAGENES = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".detek_cache", "imagenes")
+
+# Anchos generados por cada imagen; se sirve el menor que cubra el pedido
+ANCHOS = (240, 480, 960)
+TAMANO_MAXIMO_CACHE = 200 * 1024 * 1024
+CALIDAD = 80
+# Tiempo antes de reintentar un archivo que no se pudo descargar
+ESPERA_REINTENTO = 300
+# Descargas simultáneas en segundo plano
+HILOS_DESCARGA = 2
+
+FORMATO, EXTENSION = ("WEBP", "webp") if features.check("webp") else ("JPEG", "jpg")
+
+_estado = {"descargador": None, "ruta": RUTA_CACHE_IMAGENES}
+_fallidos = {}
+_locks_archivo = {}
+_en_cola = set()
+_lock = threading.Lock()
+_descargas = ThreadPoolExecutor(max_workers=HILOS_DESCARGA, thread_name_prefix="imagenes-drive")
+
+
+def _credenciales(client):
+    """Credenciales del cliente gspread (compatible con gspread 5 y 6)."""
+    http_client = getattr(client, "http_client", None)
+    if http_client is not None:
+        return http_client.auth
+    return client.auth
+
+
+def descargador_drive(client):
+    """
+    Descargador que usa la API de Drive con las credenciales del cliente gspread.
+
+    Returns:
+        Función file_id -> bytes del archivo original
+    """
+    credenciales = _credenciales(client)
+    local = threading.local()  # los servicios de googleapiclient no son seguros entre hilos
+
+    def descargar(file_id: str) -> bytes:
+        if not hasattr(local, "servicio"):
+            local.servicio = build("drive", "v3", credentials=credenciales, cache_discovery=False)
+        peticion = local.servicio.files().get_media(fileId=file_id, supportsAllDrives=True)
+        return llamar_api(peticion.execute, tipo="drive")
+
+    return descargar
+
+
+def configurar(client=None, descargador=None, ruta: str = None):
+    """
+    Define de dónde se descargan las imágenes y dónde se guardan.
+
+    Args:
+        client: Cliente gspread autorizado (usa la API de Drive)
+        descargador: Función file_id -> bytes; tiene prioridad sobre `client`
+        ruta: Carpeta de la caché en disco
+    """
+    with _lock:
+        if descargador is not None:
+            _estado["descargador"] = descargador
+        elif client is not None:
+            _estado["descargador"] = descargador_drive(client)
+        if ruta is not None:
+            _estado["ruta"] = ruta
+        _fallidos.clear()
+
+
+def iniciar(client):
+    """Configura el descargador de Drive con el cliente de la app (una vez por proceso)."""
+    with _lock:
+        if _estado["descargador"] is not None:
+            return
+    configurar(client=client)
+
+
+def _ruta_imagen(file_id: str, ancho: int) -> str:
+    return os.path.join(_estado["ruta"], f"{file_id}_{ancho}.{EXTENSION}")
+
+
+def _ruta_no_imagen(file_id: str) -> str:
+    return os.path.join(_estado["ruta"], f"{file_id}.noimagen")
+
+
+def _ancho_servido(ancho: int) -> int:
+    return next((a for a in ANCHOS if a >= ancho), ANCHOS[-1])
+
+
+def redimensionar(datos: bytes, ancho: int) -> bytes:
+    """Reduce la imagen a `ancho` píxeles (sin agrandarla) y la recodifica."""
+    with Image.open(io.BytesIO(datos)) as original:
+        imagen = ImageOps.exif_transpose(original)
+        if imagen.width > ancho:
+            imagen = imagen.resize((ancho, max(1, round(imagen.height * ancho / imagen.width))), Image.LANCZOS)
+        if FORMATO == "JPEG" and imagen.mode not in ("RGB", "L"):
+            imagen = imagen.convert("RGB")
+        elif imagen.mode not in ("RGB", "RGBA", "L", "LA"):
+            imagen = imagen.convert("RGBA")
+        salida = io.BytesIO()
+        imagen.save(salida, FORMATO, quality=CALIDAD)
+        return salida.getvalue()
+
+
+def _guardar(ruta: str, datos: bytes):
+    tmp = f"{ruta}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(datos)
+    os.replace(tmp, ruta)
+
+
+def _expulsar(conservar: str = ""):
+    """Borra las imágenes usadas hace más tiempo (salvo las de `conservar`) hasta quedar bajo TAMANO_MAXIMO_CACHE."""
+    try:
+        entradas = [e for e in os.scandir(_estado["ruta"]) if e.is_file() and not e.name.endswith(".noimagen")]
+    except FileNotFoundError:
+        return
+    archivos = sorted((e.stat().st_mtime, e.stat().st_size, e.path) for e in entradas)
+    total = sum(tamano for _, tamano, _ in archivos)
+    for _, tamano, ruta in archivos:
+        if total <= TAMANO_MAXIMO_CACHE:
+            break
+        if conservar and os.path.basename(ruta).startswith(f"{conservar}_"):
+            continue
+        try:
+            os.remove(ruta)
+            total -= tamano
+        except OSError:
+            pass
+
+
+def _generar(file_id: str) -> bool:
+    """Descarga el archivo una vez y guarda todas sus versiones reducidas."""
+    descargador = _estado["descargador"]
+    if descargador is None:
+        return False
+    try:
+        original = descargador(file_id)
+    except Exception as e:
+        print(f"No se pudo descargar la imagen de Drive {file_id}: {e}")
+        with _lock:
+            _fallidos[file_id] = time.time()
+        return False
+    os.makedirs(_estado["ruta"], exist_ok=True)
+    try:
+        versiones = {ancho: redimensionar(original, ancho) for ancho in ANCHOS}
+    except Exception as e:
+        # No es una imagen (PDF, video...): se recuerda en disco para no volver a descargarlo
+        print(f"El archivo de Drive {file_id} no es una imagen: {e}")
+        _guardar(_ruta_no_imagen(file_id), b"")
+        return False
+    for ancho, datos in versiones.items():
+        _guardar(_ruta_imagen(file_id, ancho), datos)
+    _expulsar(conservar=file_id)
+    return True
+
+
+def _preparar(file_id: str, ruta: str) -> bool:
+    """Genera las versiones del archivo si faltan (una sola descarga por archivo a la vez)."""
+    with _lock:
+        lock_archivo = _locks_archivo.setdefault(file_id, threading.Lock())
+    with lock_archivo:
+        return os.path.exists(ruta) or _generar(file_id)
+
+
+def _preparar_en_segundo_plano(file_id: str, ruta: str):
+    try:
+        _preparar(file_id, ruta)
+    finally:
+        with _lock:
+            _en_cola.discard(file_id)
+
+
+def imagen_drive(url, ancho: int = 480, esperar: bool = False):
+    """
+    Ruta local de la imagen de Drive reducida al ancho pedido.
+
+    Args:
+        url: Enlace de Drive (cualquier formato con ID)
+        ancho: Ancho deseado en píxeles (se usa el menor de ANCHOS que lo cubra)
+        esperar: True para descargar en este hilo; por defecto la descarga se
+            encola en segundo plano y se devuelve None mientras tanto
+
+    Returns:
+        Ruta del archivo en caché, o None si aún no está, no es un enlace de
+        Drive, no hay descargador configurado o el archivo no es una imagen
+    """
+    if not isinstance(url, str) or not url.strip():
+        return None
+    file_id = id_drive(url)
+    if not file_id:
+        return None
+    ruta = _ruta_imagen(file_id, _ancho_servido(ancho))
+    if not os.path.exists(ruta):
+        if _estado["descargador"] is None or os.path.exists(_ruta_no_imagen(file_id)):
+            return None
+        with _lock:
+            if time.time() - _fallidos.get(file_id, 0) < ESPERA_REINTENTO:
+                return None
+            if not esperar:
+                if file_id not in _en_cola:
+                    _en_cola.add(file_id)
+                    _descargas.submit(_preparar_en_segundo_plano, file_id, ruta)
+                return None
+        if not _preparar(file_id, ruta):
+            return None
+    try:
+        os.utime(ruta)  # marca de uso para la expulsión LRU
+    except OSError:
+        return None
+    return ruta
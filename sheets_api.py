@@ -0,0 +1,534 @@
+"""
+Acceso a Google Sheets
+======================
+Lectura en lote de las hojas de la app: todas las pestañas de un libro se
+descargan con una sola llamada a `values:batchGet` y se convierten a registros
+(lista de diccionarios, igual que `get_all_records`) localmente. Los distintos
+libros se descargan en paralelo.
+
+Los manejadores de libros y pestañas (Spreadsheet/Worksheet) se abren una sola
+vez por proceso y se reutilizan; solo se reabren ante errores de autenticación
+o de hoja no encontrada.
+
+Todas las llamadas a la API pasan por llamar_api: un limitador de tipo
+"token bucket" (lecturas, escrituras y descargas de Drive por separado, según
+la cuota por minuto)
+hace esperar a las llamadas en lugar de agotar la cuota, y los errores 429 se
+reintentan con espera exponencial aleatorizada.
+
+Los datos descargados se sirven con una caché "stale-while-revalidate": siempre
+se devuelve al instante la última copia buena y, cuando envejece, se refresca
+en un hilo en segundo plano (un solo refresco a la vez por clave).
+"""
+
+import hashlib
+import pickle
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+from gspread.utils import numericise_all
+
+URL_BATCH_GET = "https://sheets.googleapis.com/v4/spreadsheets/{id}/values:batchGet"
+# Segundos de conexión y de lectura de la descarga en lote
+TIMEOUT_BATCH_GET = (10, 120)
+
+# Hojas que se crean automáticamente si no existen, con sus encabezados
+HOJAS_AUTOCREADAS = {
+    "Chat": ["fecha", "usuario", "mensaje", "empresa"],
+    "Tareas": ["empresa", "tarea", "asignada_por", "fecha_asignacion", "completada", "fecha_completada"],
+    # Eventos del candado del registro automático diario (ver detek_batch)
+    "Control": ["fecha", "estado", "token", "marca", "detalle"],
+}
+
+# Hojas cuyo encabezado no está necesariamente en la fila 1: se busca en las
+# primeras filas la que contenga esta celda
+ENCABEZADO_VARIABLE = {"Equipos": "empresa"}
+FILAS_BUSQUEDA_ENCABEZADO = 10
+
+# Cuota de Google Sheets por minuto y usuario (la cuenta de servicio es un solo usuario);
+# Drive tiene su propia cuota, así que sus descargas no gastan las lecturas de Sheets
+CUOTA_POR_MINUTO = {"lectura": 60, "escritura": 60, "drive": 300}
+REINTENTOS_CUOTA = 5
+ESPERA_MAXIMA_CUOTA = 64.0
+
+_cubetas = {
+    tipo: {"tokens": float(cuota), "actualizado": time.monotonic()}
+    for tipo, cuota in CUOTA_POR_MINUTO.items()
+}
+_lock_cubetas = threading.Lock()
+_estadisticas_api = {"llamadas": 0, "esperas": 0, "limitadas": 0, "segundos_espera": 0.0}
+
+# Manejadores abiertos: sheet_id -> Spreadsheet, (sheet_id, pestaña) -> Worksheet
+_libros = {}
+_hojas = {}
+_lock_hojas = threading.RLock()
+
+# Códigos HTTP tras los cuales se descartan los manejadores y se reabren
+CODIGOS_RECONEXION = (401, 404)
+
+# Copias de datos por clave y refrescos en curso (compartidos por todo el proceso)
+_snapshots = {}
+_refrescando = {}  # clave -> (inicio, token) del refresco en curso
+# Un refresco que lleva más que esto se da por colgado y se permite otro
+MAX_DURACION_REFRESCO = 300
+_lock_snapshots = threading.Lock()
+_locks_carga = {}
+
+
+def _tomar_token(tipo: str):
+    """Espera hasta que haya cupo en la cubeta del tipo de llamada y lo consume."""
+    cuota = CUOTA_POR_MINUTO[tipo]
+    espero = False
+    while True:
+        with _lock_cubetas:
+            cubeta = _cubetas[tipo]
+            ahora = time.monotonic()
+            cubeta["tokens"] = min(cuota, cubeta["tokens"] + (ahora - cubeta["actualizado"]) * cuota / 60.0)
+            cubeta["actualizado"] = ahora
+            if cubeta["tokens"] >= 1:
+                cubeta["tokens"] -= 1
+                _estadisticas_api["llamadas"] += 1
+                if espero:
+                    _estadisticas_api["esperas"] += 1
+                return
+            espera = (1 - cubeta["tokens"]) * 60.0 / cuota
+            _estadisticas_api["segundos_espera"] += espera
+        espero = True
+        time.sleep(espera)
+
+
+def _es_error_cuota(error: Exception) -> bool:
+    """True para errores 429 de gspread o de googleapiclient (Drive)."""
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error, "code", None) == 429
+    respuesta = getattr(error, "resp", None)  # googleapiclient.errors.HttpError
+    return getattr(respuesta, "status", None) == 429
+
+
+def llamar_api(funcion, *args, tipo: str = "lectura", **kwargs):
+    """
+    Ejecuta una llamada a Google Sheets/Drive respetando la cuota.
+
+    Args:
+        funcion: Función que hace la llamada
+        *args, **kwargs: Argumentos de `funcion`
+        tipo: 'lectura', 'escritura' o 'drive' (cubetas de cuota distintas)
+
+    Returns:
+        Lo que devuelva `funcion`
+    """
+    for intento in range(REINTENTOS_CUOTA + 1):
+        _tomar_token(tipo)
+        try:
+            return funcion(*args, **kwargs)
+        except Exception as e:
+            if not _es_error_cuota(e) or intento == REINTENTOS_CUOTA:
+                raise
+            espera = min(ESPERA_MAXIMA_CUOTA, 2 ** intento) * random.uniform(0.5, 1.5)
+            with _lock_cubetas:
+                _estadisticas_api["limitadas"] += 1
+                _estadisticas_api["segundos_espera"] += espera
+            time.sleep(espera)
+
+
+def estadisticas_api() -> dict:
+    """Contadores del limitador: llamadas, esperas por cuota local, 429 recibidos y segundos esperados."""
+    with _lock_cubetas:
+        return dict(_estadisticas_api)
+
+
+def _sesion_http(client):
+    """Sesión HTTP autorizada del cliente gspread (compatible con gspread 5 y 6)."""
+    http_client = getattr(client, "http_client", None)
+    if http_client is not None:
+        return http_client.session
+    return client.session
+
+
+def _rango(nombre: str) -> str:
+    """Rango A1 que cubre una pestaña completa."""
+    return "'{}'".format(nombre.replace("'", "''"))
+
+
+def detectar_encabezado(filas: list, celda_clave: str = None):
+    """
+    Busca la fila de encabezados y devuelve encabezados sin vacíos ni duplicados.
+
+    Args:
+        filas: Valores de la hoja (lista de filas)
+        celda_clave: Si se indica, se usa la primera de las primeras
+            FILAS_BUSQUEDA_ENCABEZADO filas que contenga esta celda
+
+    Returns:
+        Tupla (fila_encabezado, encabezados) con fila_encabezado basada en 1
+    """
+    fila_encabezado = 1
+    if celda_clave:
+        for i, fila in enumerate(filas[:FILAS_BUSQUEDA_ENCABEZADO], start=1):
+            if any(str(celda).strip().lower() == celda_clave for celda in fila):
+                fila_encabezado = i
+                break
+
+    crudos = filas[fila_encabezado - 1] if len(filas) >= fila_encabezado else []
+    vistos = set()
+    encabezados = []
+    for idx, h in enumerate(crudos):
+        h_limpio = h if h else f"col_{idx+1}"
+        while h_limpio in vistos or h_limpio == '':
+            h_limpio += f"_{idx+1}"
+        vistos.add(h_limpio)
+        encabezados.append(h_limpio)
+    return fila_encabezado, encabezados
+
+
+def registros_desde_valores(filas: list, celda_clave: str = None, encabezado: tuple = None) -> list:
+    """
+    Convierte los valores crudos de una hoja en registros, como `get_all_records`.
+
+    Args:
+        filas: Valores de la hoja (lista de filas, sin celdas vacías al final)
+        celda_clave: Ver detectar_encabezado
+        encabezado: Tupla (fila_encabezado, encabezados) ya detectada; evita
+            repetir la búsqueda
+
+    Returns:
+        Lista de diccionarios encabezado -> valor (números ya convertidos)
+    """
+    if not filas:
+        return []
+    if encabezado is not None:
+        fila_encabezado, encabezados = encabezado
+    elif celda_clave:
+        fila_encabezado, encabezados = detectar_encabezado(filas, celda_clave)
+    else:
+        fila_encabezado, encabezados = 1, filas[0]
+    ancho = len(encabezados)
+    registros = []
+    for fila in filas[fila_encabezado:]:
+        fila = list(fila[:ancho]) + [""] * (ancho - len(fila))
+        registros.append(dict(zip(encabezados, numericise_all(fila))))
+    return registros
+
+
+def _batch_get(client, sheet_id: str, nombres: list) -> dict:
+    """Una sola petición HTTP con todos los rangos; devuelve nombre -> filas."""
+    def pedir():
+        respuesta = _sesion_http(client).get(
+            URL_BATCH_GET.format(id=sheet_id),
+            params={"ranges": [_rango(n) for n in nombres], "majorDimension": "ROWS"},
+            timeout=TIMEOUT_BATCH_GET,
+        )
+        if respuesta.status_code != 200:
+            raise gspread.exceptions.APIError(respuesta)
+        return respuesta.json()
+
+    rangos = llamar_api(pedir).get("valueRanges", [])
+    return {nombre: rango.get("values", []) for nombre, rango in zip(nombres, rangos)}
+
+
+def obtener_libro(client, sheet_id: str):
+    """Devuelve el Spreadsheet abierto una sola vez por proceso."""
+    with _lock_hojas:
+        libro = _libros.get(sheet_id)
+        if libro is None:
+            libro = llamar_api(client.open_by_key, sheet_id)
+            _libros[sheet_id] = libro
+        return libro
+
+
+def obtener_hoja(client, sheet_id: str, nombre: str):
+    """
+    Devuelve el Worksheet de una pestaña, abriéndolo solo la primera vez.
+
+    Las hojas de HOJAS_AUTOCREADAS ('Chat', 'Tareas', 'Control') se crean con sus
+    encabezados si no existen.
+
+    Args:
+        client: Cliente gspread autorizado
+        sheet_id: ID del libro
+        nombre: Nombre de la pestaña
+
+    Returns:
+        gspread.Worksheet
+    """
+    with _lock_hojas:
+        hoja = _hojas.get((sheet_id, nombre))
+        if hoja is not None:
+            return hoja
+        libro = obtener_libro(client, sheet_id)
+        try:
+            hoja = llamar_api(libro.worksheet, nombre)
+        except gspread.exceptions.WorksheetNotFound:
+            if nombre not in HOJAS_AUTOCREADAS:
+                raise
+            encabezados = HOJAS_AUTOCREADAS[nombre]
+            hoja = llamar_api(libro.add_worksheet, title=nombre, rows="1000", cols=str(len(encabezados)), tipo="escritura")
+            llamar_api(hoja.append_row, encabezados, tipo="escritura")
+        _hojas[(sheet_id, nombre)] = hoja
+        return hoja
+
+
+def olvidar_manejadores(sheet_id: str = None):
+    """Descarta los manejadores abiertos (de un libro o de todos) para forzar reconexión."""
+    with _lock_hojas:
+        for clave in [c for c in _libros if sheet_id is None or c == sheet_id]:
+            del _libros[clave]
+        for clave in [c for c in _hojas if sheet_id is None or c[0] == sheet_id]:
+            del _hojas[clave]
+
+
+def _requiere_reconexion(error: Exception) -> bool:
+    if isinstance(error, (gspread.exceptions.WorksheetNotFound, gspread.exceptions.SpreadsheetNotFound)):
+        return True
+    return isinstance(error, gspread.exceptions.APIError) and getattr(error, "code", None) in CODIGOS_RECONEXION
+
+
+def ejecutar_en_hoja(client, sheet_id: str, nombre: str, operacion, tipo: str = "escritura"):
+    """
+    Ejecuta `operacion(worksheet)` con el manejador cacheado, respetando la cuota.
+
+    Si falla por autenticación o porque la hoja ya no se encuentra, se
+    descartan los manejadores del libro, se reabre y se reintenta una vez.
+
+    Args:
+        tipo: Cubeta de cuota de la operación ('escritura' por defecto)
+
+    Returns:
+        Lo que devuelva `operacion`
+    """
+    try:
+        return llamar_api(operacion, obtener_hoja(client, sheet_id, nombre), tipo=tipo)
+    except Exception as e:
+        if not _requiere_reconexion(e):
+            raise
+        olvidar_manejadores(sheet_id)
+        return llamar_api(operacion, obtener_hoja(client, sheet_id, nombre), tipo=tipo)
+
+
+def _crear_hojas_faltantes(client, sheet_id: str, nombres: list):
+    """Crea (vía el registro de manejadores) las hojas autocreables que no existan."""
+    for nombre in nombres:
+        if nombre in HOJAS_AUTOCREADAS:
+            obtener_hoja(client, sheet_id, nombre)
+
+
+def cargar_libro(client, sheet_id: str, nombres: list) -> tuple:
+    """
+    Descarga varias pestañas de un libro en una sola llamada y las convierte a registros.
+
+    Si la llamada falla porque falta alguna hoja autocreable ('Chat', 'Tareas', 'Control'),
+    se crean y se reintenta una vez. El encabezado de las hojas de
+    ENCABEZADO_VARIABLE ('Equipos') se detecta sobre los mismos valores
+    descargados, sin peticiones adicionales.
+
+    Args:
+        client: Cliente gspread autorizado
+        sheet_id: ID del libro de Google Sheets
+        nombres: Nombres de las pestañas
+
+    Returns:
+        Tupla (registros, encabezados): nombre -> lista de registros y
+        nombre -> (fila_encabezado, encabezados) para cada pestaña
+    """
+    try:
+        valores = _batch_get(client, sheet_id, nombres)
+    except gspread.exceptions.APIError as e:
+        if getattr(e, "code", None) != 400 or not any(n in HOJAS_AUTOCREADAS for n in nombres):
+            raise
+        _crear_hojas_faltantes(client, sheet_id, nombres)
+        valores = _batch_get(client, sheet_id, nombres)
+    encabezados = {
+        nombre: (detectar_encabezado(filas, ENCABEZADO_VARIABLE[nombre]) if nombre in ENCABEZADO_VARIABLE
+                 else (1, list(filas[0]) if filas else []))
+        for nombre, filas in valores.items()
+    }
+    registros = {
+        nombre: registros_desde_valores(filas, encabezado=encabezados[nombre])
+        for nombre, filas in valores.items()
+    }
+    return registros, encabezados
+
+
+def cargar_libros(client, libros: dict) -> tuple:
+    """
+    Descarga varios libros en paralelo (una petición por libro).
+
+    Args:
+        client: Cliente gspread autorizado
+        libros: Diccionario sheet_id -> lista de pestañas
+
+    Returns:
+        Tupla (datos, encabezados, errores): sheet_id -> {pestaña: registros},
+        sheet_id -> {pestaña: (fila_encabezado, encabezados)} y
+        sheet_id -> excepción para los libros que fallaron
+    """
+    datos, encabezados, errores = {}, {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, len(libros))) as pool:
+        futuros = {
+            sheet_id: pool.submit(cargar_libro, client, sheet_id, nombres)
+            for sheet_id, nombres in libros.items()
+        }
+        for sheet_id, futuro in futuros.items():
+            try:
+                datos[sheet_id], encabezados[sheet_id] = futuro.result()
+            except Exception as e:
+                errores[sheet_id] = e
+    return datos, encabezados, errores
+
+
+def version_snapshot(datos) -> str:
+    """Hash de los datos descargados; solo cambia si cambia alguna celda."""
+    return hashlib.sha1(pickle.dumps(datos, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+
+def _nuevo_snapshot(datos) -> dict:
+    ahora = time.time()
+    version = version_snapshot(datos)
+    return {
+        "datos": datos,
+        "version": version,
+        # Copia descargada y cambios locales aplicados encima (ver modificar_snapshot)
+        "base": version,
+        "datos_base": datos,
+        "cambios": [],
+        "obtenido_en": ahora,
+        "intentado_en": ahora,
+        "error": "",
+    }
+
+
+def _marcar_refresco(clave: str):
+    """Registra un refresco nuevo (se llama con _lock_snapshots tomado) y devuelve su marca."""
+    marca = (time.time(), object())
+    _refrescando[clave] = marca
+    return marca
+
+
+def _refresco_activo(clave: str) -> bool:
+    """True si hay un refresco de la clave que no lleva más de MAX_DURACION_REFRESCO (con el lock tomado)."""
+    marca = _refrescando.get(clave)
+    return marca is not None and time.time() - marca[0] <= MAX_DURACION_REFRESCO
+
+
+def _refrescar(clave: str, cargar, marca):
+    """Descarga de nuevo los datos; si falla conserva la copia anterior y guarda el error."""
+    try:
+        nuevo = _nuevo_snapshot(cargar())
+        with _lock_snapshots:
+            anterior = _snapshots.get(clave)
+            # Un refresco colgado que termina tarde no pisa datos obtenidos después de su inicio
+            if anterior is None or anterior["obtenido_en"] <= marca[0] or _refrescando.get(clave) is marca:
+                _snapshots[clave] = nuevo
+    except Exception as e:
+        print(f"Error al refrescar '{clave}' en segundo plano: {e}")
+        with _lock_snapshots:
+            anterior = _snapshots.get(clave)
+            if anterior is not None:
+                _snapshots[clave] = {**anterior, "intentado_en": time.time(), "error": str(e)}
+    finally:
+        with _lock_snapshots:
+            if _refrescando.get(clave) is marca:
+                del _refrescando[clave]
+
+
+def obtener_snapshot(clave: str, cargar, max_edad: float = 30) -> dict:
+    """
+    Devuelve la última copia de los datos sin esperar a la API.
+
+    Si no hay copia se descarga en el hilo actual (las sesiones que lleguen a la
+    vez esperan a esa misma descarga). Si la copia tiene más de `max_edad`
+    segundos se devuelve igual y se lanza un único refresco en segundo plano
+    (uno nuevo solo si el anterior lleva más de MAX_DURACION_REFRESCO).
+
+    Args:
+        clave: Identificador de los datos (p. ej. 'sheets')
+        cargar: Función sin argumentos que descarga los datos
+        max_edad: Segundos tras los cuales la copia se considera vieja
+
+    Returns:
+        Diccionario con 'datos', 'version', 'obtenido_en', 'intentado_en',
+        'error' y los cambios locales ('base', 'datos_base', 'cambios')
+    """
+    with _lock_snapshots:
+        snapshot = _snapshots.get(clave)
+        lock_carga = _locks_carga.setdefault(clave, threading.Lock())
+
+    if snapshot is None:
+        with lock_carga:
+            with _lock_snapshots:
+                snapshot = _snapshots.get(clave)
+            if snapshot is None:
+                snapshot = _nuevo_snapshot(cargar())
+                with _lock_snapshots:
+                    _snapshots[clave] = snapshot
+        return snapshot
+
+    with _lock_snapshots:
+        if time.time() - snapshot["intentado_en"] > max_edad and not _refresco_activo(clave):
+            marca = _marcar_refresco(clave)
+            threading.Thread(target=_refrescar, args=(clave, cargar, marca), daemon=True).start()
+    return snapshot
+
+
+def refrescar_snapshot(clave: str, cargar) -> dict:
+    """Fuerza una descarga síncrona (p. ej. botón de reintento) y devuelve la copia resultante."""
+    with _lock_snapshots:
+        marca = _marcar_refresco(clave)
+    _refrescar(clave, cargar, marca)
+    with _lock_snapshots:
+        snapshot = _snapshots.get(clave)
+    if snapshot is None:
+        return obtener_snapshot(clave, cargar)
+    return snapshot
+
+
+def refresco_en_curso(clave: str) -> bool:
+    """True si hay un refresco en segundo plano para la clave."""
+    with _lock_snapshots:
+        return _refresco_activo(clave)
+
+
+def version_con_cambios(base: str, cambios: list) -> str:
+    """Versión de una copia con cambios locales: la descargada más los IDs de los cambios."""
+    if not cambios:
+        return base
+    digest = hashlib.sha1(base.encode("utf-8"))
+    for cambio in cambios:
+        digest.update(str(cambio["id"]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def modificar_snapshot(clave: str, transformar, cambios: list = ()) -> dict:
+    """
+    Reemplaza los datos de la copia en memoria por `transformar(datos)` (p. ej.
+    para reflejar escrituras encoladas).
+
+    La versión no se recalcula sobre los datos: se deriva de la versión
+    descargada ('base') y de los IDs de los cambios acumulados, que quedan en
+    'cambios' junto con 'datos_base' para que quien construye estructuras
+    derivadas pueda aplicarlos de forma incremental.
+
+    Args:
+        clave: Identificador de los datos
+        transformar: Función datos -> datos nuevos (no debe modificar los recibidos)
+        cambios: Cambios que aplica `transformar` (diccionarios con 'id')
+
+    Returns:
+        La nueva copia, o None si todavía no hay ninguna
+    """
+    with _lock_snapshots:
+        snapshot = _snapshots.get(clave)
+        if snapshot is None:
+            return None
+        acumulados = snapshot["cambios"] + list(cambios)
+        nuevo = {
+            **snapshot,
+            "datos": transformar(snapshot["datos"]),
+            "version": version_con_cambios(snapshot["base"], acumulados),
+            "cambios": acumulados,
+        }
+        _snapshots[clave] = nuevo
+        return nuevo